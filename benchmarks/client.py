@@ -0,0 +1,117 @@
+"""
+Compare the overhead each trial pays for talking to
+a Nonvex server when every request opens a new
+connection versus when connections are pooled and
+kept alive across requests. The server is a minimal
+stand-in that hands out trials without doing any
+actual searching, so that all that gets measured
+is the cost of the requests themselves.
+"""
+
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Thread
+
+import numpy as np
+import requests
+from hermes.typeo import typeo
+
+from nonvex.search import NonvexClient
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # headers and bodies get written separately, so with
+    # keep-alive connections Nagle's algorithm would hold
+    # up every response waiting on an ACK from the client
+    disable_nagle_algorithm = True
+    trial_ids = count()
+
+    def _respond(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _next_trial(self):
+        self._respond(
+            {
+                "id": str(next(self.trial_ids)),
+                "hyperparameters": {"learning_rate": 1e-4},
+            }
+        )
+
+    def do_GET(self):
+        if self.path.startswith("/hyperparameters"):
+            self._respond({"hyperparameters": ["learning_rate"]})
+        else:
+            self._next_trial()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._next_trial()
+
+    def log_message(self, *args):
+        return
+
+
+def time_unpooled(url: str, num_trials: int):
+    latencies = []
+    response = requests.get(f"{url}/start/worker")
+    trial_id = response.json()["id"]
+    for _ in range(num_trials):
+        start_time = time.perf_counter()
+        response = requests.get(
+            f"{url}/end/{trial_id}",
+            params={"val_loss": 0.1, "worker_id": "worker"},
+        )
+        trial_id = response.json()["id"]
+        latencies.append(time.perf_counter() - start_time)
+    return np.array(latencies) * 1000
+
+
+def time_pooled(url: str, num_trials: int):
+    latencies = []
+    client = NonvexClient(url, "worker")
+    _, trial_id = client.start_worker()
+    for _ in range(num_trials):
+        start_time = time.perf_counter()
+        _, trial_id = client.end_trial(trial_id, {"val_loss": 0.1})
+        latencies.append(time.perf_counter() - start_time)
+    client.close()
+    return np.array(latencies) * 1000
+
+
+@typeo
+def main(num_trials: int = 10000):
+    """Benchmark per-trial client overhead
+
+    Args:
+        num_trials:
+            The number of trials to report for each benchmark
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    try:
+        for name, fn in [("unpooled", time_unpooled), ("pooled", time_pooled)]:
+            latencies = fn(url, num_trials)
+            p50, p99 = np.percentile(latencies, [50, 99])
+            print(
+                f"{name:>10}: p50 {p50:.2f} ms, p99 {p99:.2f} ms, "
+                f"mean {latencies.mean():.2f} ms"
+            )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compare how long it takes to look up the best trials of
+a search with many completed trials using keras-tuner's
+oracle, which sorts all of its `Trial` objects every time,
+versus using Nonvex's compact trial history.
+"""
+
+import tempfile
+import time
+
+import keras_tuner as kt
+import numpy as np
+from hermes.typeo import typeo
+
+from nonvex.app.history import TrialHistory
+
+
+def time_fn(fn, num_repeats):
+    start_time = time.perf_counter()
+    for _ in range(num_repeats):
+        fn()
+    return (time.perf_counter() - start_time) / num_repeats * 1e6
+
+
+@typeo
+def main(num_trials: int = 100000, k: int = 10, num_repeats: int = 20):
+    """Benchmark top-k queries over completed trials
+
+    Args:
+        num_trials:
+            The number of completed trials to query
+        k:
+            The number of best trials to look up
+        num_repeats:
+            The number of times to time each query
+    """
+
+    hyperparameters = kt.HyperParameters()
+    hyperparameters.Float("learning_rate", 5e-6, 5e-4, sampling="log")
+    hyperparameters.Choice("batch_size", [32, 64, 128])
+
+    rng = np.random.default_rng(0)
+    learning_rates = 5e-6 * 100 ** rng.random(num_trials)
+    batch_sizes = rng.choice([32, 64, 128], num_trials)
+    scores = rng.random(num_trials)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        oracle = kt.oracles.RandomSearch(
+            objective="val_loss",
+            max_trials=num_trials,
+            hyperparameters=hyperparameters,
+        )
+        oracle._set_project_dir(tmpdir, "history", overwrite=True)
+        history = TrialHistory(hyperparameters, "min")
+
+        for i in range(num_trials):
+            values = {
+                "learning_rate": float(learning_rates[i]),
+                "batch_size": int(batch_sizes[i]),
+            }
+            trial = kt.engine.trial.Trial(
+                hyperparameters=hyperparameters,
+                trial_id=str(i),
+                status=kt.engine.trial.TrialStatus.COMPLETED,
+            )
+            trial.score = float(scores[i])
+            oracle.trials[trial.trial_id] = trial
+            history.add(trial.trial_id, values, trial.score)
+
+        benchmarks = [
+            ("keras-tuner top-k", lambda: oracle.get_best_trials(k)),
+            ("history top-k", lambda: history.top(k)),
+            ("history summary", history.summary),
+            (
+                "history filter",
+                lambda: history.filter({"batch_size": "64"}, k),
+            ),
+        ]
+        for name, fn in benchmarks:
+            latency = time_fn(fn, num_repeats)
+            print(f"{name:>18}: {latency:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
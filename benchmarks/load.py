@@ -0,0 +1,325 @@
+"""
+Measure how a Nonvex server holds up as the number of workers
+talking to it grows. For each number of workers, a server gets
+started locally and hammered by that many synthetic workers, each
+in its own thread, which "train" trials by sleeping for a random
+amount of time and fail some fraction of them. Reports the number
+of trials completed per second, p50 and p99 request latencies per
+endpoint as seen by the workers, and how much the memory of the
+process grew over the search. Results can be saved as a baseline
+and later runs compared against it to catch regressions.
+"""
+
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from typing import List, Optional
+
+import numpy as np
+import requests
+from hermes.typeo import typeo
+
+from nonvex.app import create_app, run_server
+from nonvex.search import NonvexClient
+
+HYPERPARAMETERS = """
+import keras_tuner as kt
+
+hyperparameters = kt.HyperParameters()
+hyperparameters.Float("learning_rate", 5e-6, 5e-4, sampling="log")
+hyperparameters.Choice("batch_size", [32, 64, 128])
+"""
+
+
+class TimedClient(NonvexClient):
+    """Client which records the latency of every request it makes"""
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.latencies = defaultdict(list)
+
+    def _request(self, method, path, timeout=None, **kwargs):
+        start_time = time.perf_counter()
+        response = super()._request(method, path, timeout, **kwargs)
+
+        # label requests by endpoint rather than by
+        # the worker or trial id at the end of the path
+        endpoint = path.split("/")[0]
+        self.latencies[endpoint].append(time.perf_counter() - start_time)
+        return response
+
+
+def run_worker(
+    url: str,
+    worker_id: str,
+    trial_duration: float,
+    failure_rate: float,
+    poll_timeout: float,
+):
+    rng = random.Random(worker_id)
+    client = TimedClient(url, worker_id, poll_timeout=poll_timeout, timeout=60)
+
+    _, trial_id = client.start_worker()
+    while trial_id is not None:
+        if trial_duration > 0:
+            time.sleep(rng.expovariate(1 / trial_duration))
+        if rng.random() < failure_rate:
+            _, trial_id = client.cancel_trial(trial_id)
+        else:
+            result = {"val_loss": rng.random()}
+            _, trial_id = client.end_trial(trial_id, result)
+    client.close()
+    return client.latencies
+
+
+def serve(app, num_threads: int) -> str:
+    """Serve an app in the background the way `nonvex serve` does"""
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    # the server can't be stopped from outside, so it gets
+    # left running in the background once its search is done
+    kwargs = {"port": port, "num_threads": num_threads}
+    Thread(target=run_server, args=(app,), kwargs=kwargs, daemon=True).start()
+
+    url = f"http://127.0.0.1:{port}"
+    while True:
+        try:
+            requests.get(f"{url}/hyperparameters")
+            return url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+
+def rss_mb():
+    # use the current resident memory where we can
+    # read it, otherwise fall back to the peak
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except FileNotFoundError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def run_scenario(
+    output_dir: str,
+    num_workers: int,
+    num_trials: int,
+    max_parallel_workers: int,
+    trial_duration: float,
+    failure_rate: float,
+    poll_timeout: float,
+    num_threads: int,
+):
+    memory = rss_mb()
+    app = create_app(
+        objective="val_loss",
+        max_trials=num_trials,
+        output_dir=output_dir,
+        project_name=f"load-{num_workers}",
+        max_parallel_workers=max_parallel_workers,
+        max_fails_per_worker=num_trials,
+    )
+
+    url = serve(app, num_threads)
+    try:
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = [
+                executor.submit(
+                    run_worker,
+                    url,
+                    f"worker-{i}",
+                    trial_duration,
+                    failure_rate,
+                    poll_timeout,
+                )
+                for i in range(num_workers)
+            ]
+            latencies = defaultdict(list)
+            for future in futures:
+                for endpoint, values in future.result().items():
+                    latencies[endpoint].extend(values)
+        duration = time.perf_counter() - start_time
+        memory = rss_mb() - memory
+    finally:
+        app.extensions["nonvex"].close()
+
+    result = {
+        "trials_per_sec": num_trials / duration,
+        "memory_mb": memory,
+        "latency_ms": {},
+    }
+    for endpoint, values in sorted(latencies.items()):
+        p50, p99 = np.percentile(np.array(values) * 1000, [50, 99])
+        result["latency_ms"][endpoint] = {
+            "p50": p50,
+            "p99": p99,
+            "count": len(values),
+        }
+    return result
+
+
+def compare(name: str, result: dict, baseline: dict, tolerance: float):
+    """Get descriptions of any metrics that regressed from a baseline"""
+
+    regressions = []
+
+    def check(metric, value, base, higher_is_better=False):
+        change = (value - base) / base if base else 0
+        if higher_is_better:
+            change = -change
+        if change > tolerance:
+            regressions.append(
+                f"{name} {metric}: {value:.2f} vs. baseline {base:.2f}"
+            )
+
+    check(
+        "trials/s",
+        result["trials_per_sec"],
+        baseline["trials_per_sec"],
+        higher_is_better=True,
+    )
+    for endpoint, latency in result["latency_ms"].items():
+        base = baseline["latency_ms"].get(endpoint)
+        if base is not None:
+            check(f"{endpoint} p99 ms", latency["p99"], base["p99"])
+
+    # memory growth can be tiny, so don't flag anything
+    # within a few MB of the baseline as a regression
+    base = max(baseline["memory_mb"], 4)
+    check("memory growth MB", max(result["memory_mb"], 4), base)
+    return regressions
+
+
+@typeo
+def main(
+    num_workers: List[int] = [10, 100, 1000],
+    num_trials: int = 2000,
+    max_parallel_workers: int = 64,
+    trial_duration: float = 0.05,
+    failure_rate: float = 0.05,
+    poll_timeout: float = 5,
+    num_threads: int = 16,
+    baseline: Optional[str] = None,
+    save_baseline: bool = False,
+    tolerance: float = 0.2,
+):
+    """Benchmark a server under load from many synthetic workers
+
+    Args:
+        num_workers:
+            The numbers of workers to run a search with.
+            Each gets a separate search of its own
+        num_trials:
+            The number of trials to complete in each search
+        max_parallel_workers:
+            The maximum number of trials the server lets
+            run at once. Any other workers wait in line
+        trial_duration:
+            The mean number of seconds a trial takes to run.
+            Durations are drawn from an exponential distribution
+        failure_rate:
+            The fraction of trials which fail and get cancelled
+        poll_timeout:
+            The number of seconds workers ask the server to hold
+            requests open while waiting in line for a slot
+        num_threads:
+            The number of threads the server
+            handles requests with
+        baseline:
+            Path to a JSON file of baseline results. If it exists,
+            results get compared against it, and the script exits
+            with an error if any regressed
+        save_baseline:
+            Whether to save the results to `baseline` rather
+            than comparing against it
+        tolerance:
+            The fraction by which a result can be worse than its
+            baseline before it counts as a regression
+    """
+
+    # the server logs every request, or every time requests
+    # back up under load, which would drown out the results
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    logging.getLogger("waitress.queue").setLevel(logging.ERROR)
+
+    baselines = {}
+    if baseline is not None and os.path.exists(baseline):
+        with open(baseline, "r") as f:
+            baselines = json.load(f)
+
+    results, regressions = {}, []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        with open("nonvex-hp.py", "w") as f:
+            f.write(HYPERPARAMETERS)
+
+        try:
+            for n in num_workers:
+                # results are only comparable across runs
+                # of the same scenario, so key them by it
+                name = (
+                    f"workers={n},trials={num_trials},"
+                    f"parallel={max_parallel_workers},"
+                    f"duration={trial_duration},failures={failure_rate},"
+                    f"threads={num_threads}"
+                )
+                result = run_scenario(
+                    tmpdir,
+                    n,
+                    num_trials,
+                    max_parallel_workers,
+                    trial_duration,
+                    failure_rate,
+                    poll_timeout,
+                    num_threads,
+                )
+                results[name] = result
+
+                print(
+                    f"{n:>6} workers: {result['trials_per_sec']:.1f} "
+                    f"trials/s, memory +{result['memory_mb']:.1f} MB"
+                )
+                for endpoint, latency in result["latency_ms"].items():
+                    print(
+                        f"{endpoint:>16}: p50 {latency['p50']:.2f} ms, "
+                        f"p99 {latency['p99']:.2f} ms, "
+                        f"{latency['count']} requests"
+                    )
+
+                if not save_baseline and name in baselines:
+                    regressions += compare(
+                        name, result, baselines[name], tolerance
+                    )
+        finally:
+            os.chdir(cwd)
+
+    if save_baseline and baseline is not None:
+        baselines.update(results)
+        with open(baseline, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Saved baseline to {baseline}")
+
+    if regressions:
+        print("Regressions from baseline:")
+        for regression in regressions:
+            print(f"    {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compare the latency of requests to a Nonvex server
+when trial state is written to disk as soon as it
+changes versus when writes are coalesced and done
+in the background.
+"""
+
+import os
+import tempfile
+import time
+from typing import Optional
+
+import numpy as np
+from hermes.typeo import typeo
+
+from nonvex.app import create_app
+
+HYPERPARAMETERS = """
+import keras_tuner as kt
+
+hyperparameters = kt.HyperParameters()
+hyperparameters.Float("learning_rate", 5e-6, 5e-4, sampling="log")
+hyperparameters.Choice("batch_size", [32, 64, 128])
+"""
+
+
+def time_requests(output_dir: str, num_trials: int, flush_interval: float):
+    app = create_app(
+        objective="val_loss",
+        max_trials=num_trials,
+        output_dir=output_dir,
+        project_name=f"flush-{flush_interval}",
+        max_parallel_workers=1,
+        flush_interval=flush_interval,
+    )
+    client = app.test_client()
+
+    latencies = []
+    trial_id = client.get("/start/worker").get_json()["id"]
+    while trial_id != "":
+        start_time = time.perf_counter()
+        response = client.get(
+            f"/end/{trial_id}",
+            query_string={"val_loss": 0.1, "worker_id": "worker"},
+        )
+        latencies.append(time.perf_counter() - start_time)
+        trial_id = response.get_json()["id"]
+
+    app.extensions["nonvex"].close()
+    return np.array(latencies) * 1000
+
+
+@typeo
+def main(num_trials: int = 500, output_dir: Optional[str] = None):
+    """Benchmark synchronous against coalesced trial writes
+
+    Args:
+        num_trials:
+            The number of trials to run for each benchmark
+        output_dir:
+            Directory in which to create project directories.
+            Point this at a network filesystem to see the
+            biggest difference. If left as `None`, a
+            temporary directory will be used
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_dir = output_dir or tmpdir
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        with open("nonvex-hp.py", "w") as f:
+            f.write(HYPERPARAMETERS)
+
+        try:
+            for name, flush_interval in [("sync", 0), ("coalesced", 1.0)]:
+                latencies = time_requests(
+                    output_dir, num_trials, flush_interval
+                )
+                p50, p99 = np.percentile(latencies, [50, 99])
+                print(
+                    f"{name:>10}: p50 {p50:.2f} ms, p99 {p99:.2f} ms, "
+                    f"mean {latencies.mean():.2f} ms"
+                )
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
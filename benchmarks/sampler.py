@@ -0,0 +1,73 @@
+"""
+Compare how long it takes keras-tuner's random search
+and Nonvex's vectorized sampler to create trials as a
+search space made up of `Choice` hyperparameters fills
+up, and how much of the space each one manages to cover
+before deciding that it's run out of new configs.
+"""
+
+import tempfile
+import time
+
+import keras_tuner as kt
+from hermes.typeo import typeo
+
+from nonvex.app.sampler import VectorizedRandomSearch
+
+
+def time_oracle(oracle_cls, output_dir, num_choices, num_values):
+    hyperparameters = kt.HyperParameters()
+    for i in range(num_choices):
+        hyperparameters.Choice(f"choice_{i}", list(range(num_values)))
+    size = num_values**num_choices
+
+    oracle = oracle_cls(
+        objective="val_loss", max_trials=size, hyperparameters=hyperparameters
+    )
+    oracle._set_project_dir(output_dir, oracle_cls.__name__, overwrite=True)
+
+    # only time sampling, not writing trials to disk
+    oracle.save = lambda: None
+    oracle._save_trial = lambda trial: None
+
+    num_trials = 0
+    start_time = time.perf_counter()
+    while True:
+        trial = oracle.create_trial("worker")
+        oracle.ongoing_trials.pop("worker", None)
+        if trial.status != kt.engine.trial.TrialStatus.RUNNING:
+            break
+        num_trials += 1
+    duration = time.perf_counter() - start_time
+    return num_trials, size, duration
+
+
+@typeo
+def main(num_choices: int = 6, num_values: int = 4):
+    """Benchmark trial creation over a space of `Choice` values
+
+    Args:
+        num_choices:
+            The number of `Choice` hyperparameters in the space
+        num_values:
+            The number of values each `Choice` can take on
+    """
+
+    oracles = [
+        ("keras-tuner", kt.oracles.RandomSearch),
+        ("vectorized", VectorizedRandomSearch),
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, oracle_cls in oracles:
+            num_trials, size, duration = time_oracle(
+                oracle_cls, tmpdir, num_choices, num_values
+            )
+            print(
+                f"{name:>12}: {num_trials}/{size} configs in "
+                f"{duration:.2f} s, {duration / num_trials * 1e6:.1f} "
+                "us per trial"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,70 @@
 import argparse
+import sys
 from inspect import signature
 
 from hermes.typeo.typeo import CustomHelpFormatter, _parse_doc, make_parser
 
 
+def _make_serve(create_app):
+    from .app import run_server
+
+    def serve(host, port, num_threads, **kwargs):
+        app = create_app(**kwargs)
+        try:
+            run_server(app, host=host, port=port, num_threads=num_threads)
+        finally:
+            app.extensions["nonvex"].close()
+
+    # build the `serve` signature and docs out of the
+    # app arguments plus the server arguments, minus
+    # the `app` argument that we build ourselves
+    server_params = list(signature(run_server).parameters.values())
+    serve.__signature__ = signature(create_app).replace(
+        parameters=(
+            list(signature(create_app).parameters.values())
+            + server_params[1:]
+        )
+    )
+    _, server_args_doc = _parse_doc(run_server)
+    serve.__doc__ = create_app.__doc__.rstrip() + "\n" + server_args_doc
+    return serve
+
+
+def _load_serve():
+    from .app import create_app
+
+    return _make_serve(create_app)
+
+
+def _load_studies():
+    from .app import create_study_app
+
+    return _make_serve(create_study_app)
+
+
+def _load_search():
+    from .search import run_search
+
+    return run_search
+
+
+def _load_local():
+    from .search.local import run_local_search
+
+    return run_local_search
+
+
+# subcommands get imported lazily, since the server
+# depends on TensorFlow and we don't want search
+# workers to pay for importing it if they don't need to
+_COMMANDS = {
+    "serve": _load_serve,
+    "studies": _load_studies,
+    "search": _load_search,
+    "local": _load_local,
+}
+
+
 def run_cli():
     parser = argparse.ArgumentParser(
         prog="Nonvex",
@@ -12,50 +73,44 @@ def run_cli():
     )
     subparsers = parser.add_subparsers(dest="command", required=True)
 
-    def add_subparser(fn, name=None):
+    # only load the subcommand being run, unless we
+    # can't tell which one it is, e.g. for `nonvex -h`
+    commands = _COMMANDS
+    if len(sys.argv) > 1 and sys.argv[1] in _COMMANDS:
+        commands = {sys.argv[1]: _COMMANDS[sys.argv[1]]}
+
+    fns = {}
+    for name, load in commands.items():
+        try:
+            fns[name] = fn = load()
+        except ImportError:
+            continue
+
         description, _ = _parse_doc(fn)
         subparser = subparsers.add_parser(
-            name or fn.__name__,
+            name,
             description=description,
             formatter_class=argparse.RawDescriptionHelpFormatter,
         )
         make_parser(fn, subparser)
-        return subparser
-
-    try:
-        from .app import create_app
-    except ImportError:
-        pass
-    else:
 
-        def serve(**kwargs):
-            app = create_app(**kwargs)
-            app.run()
-
-        serve.__signature__ = signature(create_app)
-        serve.__doc__ = create_app.__doc__
-        add_subparser(serve)
-
-    try:
-        from .search import run_search
-    except ImportError:
-        pass
-    else:
-        subparser = add_subparser(run_search, "search")
-        for action in subparser._actions:
+    for name in ["search", "local"]:
+        if name not in fns:
+            continue
+        for action in subparsers.choices[name]._actions:
             if action.option_strings[0] == "--executable":
                 action.option_strings = []
 
     args, fn_args = parser.parse_known_args()
     args = vars(args)
     command = args.pop("command")
-    if command == "serve":
+    if command in ("serve", "studies"):
         if len(fn_args) > 0:
-            raise parser.ArgumentError("Unknown arguments {}".format(fn_args))
-        serve(**args)
+            parser.error("Unknown arguments {}".format(fn_args))
+        fns[command](**args)
     else:
         args.pop("args")
-        run_search(**args, args=fn_args)
+        fns[command](**args, args=fn_args)
 
 
 if __name__ == "__main__":
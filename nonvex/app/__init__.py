@@ -1,7 +1,80 @@
+import dataclasses
+import importlib.util
+import math
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import partial
+from secrets import token_hex
+from threading import BoundedSemaphore, Condition, Event, RLock, Thread
+from typing import Dict, Optional, Union
 
 import keras_tuner as kt
-from flask import Flask, make_response, request
+import numpy as np
+from flask import Blueprint, Flask, g, make_response, request
+from werkzeug.local import LocalProxy
+
+from nonvex.app.buffer import TrialBuffer
+from nonvex.app.cache import ResultCache
+from nonvex.app.costs import RuntimeModel
+from nonvex.app.history import TrialHistory
+from nonvex.app.journal import Journal
+from nonvex.app.metrics import (
+    DURATION_BUCKETS,
+    LATENCY_BUCKETS,
+    Metrics,
+    render_prometheus,
+)
+from nonvex.app.persistence import OracleWriter
+from nonvex.app.sampler import VectorizedRandomSearch
+from nonvex.app.scheduler import ASHAScheduler
+from nonvex.app.server import run_server
+from nonvex.app.storage import SQLiteStorage
+from nonvex.app.studies import StudyExists, StudyManager
+
+# tuner id under which the oracle creates trials
+# before they've been handed out to an actual worker
+_UNASSIGNED_ID = "__nonvex_unassigned__"
+
+_ORACLES = {
+    "random": VectorizedRandomSearch,
+    "bayesian": kt.oracles.BayesianOptimization,
+    "hyperband": kt.oracles.Hyperband,
+}
+
+# Hyperband tells trials how many epochs to train for, and
+# which earlier trial to pick training back up from, through
+# special values. Hand these to training functions under
+# names that can actually be used as arguments
+_HYPERBAND_VALUES = {
+    "tuner/epochs": "epochs",
+    "tuner/initial_epoch": "initial_epoch",
+    "tuner/trial_id": "resume_trial_id",
+}
+
+# number of seconds between checks for a free slot when
+# slots are shared with other replicas, which can't wake
+# up our waiting workers when their trials finish
+_POLL_INTERVAL = 0.1
+
+
+class SlotUnavailable(Exception):
+    """Raised when there's no room for a worker to start trials
+
+    Args:
+        retry_after:
+            The number of seconds the worker should
+            wait before trying again
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(
+            "No trial slots available, retry "
+            "after {:0.1f}s".format(retry_after)
+        )
+        self.retry_after = retry_after
 
 
 def _load_hyperparameters():
@@ -30,75 +103,1295 @@ class Searcher:
     project_name: str
     max_parallel_workers: int = 1
     max_fails_per_worker: int = 5
+    trial_buffer_size: int = 4
+    lease_timeout: Optional[float] = None
+    resume: bool = False
+    flush_interval: float = 1.0
+    grace_period: Optional[int] = None
+    reduction_factor: int = 3
+    oracle_type: str = "random"
+    oracle_options: Optional[Dict[str, float]] = None
+    memoize: bool = True
+    warm_start: Optional[str] = None
+    hyperparameters: Optional[kt.HyperParameters] = None
+    storage: Optional[str] = None
+    replica_id: Optional[str] = None
+    cost_aware: bool = False
+    speculate: bool = False
+    max_waiting_workers: int = 8
 
     def __post_init__(self):
-        hyperparameters = _load_hyperparameters()
-        self.oracle = kt.oracles.RandomSearch(
+        # Hyperband brackets and early stopping rungs live in
+        # the memory of whichever replica created them, so
+        # other replicas wouldn't be able to follow along.
+        # Cost-aware scheduling picks from trials buffered
+        # ahead of time, which replicas can't do
+        if self.storage is not None and (
+            self.oracle_type == "hyperband"
+            or self.grace_period is not None
+            or self.cost_aware
+        ):
+            raise ValueError(
+                "Shared storage doesn't support Hyperband, early "
+                "stopping or cost-aware scheduling"
+            )
+
+        # with shared storage, each replica keeps its own copy
+        # of the search that it brings up to date from storage
+        # whenever it handles a request. Keep the copies in
+        # separate directories so their files don't clash
+        self.store = None
+        project_name = self.project_name
+        if self.storage is not None:
+            if self.replica_id is None:
+                self.replica_id = token_hex(4)
+            self.store = SQLiteStorage(self.storage)
+            project_name = os.path.join(project_name, self.replica_id)
+
+            # the version of the latest change from
+            # storage that this replica has seen
+            self._version = 0
+
+        self.oracle = self._build_oracle()
+        self.oracle._set_project_dir(
+            self.output_dir, project_name, overwrite=True
+        )
+        self.failure_counts = {}
+
+        # whether the oracle last said it couldn't create a
+        # trial until some of the running ones finish, rather
+        # than that it was out of trials altogether
+        self.idle = False
+
+        # all access to the oracle and to `failure_counts` happens
+        # behind this lock, since the server handles requests from
+        # many workers at once and keras-tuner oracles aren't
+        # thread safe. It's reentrant so that methods which already
+        # hold it can call `create_trial` without deadlocking.
+        # Methods that change the search should take it through
+        # `_transaction`, which keeps replicas in sync. Journal
+        # writes happen under it so that events stay in the order
+        # they happened in, but they never wait on the disk, and
+        # unless `flush_interval` is 0, neither do oracle writes
+        self._lock = RLock()
+
+        # rather than writing trial and oracle state to disk
+        # whenever it changes, which can be slow on network
+        # filesystems, batch writes up in the background.
+        # The journal keeps us safe if we die between writes
+        if self.flush_interval > 0:
+            self.writer = OracleWriter(
+                self.oracle, self._lock, self.flush_interval
+            )
+
+        # ongoing trials are indexed by their trial id rather
+        # than by worker id, since workers can run several
+        # trials at once. Keep track of who has what here
+        self.assignments = {}
+
+        # workers running speculative copies of trials
+        # assigned to someone else, mapped to the id of
+        # the trial they're running a copy of
+        self.copies = {}
+
+        # map from trial ids to the time at which the lease on
+        # them runs out, after which the trial gets handed to
+        # another worker
+        self.leases = {}
+
+        # workers waiting for a slot to open up line up in
+        # `admissions`, and get woken up through `slots`
+        # whenever a trial finishes. Keep track of how long
+        # trials take so we can tell workers when to check
+        # back if they get tired of waiting
+        self.admissions = deque()
+        self.slots = Condition(self._lock)
+
+        # each worker waiting in line ties up one of the
+        # server's threads, so only let so many wait at once
+        # to leave threads free for the requests that end
+        # trials and open slots back up. Studies sharing one
+        # server swap this out for one they all share
+        self.waiting = BoundedSemaphore(self.max_waiting_workers)
+        self.start_times = {}
+        self.mean_duration = None
+
+        # record how long requests and trials take and how
+        # trials end up so that the server can be monitored
+        self.metrics = Metrics()
+
+        # if we're stopping trials early, keep track of the
+        # ones we've told to stop in case they report again
+        self.scheduler = None
+        if self.grace_period is not None:
+            self.scheduler = ASHAScheduler(
+                self.oracle.objective.direction,
+                self.grace_period,
+                self.reduction_factor,
+            )
+        self.stopped = set()
+
+        # keep a compact copy of the results of completed
+        # trials around for answering queries about them
+        self.history = TrialHistory(
+            self.oracle.hyperparameters, self.oracle.objective.direction
+        )
+
+        # keep track of the results of configs that have already
+        # been evaluated, including in earlier searches, so that
+        # trials which land on them again don't get trained again
+        self.cache = None
+        if self.memoize:
+            cache_path = os.path.join(
+                self.oracle._project_dir, "results.jsonl"
+            )
+            self.cache = ResultCache(
+                cache_path, self.objective, overwrite=not self.resume
+            )
+            if self.warm_start is not None:
+                self.cache.warm_start(self.warm_start)
+
+        # learn how long trials take from how long they took
+        # on the workers that ran them, scaled by how much
+        # capacity the workers said they had, so that the
+        # longest trials can go out first to the biggest workers
+        self.capacities = {}
+        self.runtimes = None
+        if self.cost_aware:
+            self.runtimes = RuntimeModel(self.oracle.hyperparameters)
+
+        # record everything that happens to trials in a journal
+        # so that if the server goes down, we can pick the search
+        # back up where we left off rather than starting over.
+        # With shared storage, it's storage we pick back up from
+        journal_path = os.path.join(self.oracle._project_dir, "journal.jsonl")
+        unassigned = []
+        if self.resume and self.store is None and os.path.exists(journal_path):
+            unassigned = self._replay(Journal.read(journal_path))
+        self.journal = Journal(journal_path, overwrite=not self.resume)
+
+        # don't start creating new trials until we've
+        # restored any old ones so that trial ids don't clash.
+        # Replicas have to create trials as they hand them out,
+        # inside of a transaction, or two of them could create
+        # different trials with the same id
+        buffer_size = self.trial_buffer_size
+        if self.store is not None:
+            buffer_size = 0
+        self.buffer = TrialBuffer(self._create_trial, buffer_size, unassigned)
+
+        self._closed = Event()
+        if self.lease_timeout is not None:
+            self._sweeper = Thread(target=self._sweep_leases, daemon=True)
+            self._sweeper.start()
+
+        # catch up on whatever other replicas have done so far
+        if self.store is not None:
+            with self._transaction():
+                pass
+
+    def _build_oracle(self):
+        try:
+            oracle_cls = _ORACLES[self.oracle_type]
+        except KeyError:
+            raise ValueError(
+                "Unknown oracle type '{}', must be one of {}".format(
+                    self.oracle_type, ", ".join(_ORACLES)
+                )
+            )
+
+        # keras-tuner only finds out that scipy is missing
+        # once it tries to fit its first model, by which
+        # point workers would already be running trials
+        if self.oracle_type == "bayesian":
+            if importlib.util.find_spec("scipy") is None:
+                raise ImportError(
+                    "Bayesian optimization requires scipy to be installed"
+                )
+
+        # options passed from the command line all come in as
+        # floats, so turn the ones that are whole numbers back
+        # into ints for options like `max_epochs` or `seed`
+        options = {}
+        for key, value in (self.oracle_options or {}).items():
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            options[key] = value
+
+        hyperparameters = self.hyperparameters
+        if hyperparameters is None:
+            hyperparameters = _load_hyperparameters()
+        oracle = oracle_cls(
             objective=self.objective,
-            max_trials=self.max_trials,
             hyperparameters=hyperparameters,
+            **options,
         )
-        self.oracle._set_project_dir(
-            self.output_dir, self.project_name, overwrite=True
+
+        # Hyperband decides how many trials to run on its own,
+        # so set the trial budget here rather than passing it
+        oracle.max_trials = self.max_trials
+        return oracle
+
+    @property
+    def resumable(self):
+        """Whether resuming from the journal restores the whole search
+
+        Hyperband's brackets only live in memory, so a
+        Hyperband search that gets resumed starts filling
+        brackets over again rather than where it left off.
+        """
+        return self.oracle_type != "hyperband"
+
+    def close(self):
+        """Stop background work and write out any outstanding state"""
+
+        self._closed.set()
+        if self.lease_timeout is not None:
+            self._sweeper.join()
+        self.buffer.stop()
+        if self.flush_interval > 0:
+            self.writer.close()
+        self.journal.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.store is not None:
+            self.store.close()
+
+    @contextmanager
+    def _transaction(self, write=True):
+        """Take the lock, and catch up on changes from other replicas
+
+        With shared storage, also holds the storage's write lock
+        if `write` is `True`, so that no other replica can change
+        the search until we're done, and any changes we make get
+        written out together. Requests that only look at the
+        search shouldn't hold up other replicas that way.
+        """
+
+        with self._lock:
+            if self.store is None:
+                yield
+                return
+
+            with self.store.transaction(write):
+                for row in self.store.changes(self._version):
+                    self._apply(row)
+                    self._version = row["version"]
+                yield
+
+    def _apply(self, row):
+        """Bring a trial in line with its state in shared storage
+
+        Changes can be ones that this replica made itself,
+        so applying one that's already been made does nothing.
+        """
+
+        trial_id = row["trial_id"]
+        trial = self.oracle.trials.get(trial_id)
+        if trial is None:
+            trial = self._add_trial(trial_id, row["hyperparameters"])
+        elif trial.status != kt.engine.trial.TrialStatus.RUNNING:
+            return
+
+        status = row["status"]
+        if status == "running":
+            if self.assignments.get(trial_id) != row["worker_id"]:
+                if trial_id in self.assignments:
+                    self._unassign(trial_id)
+                else:
+                    self.buffer.remove(trial_id)
+                self._assign(trial, row["worker_id"], log=False)
+
+            # storage keeps lease expirations in wall clock time,
+            # since monotonic clocks don't agree across processes
+            if row["lease_expiry"] is not None:
+                remaining = row["lease_expiry"] - time.time()
+                self.leases[trial_id] = time.monotonic() + remaining
+            return
+
+        if trial_id in self.assignments:
+            self._unassign(trial_id)
+            self.oracle.ongoing_trials.pop(trial_id)
+        else:
+            self.buffer.remove(trial_id)
+
+        if status == "pending":
+            self.buffer.put(trial)
+        elif status == "completed":
+            self.oracle.ongoing_trials[trial_id] = trial
+            if row["cached"]:
+                self.oracle.max_trials += 1
+            elif self.cache is not None:
+                self.cache.put(trial.hyperparameters.values, row["result"])
+            self._record_result(trial, row["result"])
+        else:
+            self.oracle.ongoing_trials[trial_id] = trial
+            self.oracle.end_trial(
+                trial_id, kt.engine.trial.TrialStatus.INVALID
+            )
+            self.oracle.max_trials += 1
+
+    def _add_trial(self, trial_id, values):
+        """Register a trial created somewhere else with the oracle"""
+
+        hyperparameters = self.oracle.hyperparameters.copy()
+        hyperparameters.values = values
+        trial = kt.engine.trial.Trial(
+            hyperparameters=hyperparameters,
+            trial_id=trial_id,
+            status=kt.engine.trial.TrialStatus.RUNNING,
         )
-        self.failure_counts = {}
+        self.oracle.trials[trial_id] = trial
+        self.oracle.start_order.append(trial_id)
+        self.oracle._tried_so_far.add(self.oracle._compute_values_hash(values))
+        return trial
+
+    def _replay(self, events):
+        """Rebuild the state of a search from its journal
+
+        Returns the trials which were created but not
+        running at the time the journal ended. Trials that
+        were running get reassigned to their workers, so
+        that they can report back once they reconnect.
+        """
+
+        assignments = {}
+        for event in events:
+            trial_id = event["trial_id"]
+            if event["event"] == "create":
+                self._add_trial(trial_id, event["hyperparameters"])
+            elif event["event"] == "assign":
+                assignments[trial_id] = event["worker_id"]
+                if "capacity" in event:
+                    self.capacities[event["worker_id"]] = event["capacity"]
+            elif event["event"] == "requeue":
+                assignments.pop(trial_id)
+            elif event["event"] == "report":
+                self._report(trial_id, event["step"], event["metrics"])
+            else:
+                worker_id = assignments.pop(trial_id, None)
+                trial = self.oracle.trials[trial_id]
+                self.oracle.ongoing_trials[trial_id] = trial
+                if event["event"] == "complete":
+                    if event.get("duration") is not None:
+                        self._record_duration(
+                            trial, event["duration"], worker_id
+                        )
+                    result = event["result"]
+                    if event.get("cached"):
+                        self.oracle.max_trials += 1
+                    elif self.cache is not None:
+                        self.cache.put(trial.hyperparameters.values, result)
+                    self._record_result(trial, result)
+                else:
+                    self.oracle.end_trial(
+                        trial_id, kt.engine.trial.TrialStatus.INVALID
+                    )
+                    self.oracle.max_trials += 1
+
+        unassigned = []
+        for trial_id, trial in self.oracle.trials.items():
+            if trial.status != kt.engine.trial.TrialStatus.RUNNING:
+                continue
+            elif trial_id in assignments:
+                self._assign(trial, assignments[trial_id], log=False)
+                self.failure_counts[assignments[trial_id]] = 0
+            else:
+                unassigned.append(trial)
+        self.oracle.save()
+        return unassigned
+
+    def _create_trial(self):
+        """Create a new trial that isn't assigned to anyone yet
+
+        Trials whose configs have already been evaluated are
+        completed with their cached results instead, and don't
+        count against the trial budget.
+        """
+
+        with self._lock:
+            while True:
+                trial = self._new_trial()
+                if trial is None:
+                    return None
+
+                self.journal.write(
+                    "create",
+                    trial_id=trial.trial_id,
+                    hyperparameters=trial.hyperparameters.values,
+                )
+                if self.store is not None:
+                    self.store.add_trial(
+                        trial.trial_id, trial.hyperparameters.values
+                    )
+
+                result = None
+                if self.cache is not None:
+                    result = self.cache.get(trial.hyperparameters.values)
+                if result is None:
+                    return trial
+                self._complete_from_cache(trial, result)
+
+    def _complete_from_cache(self, trial, result):
+        self.journal.write(
+            "complete", trial_id=trial.trial_id, result=result, cached=True
+        )
+        if self.store is not None:
+            self.store.complete(trial.trial_id, result, cached=True)
+        self.oracle.max_trials += 1
+        self.oracle.ongoing_trials[trial.trial_id] = trial
+        self._record_result(trial, result)
+        self.metrics.increment(
+            "nonvex_trials_total", outcome="cached", worker_id=""
+        )
+
+    def _record_result(self, trial, result):
+        """Complete an ongoing trial with its result"""
+
+        self.oracle.update_trial(trial.trial_id, {self.objective: result})
+        trial.status = kt.engine.trial.TrialStatus.COMPLETED
+        self.oracle.end_trial(trial.trial_id)
+        self.history.add(
+            trial.trial_id, trial.hyperparameters.values, trial.score
+        )
+
+    def _new_trial(self):
+        """Ask the oracle for a new trial, or `None` if there isn't one"""
+
+        with self._lock:
+            # trials which have been created but not handed out
+            # yet aren't ongoing as far as the oracle is concerned,
+            # but Hyperband uses ongoing trials to decide whether
+            # to wait on results or call the search done
+            waiting = {}
+            if self.oracle_type == "hyperband":
+                ongoing = self.oracle.ongoing_trials
+                running = kt.engine.trial.TrialStatus.RUNNING
+                for trial_id, trial in self.oracle.trials.items():
+                    if trial.status == running and trial_id not in ongoing:
+                        waiting[trial_id] = trial
+                ongoing.update(waiting)
+
+            try:
+                trial = self.oracle.create_trial(_UNASSIGNED_ID)
+            finally:
+                self.oracle.ongoing_trials.pop(_UNASSIGNED_ID, None)
+                for trial_id in waiting:
+                    self.oracle.ongoing_trials.pop(trial_id)
+
+            self.idle = trial.status == kt.engine.trial.TrialStatus.IDLE
+            if trial.status != kt.engine.trial.TrialStatus.RUNNING:
+                return None
+        return trial
 
     def get_hyperparameters(self):
         hps = list(self.oracle.hyperparameters._hps.keys())
-        return make_response({"hyperparameters": hps})
+        if self.oracle_type == "hyperband":
+            hps += list(_HYPERBAND_VALUES.values())
+        return {"hyperparameters": hps}
+
+    def _trial_ids(self, worker_id):
+        """Get the ids of all the trials a worker is running"""
+
+        trial_ids = [i for i, w in self.assignments.items() if w == worker_id]
+
+        # copies don't get cleaned up when their trial
+        # finishes, so skip any that aren't running anymore
+        copy = self.copies.get(worker_id)
+        if copy in self.assignments:
+            trial_ids.append(copy)
+        return trial_ids
+
+    def _lease_expiry(self):
+        """Get the wall clock time at which a lease renewed now expires"""
+        if self.lease_timeout is not None:
+            return time.time() + self.lease_timeout
+
+    def _assign(self, trial, worker_id, log=True):
+        if log:
+            # keep track of how much capacity the worker said
+            # it had, so that its runtimes can be scaled by it
+            # even if we get resumed before it starts again
+            data = {}
+            if worker_id in self.capacities:
+                data["capacity"] = self.capacities[worker_id]
+            self.journal.write(
+                "assign", trial_id=trial.trial_id, worker_id=worker_id, **data
+            )
+            if self.store is not None:
+                self.store.claim(
+                    trial.trial_id, worker_id, self._lease_expiry()
+                )
+        self.oracle.ongoing_trials[trial.trial_id] = trial
+        self.assignments[trial.trial_id] = worker_id
+        self.start_times[trial.trial_id] = time.monotonic()
+        self._renew_lease(trial.trial_id, log=False)
+
+    def _unassign(self, trial_id):
+        self.assignments.pop(trial_id)
+        self.leases.pop(trial_id, None)
+        self.slots.notify_all()
+        return time.monotonic() - self.start_times.pop(trial_id)
+
+    def _wait_for_slot(self, wait):
+        """Wait in line for up to `wait` seconds for a free slot"""
+
+        # waiting lets go of our lock but not of the storage's,
+        # which would hold up every other request, so replicas
+        # sharing storage just check whether there's a slot
+        if self.store is not None:
+            return len(self.oracle.ongoing_trials) < self.max_parallel_workers
+
+        # if too many workers are already waiting, just check
+        # whether there's a slot free right now, which there
+        # won't be for workers at the back of the line
+        waiting = wait > 0 and self.waiting.acquire(blocking=False)
+        ticket = object()
+        self.admissions.append(ticket)
+        try:
+            return self.slots.wait_for(
+                lambda: (
+                    self.admissions[0] is ticket
+                    and len(self.oracle.ongoing_trials)
+                    < self.max_parallel_workers
+                ),
+                timeout=wait if waiting else 0,
+            )
+        finally:
+            # let the next worker in line check for a slot
+            self.admissions.remove(ticket)
+            self.slots.notify_all()
+            if waiting:
+                self.waiting.release()
+
+    def _reject(self):
+        """Tell a worker to come back once a slot might be free"""
+
+        self.metrics.increment("nonvex_rejections_total")
+
+        # on average, a slot should open up every
+        # `mean_duration / max_parallel_workers` seconds
+        if self.mean_duration is None:
+            retry_after = 1.0
+        else:
+            retry_after = self.mean_duration / self.max_parallel_workers
+            retry_after = min(max(retry_after, 1.0), 60.0)
+        raise SlotUnavailable(retry_after)
+
+    def _choose_trial(self, worker_id, trials):
+        """Pick which of the buffered trials to give to a worker
+
+        Trials expected to take the longest go out first, since
+        those are the ones that hold up the end of a search if
+        they start late. Workers get trials by rank: the worker
+        with the most capacity of those running trials gets the
+        most expensive trial, and the one with the least gets
+        the cheapest.
+        """
+
+        costs = [
+            self.runtimes.predict(t.hyperparameters.values) for t in trials
+        ]
+        if costs[0] is None:
+            return 0
+
+        capacity = self.capacities.get(worker_id, 1.0)
+        workers = set(self.assignments.values()) | {worker_id}
+        stronger = [self.capacities.get(w, 1.0) > capacity for w in workers]
+        rank = sum(stronger) / max(len(workers) - 1, 1)
+
+        order = np.argsort(-np.array(costs), kind="stable")
+        return int(order[round(rank * (len(trials) - 1))])
+
+    def _next_trials(self, worker_id, num_trials):
+        """Assign up to `num_trials` new trials to a worker"""
+
+        choose = None
+        if self.runtimes is not None:
+            choose = partial(self._choose_trial, worker_id)
+
+        trials = []
+        with self._lock:
+            for _ in range(num_trials):
+                # grab a trial that's already been created
+                # in the background and assign it to this worker
+                trial = self.buffer.get(choose)
+                if trial is None:
+                    break
+                self._assign(trial, worker_id)
+                trials.append(trial)
+        return trials
+
+    def _speculate(self, worker_id):
+        """Give an idle worker a copy of the longest running trial
+
+        Only trials which don't have a copy running already
+        get copied, so that a trial that's stuck can't take
+        up every idle worker.
+        """
+
+        copied = set(self.copies.values())
+        trial_ids = [
+            i
+            for i, w in self.assignments.items()
+            if w != worker_id and i not in copied
+        ]
+        if not trial_ids:
+            return []
+
+        trial_id = min(trial_ids, key=self.start_times.get)
+        self.copies[worker_id] = trial_id
+        self.metrics.increment("nonvex_speculative_copies_total")
+        return [self.oracle.ongoing_trials[trial_id]]
+
+    def _promote_copy(self, trial_id):
+        """Hand a trial over to a worker running a copy of it
+
+        Returns whether there was anyone to hand it over to.
+        """
+
+        for worker_id, copy in self.copies.items():
+            if copy == trial_id:
+                del self.copies[worker_id]
+                self._unassign(trial_id)
+                self._assign(self.oracle.trials[trial_id], worker_id)
+                return True
+        return False
+
+    def _trial_data(self, trial):
+        values = trial.hyperparameters.values
+        if self.oracle_type == "hyperband":
+            values = {
+                k: v for k, v in values.items() if not k.startswith("tuner/")
+            }
+            for key, name in _HYPERBAND_VALUES.items():
+                values[name] = trial.hyperparameters.values.get(key)
+
+        data = {"id": trial.trial_id, "hyperparameters": values}
+        if self.lease_timeout is not None:
+            data["lease"] = self.lease_timeout
+        return data
 
     def create_trial(self, worker_id):
-        trial = self.oracle.create_trial(worker_id)
+        with self._transaction():
+            trial_ids = self._trial_ids(worker_id)
+            if trial_ids:
+                trials = [self.oracle.ongoing_trials[trial_ids[0]]]
+            elif len(self.oracle.ongoing_trials) < self.max_parallel_workers:
+                trials = self._next_trials(worker_id, 1)
+            else:
+                # workers ending a trial usually get to reuse the
+                # slot it frees up, but if the trial was reclaimed
+                # and handed to someone else there's no slot to
+                # reuse, so send the worker to wait in line
+                self._reject()
+
+            # once there's nothing left to run, put idle
+            # workers to use on the trials holding us up
+            if not trials and not self.idle and self.speculate:
+                trials = self._speculate(worker_id)
 
-        # empty hyperparameters means that we've exceeded
-        # the max number of trials, so send back blank
-        # data to indicate that a client should stop
-        if not trial.hyperparameters.values:
+        # no trial means either that the oracle needs to wait
+        # on results from running trials, in which case the
+        # worker should check back later, or that we've
+        # exceeded the max number of trials, so send back
+        # blank data to indicate that a client should stop
+        if not trials and self.idle:
+            self._reject()
+        elif not trials:
             data = {"id": "", "hyperparameters": {}}
         else:
-            data = {
-                "id": trial.trial_id,
-                "hyperparameters": trial.hyperparameters.values,
-            }
-        return make_response(data)
+            data = self._trial_data(trials[0])
+        return data
 
-    def begin_worker(self, worker_id):
-        """Create an initial trial for a new worker"""
+    def _create_trials(self, worker_id, num_trials):
+        """Give a worker as many trials as it asks for and we can spare"""
 
-        # if we have too many parallel workers already, then
-        # reject this worker and send back an HTTP error
-        if len(self.oracle.ongoing_trials) >= self.max_parallel_workers:
-            return "Too many workers", 400
-        self.failure_counts[worker_id] = 0
+        # include any trials the worker already has, in case
+        # it's retrying a request whose response it never got
+        with self._transaction():
+            trial_ids = self._trial_ids(worker_id)[:num_trials]
+            trials = [self.oracle.ongoing_trials[i] for i in trial_ids]
 
-        # create an initial trial for this worker
-        return self.create_trial(worker_id)
+            available = self.max_parallel_workers
+            available -= len(self.oracle.ongoing_trials)
+            num_trials = min(num_trials - len(trials), available)
+            trials += self._next_trials(worker_id, num_trials)
+            if not trials and self.idle:
+                self._reject()
+        return {"trials": list(map(self._trial_data, trials))}
 
-    def get_trial_id(self, worker_id):
+    def begin_worker(self, worker_id, num_trials=None, wait=0, capacity=None):
+        """Create initial trials for a new worker
+
+        If `num_trials` is left as `None`, the worker is given
+        a single trial. Otherwise it's given a batch of up
+        to `num_trials` trials, space permitting. If there are
+        already too many trials running, the worker waits in
+        line for up to `wait` seconds for one to finish before
+        a `SlotUnavailable` error telling it when to try
+        again gets raised, or straight away if there are
+        already `max_waiting_workers` workers waiting.
+        `capacity` is how much work the worker can do
+        relative to other workers.
+        """
+
+        # check the number of trials and create new ones
+        # under the same lock so that concurrent requests
+        # can't both squeeze into the last open slot. Replicas
+        # can't wait on each other's slots, so check back for
+        # one every so often without holding the lock instead,
+        # taking up one of the `max_waiting_workers` spots while
+        # doing so just like workers waiting in line do
+        polling = (
+            self.store is not None
+            and wait > 0
+            and self.waiting.acquire(blocking=False)
+        )
+        deadline = time.monotonic() + (wait if polling else 0)
         try:
-            trial_id = self.oracle.ongoing_trials[worker_id].trial_id
-        except KeyError:
-            trial_id = ""
-        return make_response({"id": trial_id})
+            while True:
+                with self._transaction():
+                    # workers start over whenever they're turned away
+                    # or their trial gets stopped, so starting doesn't
+                    # wipe the slate clean. Workers that have failed
+                    # too many trials don't get any more
+                    if self._failures(worker_id) >= self.max_fails_per_worker:
+                        if num_trials is not None:
+                            return {"trials": []}
+                        return {"id": "", "hyperparameters": {}}
+
+                    # a worker that already has trials is retrying a
+                    # request whose response it never got, and the
+                    # slot it would be waiting on might be its own,
+                    # so give it back what it already has straight away
+                    if self._trial_ids(worker_id) or self._wait_for_slot(wait):
+                        self.failure_counts.setdefault(worker_id, 0)
+                        if capacity is not None:
+                            self.capacities[worker_id] = capacity
+
+                        # create initial trials for this worker
+                        if num_trials is not None:
+                            return self._create_trials(worker_id, num_trials)
+                        return self.create_trial(worker_id)
+                    elif not polling or time.monotonic() > deadline:
+                        self._reject()
+                time.sleep(_POLL_INTERVAL)
+        finally:
+            if polling:
+                self.waiting.release()
+
+    def get_trial_id(self, worker_id):
+        with self._transaction(write=False):
+            trial_ids = self._trial_ids(worker_id)
+        return {"id": trial_ids[0] if trial_ids else ""}
+
+    def _renew_lease(self, trial_id, log=True):
+        if self.lease_timeout is None:
+            return
+        self.leases[trial_id] = time.monotonic() + self.lease_timeout
+        if log and self.store is not None:
+            self.store.renew(trial_id, self._lease_expiry())
+
+    def heartbeat(self, worker_id):
+        """Renew the leases on a worker's current trials
+
+        Responds with the ids of the worker's trials, which
+        will be missing any trials whose leases already
+        expired and that have been given to someone else.
+        """
+
+        # without leases, there's nothing to write
+        with self._transaction(write=self.lease_timeout is not None):
+            trial_ids = self._trial_ids(worker_id)
+            for trial_id in trial_ids:
+                self._renew_lease(trial_id)
+        return {"id": trial_ids[0] if trial_ids else "", "ids": trial_ids}
+
+    def sweep_leases(self):
+        """Requeue the trials whose leases have expired"""
+
+        with self._transaction():
+            now = time.monotonic()
+            expired = [i for i, t in self.leases.items() if t < now]
+            for trial_id in expired:
+                self.metrics.increment(
+                    "nonvex_trials_total",
+                    outcome="requeued",
+                    worker_id=self.assignments[trial_id],
+                )
+                self.journal.write("requeue", trial_id=trial_id)
+                if self.store is not None:
+                    self.store.requeue(trial_id)
+                self._unassign(trial_id)
+                self.buffer.put(self.oracle.ongoing_trials.pop(trial_id))
+
+    def _sweep_leases(self):
+        while not self._closed.wait(self.lease_timeout / 4):
+            self.sweep_leases()
+
+    def _report(self, trial_id, step, metrics):
+        self.oracle.update_trial(trial_id, metrics, step=step)
+        if self.scheduler is None:
+            return False
+
+        value = metrics.get(self.objective)
+        if value is not None and trial_id not in self.stopped:
+            if self.scheduler.report(trial_id, step, value):
+                self.stopped.add(trial_id)
+        return trial_id in self.stopped
+
+    def report_trial(self, trial_id, step, metrics):
+        """Record intermediate metrics for a trial
+
+        Responds with whether the worker running the
+        trial should stop it early and report its
+        result. Reporting also counts as a heartbeat
+        for the trial's lease.
+        """
+
+        with self._transaction():
+            # if the trial's already done, e.g. because it was
+            # given away and finished by someone else, there's
+            # no point in the worker continuing with it
+            trial = self.oracle.trials[trial_id]
+            if trial.status != kt.engine.trial.TrialStatus.RUNNING:
+                return {"stop": True}
+
+            if trial_id in self.assignments:
+                self._renew_lease(trial_id)
+            self.journal.write(
+                "report", trial_id=trial_id, step=step, metrics=metrics
+            )
+            stop = self._report(trial_id, step, metrics)
+        return {"stop": stop}
+
+    def top_trials(self, k=10):
+        """Get the `k` trials with the best scores so far"""
+        with self._transaction(write=False):
+            return {"trials": self.history.top(k)}
+
+    def summarize_trials(self):
+        """Get summary statistics of the scores of completed trials"""
+        with self._transaction(write=False):
+            return self.history.summary()
+
+    def filter_trials(self, filters, k=10):
+        """Get the `k` best trials with values matching `filters`
+
+        See `TrialHistory.filter` for how filters are specified.
+        """
+        with self._transaction(write=False):
+            return {"trials": self.history.filter(filters, k)}
+
+    def metrics_snapshot(self):
+        """Get the current values of the server's metrics
+
+        Along with the request latencies and trial outcomes
+        recorded as they happen, measures how many trials and
+        workers are in each state, and how long ago each
+        ongoing trial was assigned and had its lease renewed.
+        """
+
+        with self._transaction(write=False):
+            now = time.monotonic()
+            gauges = [
+                ("nonvex_ongoing_trials", {}, len(self.oracle.ongoing_trials)),
+                ("nonvex_buffered_trials", {}, len(self.buffer)),
+                ("nonvex_completed_trials", {}, len(self.history)),
+                ("nonvex_waiting_workers", {}, len(self.admissions)),
+            ]
+            for worker_id, count in self.failure_counts.items():
+                labels = {"worker_id": worker_id}
+                gauges.append(("nonvex_worker_failures", labels, count))
+
+            for trial_id, worker_id in self.assignments.items():
+                labels = {"trial_id": trial_id, "worker_id": worker_id}
+                age = now - self.start_times[trial_id]
+                gauges.append(("nonvex_trial_age_seconds", labels, age))
+                if trial_id in self.leases:
+                    renewed = self.leases[trial_id] - self.lease_timeout
+                    age = now - renewed
+                    gauges.append(("nonvex_lease_age_seconds", labels, age))
+        return self.metrics.snapshot(gauges)
+
+    def _complete_trial(self, trial_id, result):
+        """Record the result of a trial if it hasn't already been"""
+
+        # if a worker's lease expired, its trial may have
+        # been requeued or even finished by someone else.
+        # Take the first result we get for a trial, and
+        # ignore any others
+        trial = self.oracle.trials[trial_id]
+        if trial.status != kt.engine.trial.TrialStatus.RUNNING:
+            return
+
+        # journal how long the trial took so that what
+        # we've learned from it survives being resumed
+        duration = None
+        if trial_id in self.assignments:
+            duration = time.monotonic() - self.start_times[trial_id]
+        self.journal.write(
+            "complete", trial_id=trial_id, result=result, duration=duration
+        )
+        if self.store is not None:
+            self.store.complete(trial_id, result)
+        worker_id = self.assignments.get(trial_id, "")
+        if trial_id in self.assignments:
+            self._unassign(trial_id)
+            self.metrics.observe(
+                "nonvex_trial_duration_seconds", duration, DURATION_BUCKETS
+            )
+            self._record_duration(trial, duration, worker_id)
+        else:
+            self.oracle.ongoing_trials[trial_id] = self.buffer.remove(trial_id)
+
+        self._record_result(trial, result)
+        self.metrics.increment(
+            "nonvex_trials_total", outcome="completed", worker_id=worker_id
+        )
+        if self.cache is not None:
+            self.cache.put(trial.hyperparameters.values, result)
+        self.buffer.refill()
+
+    def _record_duration(self, trial, duration, worker_id):
+        """Learn from how long a worker took to run a trial"""
+
+        if self.mean_duration is None:
+            self.mean_duration = duration
+        else:
+            self.mean_duration += 0.1 * (duration - self.mean_duration)
+        if self.runtimes is not None:
+            capacity = self.capacities.get(worker_id, 1.0)
+            values = trial.hyperparameters.values
+            self.runtimes.add(values, duration * capacity)
+
+    def _failures(self, worker_id):
+        """Get the number of trials a worker has failed"""
+
+        # workers can fail trials on other replicas too,
+        # so go by the count in storage if there is one
+        if self.store is not None:
+            self.failure_counts[worker_id] = self.store.failures(worker_id)
+        return self.failure_counts.get(worker_id, 0)
 
-    def cancel_trial(self, worker_id):
-        trial = self.oracle.ongoing_trials.pop(worker_id)
-        self.oracle.trials.pop(trial.trial_id)
+    def _set_failures(self, worker_id, failures):
+        self.failure_counts[worker_id] = failures
+        if self.store is not None:
+            self.store.set_failures(worker_id, failures)
 
-        self.failure_counts[worker_id] += 1
-        if self.failure_counts[worker_id] >= self.max_fails_per_worker:
-            return {"id": "", "hyperparameters": {}}
-        return self.create_trial(worker_id)
+    def _cancel_trial(self, worker_id, trial_id):
+        # keep the failed trial around as invalid rather than
+        # deleting it, since the oracle assigns new trial ids
+        # based on the number of trials it knows about and
+        # would otherwise reuse the id of a running trial.
+        # Bump the trial budget so that failures still
+        # don't count against the total number of trials.
+        # If the worker's lease already expired, its trial
+        # has been requeued and there's nothing to cancel.
+        # If the trial's already been cancelled, the worker
+        # is retrying a request and has already been counted
+        trial = self.oracle.trials.get(trial_id)
+        invalid = kt.engine.trial.TrialStatus.INVALID
+        if trial is not None and trial.status == invalid:
+            return self._failures(worker_id) < self.max_fails_per_worker
+
+        if self.copies.get(worker_id) == trial_id:
+            # a copy failing leaves the original running
+            self.copies.pop(worker_id)
+        elif self.assignments.get(trial_id) == worker_id:
+            # if another worker is running a copy of the
+            # trial, let them carry on with it for good
+            if not self._promote_copy(trial_id):
+                self.journal.write("cancel", trial_id=trial_id)
+                if self.store is not None:
+                    self.store.fail(trial_id)
+                self._unassign(trial_id)
+                self.oracle.end_trial(
+                    trial_id, kt.engine.trial.TrialStatus.INVALID
+                )
+                self.oracle.max_trials += 1
+                self.buffer.refill()
+
+        self.metrics.increment(
+            "nonvex_trials_total", outcome="failed", worker_id=worker_id
+        )
+        failures = self._failures(worker_id) + 1
+        self._set_failures(worker_id, failures)
+        return failures < self.max_fails_per_worker
+
+    def cancel_trial(self, worker_id, trial_id=None):
+        """Cancel a worker's trial and potentially start a new one
+
+        If `trial_id` is left as `None`, the worker's
+        current trial is cancelled.
+        """
+
+        with self._transaction():
+            if trial_id is None:
+                trial_id = (self._trial_ids(worker_id) or [None])[0]
+            if not self._cancel_trial(worker_id, trial_id):
+                return {"id": "", "hyperparameters": {}}
+            return self.create_trial(worker_id)
 
     def end_trial(self, trial_id, result, worker_id):
         """End an existing trial and potentially start a new one"""
-        self.oracle.update_trial(trial_id, {self.objective: result})
+        with self._transaction():
+            self._complete_trial(trial_id, result)
+            return self.create_trial(worker_id)
 
-        trial = self.oracle.trials[trial_id]
-        trial.status = kt.engine.trial.TrialStatus.COMPLETED
-        self.oracle.end_trial(trial_id)
+    def end_trials(self, worker_id, results, failed, num_trials, wait=0):
+        """End a batch of trials and start a new batch
+
+        Args:
+            worker_id:
+                The worker which ran the trials
+            results:
+                Mapping from the ids of trials that completed
+                successfully to their objective values
+            failed:
+                The ids of trials that failed
+            num_trials:
+                The maximum number of new trials to give
+                back to the worker
+            wait:
+                The number of seconds to wait for slots
+                to open up if the worker's trials have
+                been given to other workers. Replicas sharing
+                storage can't wait on each other's slots, so
+                with shared storage the worker is told to
+                check back straight away
+        """
+
+        with self._transaction():
+            for trial_id, result in results.items():
+                self._complete_trial(trial_id, result)
+
+            keep_going = True
+            for trial_id in failed:
+                keep_going &= self._cancel_trial(worker_id, trial_id)
+            if not keep_going:
+                return {"trials": []}
+
+            # the worker should usually be able to reuse the
+            # slots that its trials just freed up, but if its
+            # trials were reclaimed, it needs to wait in line
+            full = len(self.oracle.ongoing_trials)
+            full = full >= self.max_parallel_workers
+            if full and not self._wait_for_slot(wait):
+                self._reject()
+            return self._create_trials(worker_id, num_trials)
+
+
+# arguments to `Searcher` that get set for each study, rather
+# than being taken from its spec. Specs come in over the network,
+# so they don't get to point the server at arbitrary files either
+_STUDY_FIELDS = (
+    "output_dir",
+    "project_name",
+    "resume",
+    "hyperparameters",
+    "max_waiting_workers",
+    "storage",
+    "replica_id",
+    "warm_start",
+)
+
+
+def _create_study(output_dir, name, spec, resume, waiting):
+    """Create the searcher for a study from its spec"""
+
+    spec = dict(spec)
+    missing = {"objective", "max_trials", "hyperparameters"} - set(spec)
+    if missing:
+        raise ValueError(
+            "Study spec is missing {}".format(", ".join(sorted(missing)))
+        )
+
+    try:
+        hyperparameters = kt.HyperParameters.from_config(
+            spec.pop("hyperparameters")
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid hyperparameter config: {e}")
+
+    # specs take the same arguments as `create_app`,
+    # which turns memoization off rather than on
+    if "no_memoize" in spec:
+        spec["memoize"] = not spec.pop("no_memoize")
+
+    fields = {f.name for f in dataclasses.fields(Searcher)}
+    unknown = set(spec) - fields.difference(_STUDY_FIELDS)
+    if unknown:
+        raise ValueError(
+            "Unknown study options {}".format(", ".join(sorted(unknown)))
+        )
 
-        return self.create_trial(worker_id)
+    searcher = Searcher(
+        output_dir=output_dir,
+        project_name=name,
+        resume=resume,
+        hyperparameters=hyperparameters,
+        **spec,
+    )
+
+    # studies share the server's threads, so
+    # they share one limit on waiting workers too
+    searcher.waiting = waiting
+    return searcher
+
+
+def _add_monitoring(app: Union[Flask, Blueprint], searcher: LocalProxy):
+    """Record how requests go and add the routes that report on it"""
+
+    def start_timer():
+        g.start_time = time.perf_counter()
+
+    def record_request(response):
+        # requests for studies that don't exist
+        # don't have a searcher to record them in
+        if "searcher" not in g:
+            return response
+
+        # label requests by the route they matched rather than
+        # their path so that there's one series per endpoint
+        duration = time.perf_counter() - g.start_time
+        route = "unmatched"
+        if request.url_rule is not None:
+            route = request.url_rule.rule
+
+        searcher.metrics.observe(
+            "nonvex_request_duration_seconds",
+            duration,
+            LATENCY_BUCKETS,
+            route=route,
+        )
+        searcher.metrics.increment(
+            "nonvex_responses_total",
+            route=route,
+            status=response.status_code,
+        )
+        return response
+
+    def metrics():
+        snapshot = searcher.metrics_snapshot()
+        response = make_response(render_prometheus(snapshot))
+        response.headers["Content-Type"] = "text/plain; version=0.0.4"
+        return response
+
+    def metrics_json():
+        return searcher.metrics_snapshot()
+
+    app.route("/metrics")(metrics)
+    app.route("/metrics/json")(metrics_json)
+    app.before_request(start_timer)
+    app.after_request(record_request)
+
+
+def _add_trial_routes(app: Union[Flask, Blueprint], searcher: LocalProxy):
+    """Add the routes workers use to get trials and end them"""
+
+    def reject(error):
+        response = make_response({"retry_after": error.retry_after}, 503)
+        response.headers["Retry-After"] = str(math.ceil(error.retry_after))
+        return response
+
+    def get_hyperparameters():
+        return searcher.get_hyperparameters()
+
+    def get_trial_id(worker_id):
+        return searcher.get_trial_id(worker_id)
+
+    def heartbeat(worker_id):
+        return searcher.heartbeat(worker_id)
+
+    def begin_worker(worker_id):
+        num_trials = request.args.get("num_trials", type=int)
+        wait = request.args.get("wait", 0, type=float)
+        capacity = request.args.get("capacity", type=float)
+        return searcher.begin_worker(worker_id, num_trials, wait, capacity)
+
+    def end_trial(trial_id):
+        # results can either come as query parameters or,
+        # if they're too big for those, in the request body
+        if request.method == "POST":
+            body = request.get_json()
+            result, worker_id = body["result"], body["worker_id"]
+        else:
+            result, worker_id = request.args, request.args.get("worker_id")
+        result = float(result[searcher.objective])
+        return searcher.end_trial(trial_id, result, worker_id)
+
+    def cancel_trial(worker_id):
+        trial_id = request.args.get("trial_id")
+        return searcher.cancel_trial(worker_id, trial_id)
+
+    def report_trial(trial_id):
+        body = request.get_json()
+        metrics = {k: float(v) for k, v in body["metrics"].items()}
+        return searcher.report_trial(trial_id, body["step"], metrics)
+
+    def end_trials(worker_id):
+        body = request.get_json()
+        results = {
+            trial_id: float(result[searcher.objective])
+            for trial_id, result in body["results"].items()
+        }
+        return searcher.end_trials(
+            worker_id,
+            results,
+            body["failed"],
+            body["num_trials"],
+            body.get("wait", 0),
+        )
+
+    app.route("/hyperparameters")(get_hyperparameters)
+    app.route("/start/<worker_id>")(begin_worker)
+    app.route("/ongoing/<worker_id>")(get_trial_id)
+    app.route("/end/<trial_id>", methods=["GET", "POST"])(end_trial)
+    app.route("/batch/<worker_id>", methods=["POST"])(end_trials)
+    app.route("/report/<trial_id>", methods=["POST"])(report_trial)
+    app.route("/cancel/<worker_id>")(cancel_trial)
+    app.route("/heartbeat/<worker_id>")(heartbeat)
+    app.register_error_handler(SlotUnavailable, reject)
+
+
+def _add_query_routes(app: Union[Flask, Blueprint], searcher: LocalProxy):
+    """Add the routes for looking up the results of trials"""
+
+    def summarize_trials():
+        return searcher.summarize_trials()
+
+    def top_trials():
+        k = request.args.get("k", 10, type=int)
+        return searcher.top_trials(k)
+
+    def filter_trials():
+        # any query parameters other than `k`
+        # are filters on hyperparameter values
+        filters = request.args.to_dict()
+        try:
+            k = int(filters.pop("k", 10))
+            return searcher.filter_trials(filters, k)
+        except ValueError as e:
+            return make_response({"error": str(e)}, 400)
+
+    app.route("/trials")(filter_trials)
+    app.route("/trials/top")(top_trials)
+    app.route("/trials/summary")(summarize_trials)
+
+
+def _add_routes(app: Union[Flask, Blueprint]):
+    """Add the routes workers use to run a search to an app
+
+    Views handle requests with the `Searcher` that's
+    been put in `g.searcher` before the request.
+    """
+
+    searcher = LocalProxy(lambda: g.searcher)
+    _add_trial_routes(app, searcher)
+    _add_query_routes(app, searcher)
+    _add_monitoring(app, searcher)
 
 
 def create_app(
@@ -108,6 +1401,21 @@ def create_app(
     project_name: str,
     max_parallel_workers: int,
     max_fails_per_worker: int = 5,
+    trial_buffer_size: int = 4,
+    lease_timeout: Optional[float] = None,
+    resume: bool = False,
+    flush_interval: float = 1.0,
+    grace_period: Optional[int] = None,
+    reduction_factor: int = 3,
+    oracle_type: str = "random",
+    oracle_options: Optional[Dict[str, float]] = None,
+    no_memoize: bool = False,
+    warm_start: Optional[str] = None,
+    storage: Optional[str] = None,
+    replica_id: Optional[str] = None,
+    cost_aware: bool = False,
+    speculate: bool = False,
+    max_waiting_workers: int = 8,
 ):
     """Start a Nonvex hyperparameter server
 
@@ -127,8 +1435,109 @@ def create_app(
         project_name:
             The name to assign to this hyperparameter search
         max_parallel_workers:
-            The maximum number of workers that can
-            run trials simultaneously
+            The maximum number of trials that can be
+            run simultaneously across all workers
+        max_fails_per_worker:
+            The number of trials a worker can fail
+            before the server stops assigning it trials
+        trial_buffer_size:
+            The number of trials to create ahead of time
+            in the background so that workers don't have
+            to wait on the oracle for new trials
+        lease_timeout:
+            The number of seconds a worker can go without
+            a heartbeat before its trial is reclaimed and
+            handed to another worker. If left as `None`,
+            trials are never reclaimed
+        resume:
+            Whether to pick up an existing search in the same
+            project directory where it left off by replaying
+            its journal, rather than starting a new one
+        flush_interval:
+            The maximum number of seconds to wait between
+            writing batches of trial state to the project
+            directory. If `0`, trial state is written as
+            soon as it changes
+        grace_period:
+            The number of steps of intermediate metrics a
+            trial has to report before it can be stopped early
+            by asynchronous successive halving. If left as
+            `None`, trials are never stopped early
+        reduction_factor:
+            The factor by which successive halving cuts down
+            the number of trials at each rung, and by which
+            the number of steps between rungs grows
+        oracle_type:
+            The algorithm used to pick hyperparameters for new
+            trials. One of `"random"`, `"bayesian"` or
+            `"hyperband"`. Hyperband trials are passed the
+            arguments `epochs` and `initial_epoch` to train
+            for, and `resume_trial_id`, the id of the trial
+            to pick training back up from, if any
+        oracle_options:
+            Any options to pass to the oracle, e.g.
+            `num_candidates` to sample at once for random
+            search, `num_initial_points` for Bayesian
+            optimization, or `max_epochs` and `factor`
+            for Hyperband
+        no_memoize:
+            Whether to train every trial, rather than caching
+            the results of configs that have been evaluated
+            with the project and completing any later trials
+            with the same config straight from the cache.
+            Trials completed from the cache don't count
+            against `max_trials`
+        warm_start:
+            The project directory of an earlier search whose
+            results to add to the cache, so that configs it
+            already evaluated get skipped. Can't be used
+            with `no_memoize`
+        storage:
+            Path to a SQLite database in which to keep the
+            trials of the search, so that several replicas of
+            the server on the same host or shared volume can
+            hand them out at once. Replicas join whatever
+            search is already in the database, and keep their
+            own files in a directory under the project directory.
+            Doesn't support Hyperband, early stopping or
+            `cost_aware`. If left as `None`, the search only
+            lives in this server
+        replica_id:
+            A unique ID for this replica of the server when
+            using `storage`. If left as `None`, a random hex
+            value will be assigned
+        cost_aware:
+            Whether to learn how long trials take from their
+            hyperparameter values, and hand out the trials
+            expected to take longest first, to the workers
+            with the most capacity. Trials are picked from
+            the `trial_buffer_size` created ahead of time,
+            so bigger buffers give more to pick from. Workers
+            can advertise their capacity, e.g. their number
+            of GPUs, when they start, and otherwise count as 1.
+            Can't be used with `storage`
+        speculate:
+            Whether to give idle workers copies of the longest
+            running trials once there are no trials left to
+            hand out, so that a slow or stuck trial doesn't
+            hold up the end of the search. The first result
+            for a trial wins, and workers running other copies
+            are told to stop by their next heartbeat, which
+            kills trials running in isolated processes, or
+            the next time they report metrics. Without a
+            `lease_timeout` workers don't send heartbeats,
+            so only trials that report metrics get stopped.
+            If a worker fails a trial, a worker running a copy
+            of it carries on with it. Copies only go to workers
+            which ask for one trial at a time, and don't count
+            against `max_parallel_workers`
+        max_waiting_workers:
+            The maximum number of workers that can wait in
+            line for a slot at once. Each waiting worker ties
+            up one of the server's threads, so this should be
+            well below `num_threads` to leave threads free for
+            ending trials. Workers past this are told when to
+            check back straight away
     """
 
     app = Flask(__name__)
@@ -139,17 +1548,107 @@ def create_app(
         project_name=project_name,
         max_parallel_workers=max_parallel_workers,
         max_fails_per_worker=max_fails_per_worker,
+        trial_buffer_size=trial_buffer_size,
+        lease_timeout=lease_timeout,
+        resume=resume,
+        flush_interval=flush_interval,
+        grace_period=grace_period,
+        reduction_factor=reduction_factor,
+        oracle_type=oracle_type,
+        oracle_options=oracle_options,
+        memoize=not no_memoize,
+        warm_start=warm_start,
+        storage=storage,
+        replica_id=replica_id,
+        cost_aware=cost_aware,
+        speculate=speculate,
+        max_waiting_workers=max_waiting_workers,
     )
+    app.extensions["nonvex"] = searcher
 
-    def end_trial(trial_id):
-        result = float(request.args.get(searcher.objective))
-        worker_id = request.args.get("worker_id")
-        return searcher.end_trial(trial_id, result, worker_id)
+    def use_searcher():
+        g.searcher = searcher
+
+    app.before_request(use_searcher)
+    _add_routes(app)
+    return app
+
+
+def create_study_app(
+    output_dir: str, idle_timeout: float = 600, max_waiting_workers: int = 8
+):
+    """Start a Nonvex server which hosts many searches at once
+
+    Rather than running a single search, the server hosts
+    any number of named studies, each with its own objective
+    and search space. Studies are created by `PUT`ing a JSON
+    spec to `/studies/<name>`, with the search space given
+    under `hyperparameters` as the config of a keras-tuner
+    `HyperParameters` object, along with any arguments to
+    `create_app` other than `output_dir`, `project_name`,
+    `resume` and `max_waiting_workers`, or the ones which
+    pick files for the server to use, `storage`, `replica_id`
+    and `warm_start`, which it isn't safe to let clients do.
+    Workers run trials for a study through the same routes
+    as for a single search, prefixed with `/studies/<name>`.
+
+    Args:
+        output_dir:
+            The output directory in which to create
+            a project directory for each study
+        idle_timeout:
+            The number of seconds a study can go without
+            any requests or running trials before it's moved
+            out of memory. Studies get picked back up from
+            disk the next time they're used. Hyperband studies
+            can't be picked back up where they left off, so
+            they're always kept in memory. If `0`, all studies
+            are kept in memory for good
+        max_waiting_workers:
+            The maximum number of workers that can wait in
+            line for a slot at once, across all studies. This
+            should be well below `num_threads` to leave threads
+            free for ending trials
+    """
+
+    app = Flask(__name__)
+    waiting = BoundedSemaphore(max_waiting_workers)
+
+    def create(name, spec, resume):
+        return _create_study(output_dir, name, spec, resume, waiting)
+
+    manager = StudyManager(output_dir, create, idle_timeout)
+    app.extensions["nonvex"] = manager
+
+    def create_study(study):
+        try:
+            created = manager.create(study, request.get_json())
+        except (ValueError, ImportError) as e:
+            return make_response({"error": str(e)}, 400)
+        except StudyExists as e:
+            return make_response({"error": str(e)}, 409)
+        return make_response({"study": study}, 201 if created else 200)
+
+    def pop_study(endpoint, values):
+        g.study = values.pop("study")
+
+    def acquire_study():
+        try:
+            g.searcher = manager.acquire(g.study)
+        except KeyError:
+            return make_response({"error": f"No study '{g.study}'"}, 404)
+
+    def release_study(error):
+        if "searcher" in g:
+            manager.release(g.study)
 
-    app.route("/hyperparameters")(searcher.get_hyperparameters)
-    app.route("/start/<worker_id>")(searcher.begin_worker)
-    app.route("/ongoing/<worker_id>")(searcher.get_trial_id)
-    app.route("/end/<trial_id>")(end_trial)
-    app.route("/cancel/<worker_id>")(searcher.cancel_trial)
+    studies = Blueprint("studies", __name__, url_prefix="/studies/<study>")
+    studies.url_value_preprocessor(pop_study)
+    studies.before_request(acquire_study)
+    studies.teardown_request(release_study)
+    _add_routes(studies)
 
+    app.route("/studies")(manager.names)
+    app.route("/studies/<study>", methods=["PUT"])(create_study)
+    app.register_blueprint(studies)
     return app
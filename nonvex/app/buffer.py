@@ -0,0 +1,122 @@
+from collections import deque
+from threading import Condition, Thread
+from typing import Callable, Iterable, List, Optional
+
+import keras_tuner as kt
+
+
+class TrialBuffer:
+    """Bounded buffer of trials created ahead of time
+
+    Keeps up to `size` trials created by `create` in
+    reserve using a background thread, so that handing
+    a trial to a worker doesn't require waiting for the
+    oracle to sample values and write them to disk.
+    Buffered trials are registered with the oracle, and
+    so count against its `max_trials`, but aren't
+    considered ongoing until they're handed out.
+
+    Args:
+        create:
+            Function which creates a new trial, or
+            returns `None` if the oracle is out of trials
+        size:
+            The maximum number of trials to create
+            ahead of time
+        trials:
+            Any already existing trials to start the
+            buffer off with
+    """
+
+    def __init__(
+        self,
+        create: Callable[[], Optional[kt.engine.trial.Trial]],
+        size: int = 4,
+        trials: Iterable[kt.engine.trial.Trial] = (),
+    ):
+        self._create = create
+        self.size = size
+
+        self._trials = deque(trials)
+        self._cond = Condition()
+        self._exhausted = False
+        self._stopped = False
+
+        self._thread = Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._trials)
+
+    def _fill(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (
+                    self._exhausted or len(self._trials) >= self.size
+                ):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+            trial = self._create()
+            with self._cond:
+                # if the oracle doesn't have any more trials to
+                # give, stop trying until we're told to refill
+                if trial is None:
+                    self._exhausted = True
+                else:
+                    self._trials.append(trial)
+
+    def get(
+        self,
+        choose: Optional[Callable[[List[kt.engine.trial.Trial]], int]] = None,
+    ):
+        """Get the next trial, or `None` if the search is done
+
+        If `choose` is given, it's passed the buffered trials,
+        oldest first, and returns the index of the one to
+        take, rather than the oldest one getting taken.
+        """
+
+        with self._cond:
+            if self._trials:
+                idx = 0 if choose is None else choose(list(self._trials))
+                trial = self._trials[idx]
+                del self._trials[idx]
+                self._cond.notify()
+                return trial
+
+        # if the background thread hasn't been able to keep
+        # up, or thinks the oracle is out of trials, ask the
+        # oracle directly rather than making the worker wait
+        return self._create()
+
+    def put(self, trial):
+        """Return a trial to the front of the buffer"""
+
+        with self._cond:
+            self._trials.appendleft(trial)
+
+    def remove(self, trial_id):
+        """Remove the trial with the given id from the buffer"""
+
+        with self._cond:
+            for trial in self._trials:
+                if trial.trial_id == trial_id:
+                    self._trials.remove(trial)
+                    self._cond.notify()
+                    return trial
+
+    def refill(self):
+        """Resume filling the buffer after the oracle was exhausted"""
+
+        with self._cond:
+            self._exhausted = False
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+from nonvex.app.journal import Journal
+
+
+def config_hash(values: Dict) -> str:
+    """Hash a set of hyperparameter values by their content"""
+
+    content = json.dumps(values, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class ResultCache:
+    """Content-addressed store of the results of evaluated configs
+
+    Maps the hash of each config that's been evaluated to the
+    objective value it got, so that trials which land on the
+    same config again don't need to be run. New results are
+    appended to a file at `path` as they come in, so that the
+    cache persists with the project.
+
+    Args:
+        path:
+            The file to record results in
+        objective:
+            The name of the objective being cached. Results
+            loaded for any other objective are ignored
+        overwrite:
+            Whether to start a fresh cache at `path` rather
+            than loading results from an existing one
+    """
+
+    def __init__(self, path: str, objective: str, overwrite: bool = False):
+        self.objective = objective
+        self._results = {}
+        if not overwrite and os.path.exists(path):
+            self.load(path)
+        self._journal = Journal(path, overwrite=overwrite)
+
+    def __len__(self):
+        return len(self._results)
+
+    def load(self, path: str):
+        """Load results recorded in another cache file"""
+
+        for event in Journal.read(path):
+            if event["objective"] == self.objective:
+                self._results[event["hash"]] = event["result"]
+
+    def load_journal(self, path: str):
+        """Load the results of trials completed in a search journal"""
+
+        values = {}
+        for event in Journal.read(path):
+            if event["event"] == "create":
+                values[event["trial_id"]] = event["hyperparameters"]
+            elif event["event"] == "complete" and not event.get("cached"):
+                key = config_hash(values[event["trial_id"]])
+                self._results[key] = event["result"]
+
+    def warm_start(self, project_dir: str):
+        """Load the results of a search run in another project
+
+        Uses the project's cache if it has one, otherwise
+        the results of the trials recorded in its journal.
+        Assumes the other search used the same objective.
+        """
+
+        path = os.path.join(project_dir, "results.jsonl")
+        if os.path.exists(path):
+            self.load(path)
+            return
+
+        path = os.path.join(project_dir, "journal.jsonl")
+        if not os.path.exists(path):
+            raise ValueError(
+                "No results to warm start from in project "
+                "directory {}".format(project_dir)
+            )
+        self.load_journal(path)
+
+    def get(self, values: Dict) -> Optional[float]:
+        return self._results.get(config_hash(values))
+
+    def put(self, values: Dict, result: float):
+        key = config_hash(values)
+        if self._results.get(key) == result:
+            return
+
+        self._results[key] = result
+        self._journal.write(
+            "result",
+            hash=key,
+            objective=self.objective,
+            hyperparameters=values,
+            result=result,
+        )
+
+    def close(self):
+        self._journal.close()
@@ -0,0 +1,138 @@
+import math
+from typing import Dict, Optional
+
+import keras_tuner as kt
+import numpy as np
+
+hp_module = kt.engine.hyperparameters
+
+
+class _Feature:
+    """Encodes the values of a hyperparameter as regression features
+
+    Hyperparameters which take on a handful of values get one
+    indicator feature per value, so that runtimes don't have
+    to change smoothly from one value to the next. Ranges get
+    a single feature scaled to [0, 1], on a log scale if
+    they're sampled on one. Missing values, e.g. from inactive
+    conditional hyperparameters, leave every feature at 0.
+    """
+
+    def __init__(self, hp):
+        self.name = hp.name
+        if isinstance(hp, hp_module.Boolean):
+            values = [True, False]
+        elif isinstance(hp, hp_module.Choice):
+            values = hp.values
+        elif isinstance(hp, hp_module.Fixed):
+            values = [hp.value]
+        else:
+            values = None
+
+        self.vocab = None
+        if values is not None:
+            self.vocab = {value: i for i, value in enumerate(values)}
+            self.size = len(values)
+            return
+
+        self.size = 1
+        self.log = hp.sampling == "log"
+        low, high = hp.min_value, hp.max_value
+        if self.log:
+            low, high = math.log(low), math.log(high)
+        self.low, self.span = low, (high - low) or 1
+
+    def encode(self, value, out: np.ndarray):
+        if value is None:
+            return
+        elif self.vocab is not None:
+            idx = self.vocab.get(value)
+            if idx is not None:
+                out[idx] = 1
+            return
+
+        if self.log:
+            value = math.log(value)
+        out[0] = (value - self.low) / self.span
+
+
+class RuntimeModel:
+    """Learns how long trials take from the configs they ran with
+
+    Fits a ridge regression of the log of the time each trial
+    took on its hyperparameter values, so that the time a new
+    trial will take can be estimated before it's handed out.
+    Working with logs means that hyperparameters scale runtimes
+    by some factor, e.g. halving the batch size doubling the
+    time an epoch takes, rather than adding a fixed amount.
+    Only the sums the regression needs are kept, so adding
+    trials and making estimates is cheap no matter how many
+    trials have been run.
+
+    Args:
+        hyperparameters:
+            The search space that trials are drawn from
+        min_trials:
+            The number of trials to learn from
+            before making any estimates
+        alpha:
+            The strength of the ridge penalty, which keeps
+            estimates from swinging wildly while there
+            are only a few trials to go on
+    """
+
+    def __init__(
+        self,
+        hyperparameters: kt.HyperParameters,
+        min_trials: int = 3,
+        alpha: float = 1.0,
+    ):
+        self.features = [_Feature(hp) for hp in hyperparameters.space]
+        self.min_trials = min_trials
+        self.alpha = alpha
+
+        # the first feature is a constant for the intercept
+        size = 1 + sum([feature.size for feature in self.features])
+        self._gram = np.zeros((size, size))
+        self._moment = np.zeros((size,))
+        self._count = 0
+        self._weights = None
+
+    def __len__(self):
+        return self._count
+
+    def _encode(self, values: Dict) -> np.ndarray:
+        x = np.zeros_like(self._moment)
+        x[0] = 1
+        start = 1
+        for feature in self.features:
+            stop = start + feature.size
+            feature.encode(values.get(feature.name), x[start:stop])
+            start = stop
+        return x
+
+    def add(self, values: Dict, duration: float):
+        """Record the time a trial with the given values took"""
+
+        x = self._encode(values)
+        self._gram += np.outer(x, x)
+        self._moment += x * math.log(max(duration, 1e-6))
+        self._count += 1
+        self._weights = None
+
+    def predict(self, values: Dict) -> Optional[float]:
+        """Estimate the time a trial with the given values will take
+
+        Returns `None` if there haven't been
+        enough trials to learn from yet.
+        """
+
+        if self._count < self.min_trials:
+            return None
+
+        # only refit once new trials have come in
+        if self._weights is None:
+            penalty = self.alpha * np.eye(len(self._moment))
+            penalty[0, 0] = 0
+            self._weights = np.linalg.solve(self._gram + penalty, self._moment)
+        return math.exp(self._encode(values) @ self._weights)
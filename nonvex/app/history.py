@@ -0,0 +1,219 @@
+import math
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+import keras_tuner as kt
+import numpy as np
+
+hp_module = kt.engine.hyperparameters
+
+# comparison operators that filters can use, given
+# as suffixes on the name of the column to filter
+_OPERATORS = {
+    "eq": np.equal,
+    "ne": np.not_equal,
+    "lt": np.less,
+    "le": np.less_equal,
+    "gt": np.greater,
+    "ge": np.greater_equal,
+}
+
+
+class _Column:
+    """Encodes the values of a hyperparameter as floats
+
+    String values get stored as their index among the
+    values the hyperparameter can take on, and missing
+    values, e.g. from inactive conditional hyperparameters,
+    get stored as NaN.
+    """
+
+    def __init__(self, hp):
+        self.name = hp.name
+        if isinstance(hp, hp_module.Choice):
+            values = hp.values
+        elif isinstance(hp, hp_module.Fixed):
+            values = [hp.value]
+        else:
+            values = None
+
+        self.vocab = None
+        if isinstance(hp, hp_module.Boolean):
+            self.type = bool
+        elif isinstance(hp, hp_module.Int):
+            self.type = int
+        elif values is None:
+            self.type = float
+        else:
+            self.type = type(values[0])
+            if self.type is str:
+                self.vocab = {value: i for i, value in enumerate(values)}
+                self.values = values
+
+    def encode(self, value):
+        if value is None:
+            return math.nan
+        elif self.vocab is not None:
+            return self.vocab.get(value, -1)
+        return float(value)
+
+    def parse(self, text: str):
+        """Encode a value given as a query string"""
+
+        if self.type is bool:
+            return float(text.lower() in ("true", "1"))
+        elif self.vocab is not None:
+            return self.encode(text)
+        return float(text)
+
+    def decode(self, x):
+        if math.isnan(x):
+            return None
+        elif self.vocab is not None:
+            return self.values[int(x)]
+        return self.type(x)
+
+
+class TrialHistory:
+    """Compact store of completed trials for fast queries
+
+    Keeps the hyperparameter values and scores of completed
+    trials in NumPy arrays, one column per hyperparameter,
+    rather than as full keras-tuner `Trial` objects, along
+    with an index of trials sorted from best to worst score.
+    This makes looking up the best trials or summarizing
+    results cheap no matter how many trials there are, and
+    lets trials be filtered by their values in one pass.
+
+    Args:
+        hyperparameters:
+            The search space that trials are drawn from
+        direction:
+            Whether a better score is lower, `"min"`,
+            or higher, `"max"`
+        capacity:
+            The number of trials to allocate space for up
+            front. The arrays get doubled in size whenever
+            they fill up.
+    """
+
+    def __init__(
+        self,
+        hyperparameters: kt.HyperParameters,
+        direction: str,
+        capacity: int = 1024,
+    ):
+        self.columns = [_Column(hp) for hp in hyperparameters.space]
+        self._column_idx = {c.name: i for i, c in enumerate(self.columns)}
+        self.sign = 1 if direction == "min" else -1
+
+        # store values column by column so that
+        # filtering on a column reads contiguous memory
+        self.trial_ids = []
+        self._values = np.empty((len(self.columns), capacity))
+        self._scores = np.empty((capacity,))
+
+        # sorted signed scores and the rows they belong to,
+        # plus running sums for computing summary stats
+        self._keys = []
+        self._order = []
+        self._sum = 0.0
+        self._sum_sq = 0.0
+
+    def __len__(self):
+        return len(self.trial_ids)
+
+    def add(self, trial_id: str, values: Dict, score: float):
+        """Record the values and score of a completed trial"""
+
+        row = len(self.trial_ids)
+        if row == len(self._scores):
+            self._values = np.concatenate([self._values, self._values], axis=1)
+            self._scores = np.concatenate([self._scores, self._scores])
+
+        self.trial_ids.append(trial_id)
+        for i, column in enumerate(self.columns):
+            self._values[i, row] = column.encode(values.get(column.name))
+        self._scores[row] = score
+
+        key = self.sign * score
+        idx = bisect_right(self._keys, key)
+        self._keys.insert(idx, key)
+        self._order.insert(idx, row)
+        self._sum += score
+        self._sum_sq += score**2
+
+    def _trial(self, row):
+        values = {}
+        for column, x in zip(self.columns, self._values[:, row]):
+            value = column.decode(x)
+            if value is not None:
+                values[column.name] = value
+        return {
+            "id": self.trial_ids[row],
+            "hyperparameters": values,
+            "score": float(self._scores[row]),
+        }
+
+    def top(self, k: int = 10) -> List[Dict]:
+        """Get the `k` best trials, best first"""
+        return [self._trial(row) for row in self._order[:k]]
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        """Get summary statistics of the scores of all trials"""
+
+        n = len(self)
+        if n == 0:
+            return {"count": 0}
+
+        mean = self._sum / n
+        variance = max(self._sum_sq / n - mean**2, 0)
+        scores = [self._scores[self._order[i]] for i in [0, n // 2, -1]]
+        best, median, worst = map(float, scores)
+        return {
+            "count": n,
+            "best": best,
+            "worst": worst,
+            "median": median,
+            "mean": mean,
+            "std": variance**0.5,
+        }
+
+    def _parse_filter(self, name: str, text: str) -> Tuple[int, str, float]:
+        name, _, op = name.partition("__")
+        op = op or "eq"
+        if op not in _OPERATORS:
+            raise ValueError(f"Unknown filter operator '{op}'")
+        try:
+            idx = self._column_idx[name]
+        except KeyError:
+            raise ValueError(f"Unknown hyperparameter '{name}'")
+        return idx, op, self.columns[idx].parse(text)
+
+    def filter(self, filters: Dict[str, str], k: int = 10) -> List[Dict]:
+        """Get the `k` best trials whose values match `filters`
+
+        Args:
+            filters:
+                Mapping from hyperparameter names to values
+                the trials should have. Names can end in a
+                suffix `__ne`, `__lt`, `__le`, `__gt` or
+                `__ge` to filter by values which aren't equal
+                to, or less or greater than, the given value
+            k:
+                The maximum number of trials to return
+        """
+
+        n = len(self)
+        mask = np.ones((n,), dtype=bool)
+        for name, text in filters.items():
+            idx, op, value = self._parse_filter(name, text)
+            mask &= _OPERATORS[op](self._values[idx, :n], value)
+
+        rows = np.flatnonzero(mask)
+        keys = self.sign * self._scores[rows]
+        if len(rows) > k:
+            partition = np.argpartition(keys, k)[:k]
+            rows, keys = rows[partition], keys[partition]
+        rows = rows[np.argsort(keys, kind="stable")]
+        return [self._trial(row) for row in rows]
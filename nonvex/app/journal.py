@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+from threading import Event, Lock, Thread
+
+
+class Journal:
+    """Append-only log of trial events for recovering a search
+
+    Each event is written as a line of JSON and flushed to
+    the operating system immediately, so that nothing is lost
+    if the server process dies. Syncing to disk is more
+    expensive, so it's done in batches by a background thread
+    every `sync_interval` seconds, or as soon as `sync_every`
+    events have piled up, whichever comes first. Writes never
+    wait on the disk, so callers can write while holding
+    locks of their own without holding everyone else up.
+
+    Args:
+        path:
+            The file to write events to
+        overwrite:
+            Whether to start a fresh journal at `path`
+            rather than appending to an existing one
+        sync_interval:
+            The maximum number of seconds between syncs
+        sync_every:
+            The maximum number of events between syncs
+    """
+
+    def __init__(
+        self,
+        path: str,
+        overwrite: bool = False,
+        sync_interval: float = 0.5,
+        sync_every: int = 256,
+    ):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_every = sync_every
+
+        self._file = open(path, "w" if overwrite else "a")
+        self._lock = Lock()
+        self._pending = 0
+
+        self._wake = Event()
+        self._stopped = Event()
+        self._thread = Thread(target=self._sync_loop, daemon=True)
+        self._thread.start()
+
+    def write(self, event: str, **data):
+        record = json.dumps({"event": event, **data})
+        with self._lock:
+            self._file.write(record + "\n")
+            self._file.flush()
+            self._pending += 1
+            if self._pending >= self.sync_every:
+                self._wake.set()
+
+    def _sync(self):
+        # sync without holding the lock so that writes can
+        # carry on in the meantime. Everything that was
+        # flushed before the sync started gets synced
+        with self._lock:
+            pending, self._pending = self._pending, 0
+        if pending > 0:
+            os.fsync(self._file.fileno())
+
+    def _sync_loop(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+            self._sync()
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+        self._sync()
+        with self._lock:
+            self._file.close()
+
+    @staticmethod
+    def read(path: str):
+        """Iterate through the events recorded in a journal"""
+
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+
+        for i, line in enumerate(lines):
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # the last event may have only been partially
+                # written if the server died in the middle of
+                # writing it, in which case it never happened
+                if i < len(lines) - 1:
+                    raise
+                logging.warning(
+                    "Ignoring partially written event at end "
+                    "of journal {}".format(path)
+                )
@@ -0,0 +1,204 @@
+import math
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+from typing import Dict, Iterable, List, Tuple
+
+# bucket upper bounds, in seconds, for request latencies, which
+# range from well under a millisecond for most endpoints up to
+# the poll timeout for workers waiting in line for a slot
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+# and for how long trials take to run
+DURATION_BUCKETS = (1, 10, 30, 60, 300, 600, 1800, 3600, 7200, 21600, 86400)
+
+DESCRIPTIONS = {
+    "nonvex_request_duration_seconds": (
+        "histogram",
+        "Time taken to respond to requests, by route",
+    ),
+    "nonvex_responses_total": (
+        "counter",
+        "Number of responses sent, by route and status code",
+    ),
+    "nonvex_trial_duration_seconds": (
+        "histogram",
+        "Time between trials being assigned and completed",
+    ),
+    "nonvex_trials_total": (
+        "counter",
+        "Number of trials that ended, by worker and outcome",
+    ),
+    "nonvex_speculative_copies_total": (
+        "counter",
+        "Number of copies of running trials handed to idle workers",
+    ),
+    "nonvex_rejections_total": (
+        "counter",
+        "Number of times workers were told to come back later",
+    ),
+    "nonvex_ongoing_trials": ("gauge", "Number of trials being run"),
+    "nonvex_buffered_trials": (
+        "gauge",
+        "Number of trials created ahead of time and waiting for a worker",
+    ),
+    "nonvex_completed_trials": ("gauge", "Number of completed trials"),
+    "nonvex_waiting_workers": (
+        "gauge",
+        "Number of workers waiting in line for a slot",
+    ),
+    "nonvex_worker_failures": (
+        "gauge",
+        "Number of trials a worker has failed since it last started",
+    ),
+    "nonvex_trial_age_seconds": (
+        "gauge",
+        "Time since an ongoing trial was assigned",
+    ),
+    "nonvex_lease_age_seconds": (
+        "gauge",
+        "Time since the lease on an ongoing trial was last renewed",
+    ),
+}
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> _Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram:
+    """Counts of observed values that fall into fixed buckets"""
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        # Prometheus buckets count everything
+        # at or below their upper bound
+        buckets, total = {}, 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            buckets["+Inf" if bound == math.inf else str(bound)] = total
+        return {"buckets": buckets, "sum": self.sum, "count": total}
+
+
+class Metrics:
+    """Low-overhead counters and histograms for a server
+
+    Recording a value only takes a lock and a couple of
+    additions, so it's cheap enough to do on every request.
+    Values are labelled, e.g. by route or worker, and
+    snapshots of everything recorded can be rendered as
+    JSON or in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = Counter()
+        self._histograms = {}
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        with self._lock:
+            self._counters[name, _labels(labels)] += amount
+
+    def observe(
+        self, name: str, value: float, buckets: Iterable[float], **labels
+    ):
+        key = (name, _labels(labels))
+        with self._lock:
+            try:
+                histogram = self._histograms[key]
+            except KeyError:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def snapshot(
+        self, gauges: Iterable[Tuple[str, Dict[str, str], float]] = ()
+    ) -> Dict[str, List[Dict]]:
+        """Get the current values of all metrics
+
+        Args:
+            gauges:
+                Metrics whose values are measured at the
+                time of the snapshot, given as tuples of
+                their name, labels and value
+        Returns:
+            Mapping from metric names to lists of samples,
+            each with the labels and value of the sample,
+            or for histograms, bucket counts, sum and count
+        """
+
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                sample = {"labels": dict(labels), "value": value}
+                samples.setdefault(name, []).append(sample)
+            for (name, labels), histogram in self._histograms.items():
+                sample = {"labels": dict(labels), **histogram.snapshot()}
+                samples.setdefault(name, []).append(sample)
+
+        for name, labels, value in gauges:
+            sample = {"labels": dict(labels), "value": value}
+            samples.setdefault(name, []).append(sample)
+        return samples
+
+
+def _escape(value: str) -> str:
+    value = value.replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    labels = ",".join([f'{k}="{_escape(v)}"' for k, v in labels.items()])
+    return "{" + labels + "}"
+
+
+def render_prometheus(snapshot: Dict[str, List[Dict]]) -> str:
+    """Render a metrics snapshot in the Prometheus text format"""
+
+    lines = []
+    for name, samples in snapshot.items():
+        type_, help_ = DESCRIPTIONS.get(name, ("untyped", ""))
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} {type_}")
+        for sample in samples:
+            labels = sample["labels"]
+            if "buckets" not in sample:
+                label_str = _format_labels(labels)
+                lines.append(f"{name}{label_str} {sample['value']}")
+                continue
+
+            for bound, count in sample["buckets"].items():
+                label_str = _format_labels({**labels, "le": bound})
+                lines.append(f"{name}_bucket{label_str} {count}")
+            label_str = _format_labels(labels)
+            lines.append(f"{name}_sum{label_str} {sample['sum']}")
+            lines.append(f"{name}_count{label_str} {sample['count']}")
+    return "\n".join(lines) + "\n"
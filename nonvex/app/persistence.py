@@ -0,0 +1,125 @@
+import atexit
+import json
+import os
+from threading import Condition, Lock, Thread
+
+import keras_tuner as kt
+import tensorflow as tf
+
+
+class OracleWriter:
+    """Write oracle state to disk in batches in the background
+
+    keras-tuner oracles write a trial's state to disk every
+    time it changes, and their own state every time a trial
+    is created or ended. This replaces those writes with
+    marking the trial or oracle as dirty, and has a background
+    thread write everything that's dirty every `flush_interval`
+    seconds, or as soon as `max_pending` trials are dirty.
+    Anything still dirty is written when the process exits.
+
+    Args:
+        oracle:
+            The oracle whose writes to take over
+        lock:
+            The lock guarding access to `oracle`
+        flush_interval:
+            The maximum number of seconds between writes
+        max_pending:
+            The maximum number of dirty trials to
+            keep around before writing them
+    """
+
+    def __init__(
+        self,
+        oracle: kt.Oracle,
+        lock,
+        flush_interval: float = 1.0,
+        max_pending: int = 64,
+    ):
+        self.oracle = oracle
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = lock
+
+        self._trials = {}
+        self._oracle_dirty = False
+        self._cond = Condition()
+        self._flush_lock = Lock()
+        self._stopped = False
+
+        oracle._save_trial = self._mark_trial
+        oracle.save = self._mark_oracle
+
+        self._thread = Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _mark_trial(self, trial):
+        with self._cond:
+            self._trials[trial.trial_id] = trial
+            if len(self._trials) >= self.max_pending:
+                self._cond.notify()
+
+    def _mark_oracle(self):
+        with self._cond:
+            self._oracle_dirty = True
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: (
+                        self._stopped or len(self._trials) >= self.max_pending
+                    ),
+                    timeout=self.flush_interval,
+                )
+                stopped = self._stopped
+            self.flush()
+            if stopped:
+                return
+
+    def _write(self, fname, state):
+        with tf.io.gfile.GFile(fname, "w") as f:
+            f.write(state)
+
+    def flush(self):
+        """Write everything that's dirty to disk"""
+
+        # only let one flush happen at a time so that
+        # older states can't overwrite newer ones
+        with self._flush_lock:
+            with self._cond:
+                trials, self._trials = self._trials, {}
+                save_oracle, self._oracle_dirty = self._oracle_dirty, False
+            if not trials and not save_oracle:
+                return
+
+            # grab the states to write while nobody is
+            # changing them, then do the actual writing
+            # without holding up access to the oracle
+            with self._lock:
+                states = {
+                    trial_id: json.dumps(trial.get_state())
+                    for trial_id, trial in trials.items()
+                }
+                if save_oracle:
+                    oracle_state = json.dumps(self.oracle.get_state())
+
+            for trial_id, state in states.items():
+                trial_dir = self.oracle._get_trial_dir(trial_id)
+                self._write(os.path.join(trial_dir, "trial.json"), state)
+            if save_oracle:
+                self._write(self.oracle._get_oracle_fname(), oracle_state)
+
+    def close(self):
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+        # don't keep closed writers, and the oracles
+        # they hold onto, alive until the process exits
+        atexit.unregister(self.close)
@@ -0,0 +1,186 @@
+import itertools
+import math
+from collections import deque
+
+import keras_tuner as kt
+import numpy as np
+
+hp_module = kt.engine.hyperparameters
+
+# largest finite search space we're willing to list out
+# in full once random draws stop turning up new configs
+_MAX_ENUMERATED = 10**6
+
+
+def _grid(hp):
+    grid = np.arange(hp.min_value, hp.max_value + 1e-7, step=hp.step)
+    if isinstance(hp, hp_module.Int):
+        grid = grid.astype(int)
+    return grid
+
+
+def _values(hp):
+    """List out every value a hyperparameter can take on"""
+
+    if isinstance(hp, hp_module.Fixed):
+        return [hp.value]
+    elif isinstance(hp, hp_module.Boolean):
+        return [True, False]
+    elif isinstance(hp, hp_module.Choice):
+        return hp.values
+    elif hp.step is not None:
+        return _grid(hp).tolist()
+    return None
+
+
+def _space_size(space):
+    size = 1
+    for hp in space:
+        values = _values(hp)
+        if values is None:
+            return math.inf
+        size *= len(values)
+    return size
+
+
+def _sample(hp, probs):
+    """Map an array of probabilities to hyperparameter values
+
+    Vectorized version of keras-tuner's `cumulative_prob_to_value`,
+    so that values are distributed the same way as they are
+    when keras-tuner samples them one at a time.
+    """
+
+    if isinstance(hp, hp_module.Fixed):
+        return [hp.value] * len(probs)
+    elif isinstance(hp, hp_module.Boolean):
+        return (probs >= 0.5).tolist()
+    elif isinstance(hp, hp_module.Choice):
+        idx = np.minimum(
+            (probs * len(hp.values)).astype(int), len(hp.values) - 1
+        )
+        return [hp.values[i] for i in idx]
+
+    sampling = hp.sampling or "linear"
+    if sampling == "linear":
+        values = probs * (hp.max_value - hp.min_value) + hp.min_value
+    elif sampling == "log":
+        values = hp.min_value * (hp.max_value / hp.min_value) ** probs
+    else:
+        values = hp.min_value * (hp.max_value / hp.min_value) ** (1 - probs)
+        values = hp.max_value + hp.min_value - values
+
+    if hp.step is not None:
+        grid = _grid(hp)
+        idx = np.rint((values - hp.min_value) / hp.step).astype(int)
+        values = grid[np.clip(idx, 0, len(grid) - 1)]
+    return values.tolist()
+
+
+class VectorizedRandomSearch(kt.oracles.RandomSearch):
+    """Random search which samples candidate trials in batches
+
+    keras-tuner's random search samples one value at a time
+    in Python, and starts over whenever it lands on a config
+    it's already tried, which gets slow as the search space
+    fills up. This draws batches of `num_candidates` configs
+    at once with NumPy, and keeps track of the ones already
+    drawn in a set so that duplicates are cheap to throw
+    out. Once batches stop turning up anything new, small
+    enough spaces get listed out so that what's left can be
+    handed out directly, and spaces with nothing left stop
+    the search straight away.
+
+    Search spaces with conditional hyperparameters are
+    sampled by keras-tuner as usual.
+
+    Args:
+        num_candidates:
+            The number of configs to sample at once
+
+    Any other arguments are passed to keras-tuner's
+    `RandomSearchOracle`.
+    """
+
+    def __init__(
+        self,
+        objective=None,
+        max_trials=10,
+        seed=None,
+        hyperparameters=None,
+        num_candidates=256,
+        **kwargs
+    ):
+        super().__init__(
+            objective=objective,
+            max_trials=max_trials,
+            seed=seed,
+            hyperparameters=hyperparameters,
+            **kwargs
+        )
+        self.num_candidates = num_candidates
+        self._rng = np.random.default_rng(seed)
+        self._candidates = deque()
+        self._seen = set()
+        self._remaining = None
+
+    def _draw(self, space):
+        probs = self._rng.random((len(space), self.num_candidates))
+        columns = [_sample(hp, p) for hp, p in zip(space, probs)]
+        return zip(*columns)
+
+    def _next_key(self, space):
+        """Get a config that hasn't been drawn before"""
+
+        # if we've already listed out what's
+        # left of the space, take from there
+        if self._remaining is not None:
+            return self._remaining.pop() if self._remaining else None
+
+        size = _space_size(space)
+        if len(self._seen) >= size:
+            return None
+
+        for _ in range(self._max_collisions + 1):
+            while self._candidates:
+                key = self._candidates.popleft()
+                if key not in self._seen:
+                    self._seen.add(key)
+                    return key
+            self._candidates.extend(self._draw(space))
+
+        # nothing in the last few batches was new, so the space
+        # must be close to full. If it's small enough, list out
+        # whatever's left and hand that out in a random order
+        if size > _MAX_ENUMERATED:
+            return None
+        self._remaining = [
+            key
+            for key in itertools.product(*map(_values, space))
+            if key not in self._seen
+        ]
+        self._rng.shuffle(self._remaining)
+        return self._next_key(space)
+
+    def populate_space(self, trial_id):
+        space = self.hyperparameters.space
+        if any([hp.conditions for hp in space]):
+            return super().populate_space(trial_id)
+
+        names = [hp.name for hp in space]
+        while True:
+            key = self._next_key(space)
+            if key is None:
+                return {"status": kt.engine.trial.TrialStatus.STOPPED}
+
+            # configs can have been tried without our having
+            # drawn them, e.g. if trials were restored from
+            # a journal, so check the oracle's record too
+            values = dict(zip(names, key))
+            values_hash = self._compute_values_hash(values)
+            if values_hash not in self._tried_so_far:
+                self._tried_so_far.add(values_hash)
+                return {
+                    "status": kt.engine.trial.TrialStatus.RUNNING,
+                    "values": values,
+                }
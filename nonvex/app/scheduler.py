@@ -0,0 +1,62 @@
+from collections import defaultdict
+
+
+class ASHAScheduler:
+    """Asynchronous successive halving for stopping trials early
+
+    Trials report their objective as they go along, and
+    are compared against other trials at a series of rungs:
+    the first after `grace_period` steps, and each after
+    `reduction_factor` times as many steps as the last.
+    A trial only gets to keep going past a rung if it's in
+    the top `1 / reduction_factor` of all the trials that
+    have reached that rung so far. Trials are never held up
+    waiting for others to catch up, so a trial that's early
+    to a rung is compared against fewer trials.
+
+    Args:
+        direction:
+            Whether a better objective is lower, `"min"`,
+            or higher, `"max"`
+        grace_period:
+            The number of steps a trial gets to run for
+            before it can be stopped
+        reduction_factor:
+            The factor by which the number of trials gets
+            cut at each rung, and by which the number of
+            steps between rungs grows
+    """
+
+    def __init__(
+        self, direction: str, grace_period: int = 1, reduction_factor: int = 3
+    ):
+        self.sign = 1 if direction == "min" else -1
+        self.grace_period = grace_period
+        self.reduction_factor = reduction_factor
+
+        # objective values recorded at each rung,
+        # and the next rung each trial is headed for
+        self.rungs = defaultdict(list)
+        self._next_rung = defaultdict(int)
+
+    def _milestone(self, rung):
+        return self.grace_period * self.reduction_factor**rung
+
+    def _promotable(self, value, values):
+        num_better = sum([self.sign * i < self.sign * value for i in values])
+        return num_better < max(1, len(values) // self.reduction_factor)
+
+    def report(self, trial_id: str, step: int, value: float) -> bool:
+        """Record a trial's objective and decide whether it should stop"""
+
+        rung = self._next_rung[trial_id]
+        while step >= self._milestone(rung):
+            values = self.rungs[rung]
+            values.append(value)
+            rung += 1
+            if not self._promotable(value, values):
+                self._next_rung[trial_id] = rung
+                return True
+
+        self._next_rung[trial_id] = rung
+        return False
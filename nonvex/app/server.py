@@ -0,0 +1,39 @@
+import logging
+
+from flask import Flask
+
+
+def run_server(
+    app: Flask,
+    host: str = "127.0.0.1",
+    port: int = 5000,
+    num_threads: int = 16,
+):
+    """Serve a Nonvex app to many workers at once
+
+    Uses a `waitress` WSGI server if one is installed,
+    otherwise falls back to Flask's threaded
+    development server.
+
+    Args:
+        app:
+            The Flask app to serve
+        host:
+            The address on which to listen for workers
+        port:
+            The port on which to listen for workers
+        num_threads:
+            The number of threads used to handle
+            requests from workers concurrently
+    """
+
+    try:
+        import waitress
+    except ImportError:
+        logging.warning(
+            "waitress not installed, falling back to "
+            "Flask development server"
+        )
+        app.run(host=host, port=port, threaded=True)
+    else:
+        waitress.serve(app, host=host, port=port, threads=num_threads)
@@ -0,0 +1,282 @@
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from threading import RLock
+from typing import Dict, List, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    trial_id TEXT PRIMARY KEY,
+    hyperparameters TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker_id TEXT,
+    lease_expiry REAL,
+    result REAL,
+    cached INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trials_by_version ON trials (version);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL
+);
+"""
+
+
+class Storage(ABC):
+    """Shared record of the trials in a search
+
+    Lets several server replicas run one search by keeping the
+    state that they need to agree on in one place: which trials
+    exist, which worker each one is claimed by and until when,
+    their results, and how many trials each worker has failed.
+    Trials are `"pending"` until they're claimed, `"running"`
+    while they're claimed, and then either `"completed"` or
+    `"failed"`. Every change to a trial gives it a new version,
+    higher than any other, so that replicas can find out what's
+    changed since they last looked.
+
+    Writes should be made inside of `transaction`, which holds
+    the write lock for the whole search so that replicas can't
+    make conflicting decisions. Reads can be made inside of a
+    read-only transaction instead, which doesn't hold up other
+    replicas.
+    """
+
+    @abstractmethod
+    def transaction(self, write: bool = True):
+        """Get a context manager for a consistent view of the trials
+
+        Holds the write lock if `write` is `True`.
+        """
+
+    @abstractmethod
+    def changes(self, version: int) -> List[Dict]:
+        """Get the trials that have changed since `version`
+
+        Returns the current state of each trial, oldest
+        change first, as dicts with the same keys as the
+        arguments of `add_trial` plus `version`.
+        """
+
+    @abstractmethod
+    def add_trial(
+        self,
+        trial_id: str,
+        hyperparameters: Dict,
+        status: str = "pending",
+        worker_id: Optional[str] = None,
+        lease_expiry: Optional[float] = None,
+        result: Optional[float] = None,
+        cached: bool = False,
+    ):
+        """Add a new trial, `"pending"` unless said otherwise"""
+
+    @abstractmethod
+    def claim(
+        self, trial_id: str, worker_id: str, lease_expiry: Optional[float]
+    ):
+        """Mark a trial as running on a worker
+
+        `lease_expiry` is the wall clock time at which the
+        claim runs out, or `None` if it never does.
+        """
+
+    @abstractmethod
+    def renew(self, trial_id: str, lease_expiry: float):
+        """Extend a running trial's claim until `lease_expiry`"""
+
+    @abstractmethod
+    def requeue(self, trial_id: str):
+        """Release a trial's claim so another worker can run it"""
+
+    @abstractmethod
+    def complete(self, trial_id: str, result: float, cached: bool = False):
+        """Record a trial's result
+
+        `cached` marks results that were looked up rather
+        than run, which don't count against `max_trials`.
+        """
+
+    @abstractmethod
+    def fail(self, trial_id: str):
+        """Mark a trial as failed"""
+
+    @abstractmethod
+    def failures(self, worker_id: str) -> int:
+        """Get the number of trials a worker has failed"""
+
+    @abstractmethod
+    def set_failures(self, worker_id: str, failures: int):
+        """Set the number of trials a worker has failed"""
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage(Storage):
+    """Trial storage in a SQLite database
+
+    Uses write-ahead logging, so that replicas reading the
+    database don't block the one writing to it. Replicas
+    need to be on the same host, or share a filesystem
+    which supports the locks SQLite relies on.
+
+    Args:
+        path:
+            The database file, which gets created
+            if it doesn't already exist
+        timeout:
+            The number of seconds to wait for
+            another replica's transaction to finish
+    """
+
+    def __init__(self, path: str, timeout: float = 30):
+        # manage transactions ourselves rather than
+        # letting the sqlite3 module start them implicitly
+        self._conn = sqlite3.connect(
+            path,
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+        self._lock = RLock()
+        self._depth = 0
+        self._write = False
+
+    @contextmanager
+    def transaction(self, write: bool = True):
+        """Read from the database, holding its write lock if `write`
+
+        Transactions can be nested, and only the outermost
+        one actually begins and commits, so a transaction
+        that writes can't be nested inside of one that
+        doesn't. Changes are committed even if the block
+        raises, since anything the caller did to its own
+        state along with them sticks too.
+        """
+
+        with self._lock:
+            if self._depth == 0:
+                # take the write lock up front rather than on the
+                # first write, so that what we read can't change
+                # out from under us before we write. Reads see a
+                # snapshot of the database either way, and WAL
+                # mode lets them go ahead while another replica
+                # is writing
+                self._write = write
+                self._conn.execute(
+                    "BEGIN IMMEDIATE" if write else "BEGIN DEFERRED"
+                )
+            elif write and not self._write:
+                raise RuntimeError(
+                    "Can't write inside of a read-only transaction"
+                )
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute("COMMIT")
+
+    def _update(self, trial_id: str, **values):
+        values["version"] = self._next_version()
+        columns = ", ".join([f"{k} = ?" for k in values])
+        self._conn.execute(
+            f"UPDATE trials SET {columns} WHERE trial_id = ?",
+            list(values.values()) + [trial_id],
+        )
+
+    def _next_version(self):
+        query = "SELECT COALESCE(MAX(version), 0) + 1 FROM trials"
+        return self._conn.execute(query).fetchone()[0]
+
+    def changes(self, version: int) -> List[Dict]:
+        rows = self._conn.execute(
+            "SELECT * FROM trials WHERE version > ? ORDER BY version",
+            (version,),
+        )
+
+        changes = []
+        for row in rows:
+            change = dict(row)
+            change["hyperparameters"] = json.loads(row["hyperparameters"])
+            change["cached"] = bool(row["cached"])
+            changes.append(change)
+        return changes
+
+    def add_trial(
+        self,
+        trial_id: str,
+        hyperparameters: Dict,
+        status: str = "pending",
+        worker_id: Optional[str] = None,
+        lease_expiry: Optional[float] = None,
+        result: Optional[float] = None,
+        cached: bool = False,
+    ):
+        self._conn.execute(
+            "INSERT INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                trial_id,
+                json.dumps(hyperparameters),
+                status,
+                worker_id,
+                lease_expiry,
+                result,
+                int(cached),
+                self._next_version(),
+            ),
+        )
+
+    def claim(
+        self, trial_id: str, worker_id: str, lease_expiry: Optional[float]
+    ):
+        self._update(
+            trial_id,
+            status="running",
+            worker_id=worker_id,
+            lease_expiry=lease_expiry,
+        )
+
+    def renew(self, trial_id: str, lease_expiry: float):
+        self._update(trial_id, lease_expiry=lease_expiry)
+
+    def requeue(self, trial_id: str):
+        self._update(
+            trial_id, status="pending", worker_id=None, lease_expiry=None
+        )
+
+    def complete(self, trial_id: str, result: float, cached: bool = False):
+        self._update(
+            trial_id,
+            status="completed",
+            result=result,
+            cached=int(cached),
+            lease_expiry=None,
+        )
+
+    def fail(self, trial_id: str):
+        self._update(trial_id, status="failed", lease_expiry=None)
+
+    def failures(self, worker_id: str) -> int:
+        row = self._conn.execute(
+            "SELECT failures FROM workers WHERE worker_id = ?", (worker_id,)
+        ).fetchone()
+        return 0 if row is None else row[0]
+
+    def set_failures(self, worker_id: str, failures: int):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO workers VALUES (?, ?)",
+            (worker_id, failures),
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Optional
+
+# study names become directory names, so keep them simple
+_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]*")
+
+
+class StudyExists(Exception):
+    """Raised when creating a study under a name that's taken"""
+
+
+class StudyManager:
+    """Hosts many named searches, or studies, in one process
+
+    Each study gets a project directory of its own under
+    `output_dir`, in which the spec it was created from is
+    saved. Studies which haven't had any requests or trials
+    running for `idle_timeout` seconds get closed, which
+    writes all their state out to disk, and are picked back
+    up from their journals the next time they're used. Studies
+    whose searchers aren't `resumable` are never closed.
+
+    Args:
+        output_dir:
+            The directory in which to create a project
+            directory for each study
+        create:
+            Function which creates the searcher for a study
+            given its name, its spec and whether to resume it
+            from disk. Should raise a `ValueError` if the
+            spec is invalid
+        idle_timeout:
+            The number of seconds a study can go unused
+            before it's moved out of memory. If `0`,
+            studies are kept in memory for good
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        create: Callable,
+        idle_timeout: float = 600,
+    ):
+        self.output_dir = output_dir
+        self._create = create
+        self.idle_timeout = idle_timeout
+
+        # studies in memory, along with the number of
+        # requests each one is handling and when they
+        # last finished handling one
+        self._studies = {}
+        self._active = Counter()
+        self._last_used = {}
+        self._lock = Lock()
+
+        self._closed = Event()
+        self._sweeper = None
+        if idle_timeout > 0:
+            self._sweeper = Thread(target=self._sweep, daemon=True)
+            self._sweeper.start()
+
+    def _spec_path(self, name: str) -> str:
+        return os.path.join(self.output_dir, name, "study.json")
+
+    def _read_spec(self, name: str) -> Optional[Dict]:
+        try:
+            with open(self._spec_path(name), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def names(self):
+        """Get the names of all studies, in memory or not"""
+
+        names = set()
+        if os.path.isdir(self.output_dir):
+            for name in os.listdir(self.output_dir):
+                if os.path.exists(self._spec_path(name)):
+                    names.add(name)
+        with self._lock:
+            loaded = set(self._studies)
+        return {"studies": sorted(names | loaded), "loaded": sorted(loaded)}
+
+    def create(self, name: str, spec: Dict) -> bool:
+        """Create a new study from a spec
+
+        Creating a study that already exists with the same
+        spec does nothing, so that requests to create a study
+        are safe to retry. Returns whether a study was created.
+        """
+
+        if _NAME_PATTERN.fullmatch(name) is None:
+            raise ValueError(f"Invalid study name '{name}'")
+
+        with self._lock:
+            existing = self._read_spec(name)
+            if existing is not None:
+                if existing != spec:
+                    raise StudyExists(
+                        f"Study '{name}' already exists with a different spec"
+                    )
+                return False
+
+            self._studies[name] = self._create(name, spec, False)
+            self._last_used[name] = time.monotonic()
+
+            # only save the spec once the searcher's been created,
+            # both because that's what makes the project directory
+            # and so that invalid specs don't get left behind
+            with open(self._spec_path(name), "w") as f:
+                json.dump(spec, f)
+        return True
+
+    def acquire(self, name: str):
+        """Get the searcher for a study to handle a request with
+
+        Loads the study back into memory if it's been moved
+        out. Every call should be paired with a `release`.
+        Raises a `KeyError` if there's no such study.
+        """
+
+        with self._lock:
+            searcher = self._studies.get(name)
+            if searcher is None:
+                spec = None
+                if _NAME_PATTERN.fullmatch(name) is not None:
+                    spec = self._read_spec(name)
+                if spec is None:
+                    raise KeyError(name)
+                searcher = self._studies[name] = self._create(name, spec, True)
+            self._active[name] += 1
+            return searcher
+
+    def release(self, name: str):
+        with self._lock:
+            self._active[name] -= 1
+            self._last_used[name] = time.monotonic()
+
+    def evict_idle(self):
+        """Move studies which have gone unused out of memory"""
+
+        now = time.monotonic()
+        with self._lock:
+            for name, searcher in list(self._studies.items()):
+                # studies with trials still out have workers
+                # that will be back, so keep them around, as
+                # well as any that couldn't be picked back up
+                # from disk without losing some of their state
+                if (
+                    self._active[name]
+                    or searcher.assignments
+                    or not searcher.resumable
+                    or now - self._last_used[name] < self.idle_timeout
+                ):
+                    continue
+                searcher.close()
+                self._studies.pop(name)
+                self._active.pop(name, None)
+
+    def _sweep(self):
+        # keep sweeping even if a study fails to close,
+        # otherwise nothing would ever get evicted again
+        while not self._closed.wait(self.idle_timeout / 4):
+            try:
+                self.evict_idle()
+            except Exception:
+                logging.exception("Failed to evict idle studies")
+
+    def close(self):
+        self._closed.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+        with self._lock:
+            for searcher in self._studies.values():
+                searcher.close()
+            self._studies = {}
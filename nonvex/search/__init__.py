@@ -1,2 +1,3 @@
-from .client import NonvexClient
-from .search import run_search
+from .client import AsyncNonvexClient, NonvexClient
+from .reporting import areport, keras_callback, report
+from .search import run_async_search, run_search
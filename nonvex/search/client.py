@@ -1,53 +1,497 @@
-from dataclasses import dataclass
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from functools import partial
 from secrets import token_hex
-from typing import Optional
+from threading import Event, Thread
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
 
 import requests
 
+# only import keras-tuner for type checking, since
+# importing it means importing TensorFlow
+if TYPE_CHECKING:
+    import keras_tuner as kt
+
+# statuses from e.g. proxies in front of the server
+# that are worth retrying a request for
+_RETRY_STATUSES = (502, 504)
+
 
 @dataclass
 class NonvexClient:
+    """Client for talking to a Nonvex hyperparameter server
+
+    Args:
+        url:
+            The URL of the hyperparameter server
+        worker_id:
+            A unique ID to assign to this worker. If left
+            as `None`, a random hex value will be assigned
+        poll_timeout:
+            The number of seconds to ask the server to hold
+            a request open while waiting for a free slot
+        admission_timeout:
+            The total number of seconds to wait for a free
+            slot when starting before giving up. If left as
+            `None`, the client will wait indefinitely
+        timeout:
+            The number of seconds to wait on the server to
+            respond to a request, on top of any time it's
+            been asked to wait for a free slot
+        max_retries:
+            The number of times to retry a request that
+            fails because of a network error
+        backoff:
+            The base number of seconds to wait between retries.
+            Retry `n` waits a random amount of time up to
+            `backoff * 2**n` seconds
+        study:
+            The name of the study to run trials for on a server
+            hosting many studies. If left as `None`, the server
+            is assumed to be running a single search
+        capacity:
+            How much work this worker can do relative to other
+            workers, e.g. its number of GPUs. Servers scheduling
+            trials by cost give their most expensive trials to
+            the workers with the most capacity. If left as
+            `None`, the worker counts as having a capacity of 1
+    """
+
     url: str
     worker_id: Optional[str] = None
+    poll_timeout: float = 30
+    admission_timeout: Optional[float] = None
+    timeout: float = 10
+    max_retries: int = 3
+    backoff: float = 0.5
+    study: Optional[str] = None
+    capacity: Optional[float] = None
+    lease_timeout: Optional[float] = field(default=None, init=False)
 
     def __post_init__(self):
         if self.worker_id is None:
             self.worker_id = token_hex(15)
+        self._heartbeat_thread = None
+        self._heartbeat_stop = Event()
+
+        # the trials we're running, and any of them that
+        # the server has stopped listing as ours, e.g.
+        # because someone else finished them first
+        self._trial_ids = set()
+        self._lost = set()
+
+        # reuse connections to the server across requests
+        # rather than opening a new one for every trial
+        self._session = requests.Session()
+
+    def _request(self, method, path, timeout=None, **kwargs):
+        """Make a request, retrying if the network lets us down
+
+        Every request the server handles is safe to repeat,
+        so it's fine to retry requests that might have made
+        it to the server before failing.
+        """
+
+        if self.study is not None:
+            path = f"studies/{self.study}/{path}".rstrip("/")
+        url = f"{self.url}/{path}"
+        timeout = timeout or self.timeout
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._session.request(
+                    method, url, timeout=timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                error = e
+            else:
+                retry = response.status_code in _RETRY_STATUSES
+                if not retry or attempt == self.max_retries:
+                    return response
+                error = f"status code {response.status_code}"
+
+            # use jittered exponential backoff so that workers
+            # which lost the server at the same time don't all
+            # come back to it at the same time
+            delay = random.uniform(0, self.backoff * 2**attempt)
+            logging.warning(
+                "Request to {} failed with {}, retrying in "
+                "{:0.2f}s".format(url, error, delay)
+            )
+            time.sleep(delay)
+
+    def close(self):
+        self.stop_heartbeat()
+        self._session.close()
+
+    def create_study(
+        self,
+        hyperparameters: Union["kt.HyperParameters", Dict],
+        objective: str,
+        max_trials: int,
+        **kwargs,
+    ):
+        """Create the study this client runs trials for
+
+        Does nothing if the study already exists with the same
+        settings, so every worker in a search can call this
+        before starting rather than having to coordinate.
+
+        Args:
+            hyperparameters:
+                The search space of the study, or its config
+            objective:
+                The name of the objective that workers
+                will report back to the server
+            max_trials:
+                The maximum number of trials to run
+            **kwargs:
+                Any other settings for the study, from
+                the arguments to `nonvex.app.create_app`
+        """
+
+        if self.study is None:
+            raise ValueError("Client has no study to create")
+
+        if not isinstance(hyperparameters, dict):
+            hyperparameters = hyperparameters.get_config()
+        spec = {
+            "hyperparameters": hyperparameters,
+            "objective": objective,
+            "max_trials": max_trials,
+            **kwargs,
+        }
+        response = self._request("PUT", "", json=spec)
+        if response.status_code in (400, 409):
+            raise ValueError(response.json()["error"])
+        response.raise_for_status()
 
     def get_hyperparameters(self):
-        response = requests.get(f"{self.url}/hyperparameters")
+        response = self._request("GET", "hyperparameters")
         response.raise_for_status()
         return response.json()["hyperparameters"]
 
+    def _hold(self, trial_ids):
+        self._trial_ids = set(trial_ids)
+        self._lost = set()
+
     def _read_response(self, response):
-        response = response.json()
         if response["id"] == "":
+            self._hold([])
             return None, None
+        self._hold([response["id"]])
+
+        # the server will tell us how long we can go
+        # without a heartbeat if it's using leases
+        self.lease_timeout = response.get("lease")
         return response["hyperparameters"], response["id"]
 
-    def start_worker(self):
-        response = requests.get(f"{self.url}/start/{self.worker_id}")
-        try:
-            response.raise_for_status()
-        except requests.HTTPError:
-            if response.code == 400:
+    def _read_batch_response(self, response):
+        trials = response["trials"]
+        self._hold([i["id"] for i in trials])
+        if trials:
+            self.lease_timeout = trials[0].get("lease")
+        return [(i["hyperparameters"], i["id"]) for i in trials]
+
+    def _begin(self, params):
+        """Ask the server for a slot
+
+        Returns the server's response, or `None` along with
+        the number of seconds to wait before asking again
+        if the server couldn't find a slot in time.
+        """
+
+        response = self._request(
+            "GET",
+            f"start/{self.worker_id}",
+            params=params,
+            timeout=self.timeout + params["wait"],
+        )
+        if response.status_code == 503:
+            return None, float(response.headers.get("Retry-After", 1))
+        response.raise_for_status()
+        return response.json(), None
+
+    def _start(self, **params):
+        """Wait in line at the server for a slot to open up"""
+
+        params["wait"] = self.poll_timeout
+        if self.capacity is not None:
+            params["capacity"] = self.capacity
+        start_time = time.monotonic()
+        while True:
+            response, retry_after = self._begin(params)
+            if response is not None:
+                return response
+
+            # the server couldn't find a slot for us in time,
+            # so back off for as long as it tells us to
+            waited = time.monotonic() - start_time + retry_after
+            if (
+                self.admission_timeout is not None
+                and waited > self.admission_timeout
+            ):
                 raise RuntimeError(
                     "Too many parallel workers in progress for "
                     "hyperparameter server at URL {}".format(self.url)
                 )
-            raise
+            time.sleep(retry_after)
 
+    def start_worker(self):
+        response = self._start()
         return self._read_response(response)
 
+    def start_batch(self, num_trials: int):
+        """Start this worker with up to `num_trials` trials at once
+
+        Returns a list of `(hyperparameters, trial_id)` tuples,
+        which will be empty if there are no trials left to run.
+        """
+
+        response = self._start(num_trials=num_trials)
+        return self._read_batch_response(response)
+
     def end_trial(self, trial_id, result):
-        params = {"worker_id": self.worker_id}
-        params.update(result)
+        """Report the result of a trial and get the next one"""
 
-        response = requests.get(f"{self.url}/end/{trial_id}", params=params)
+        response = self._request(
+            "POST",
+            f"end/{trial_id}",
+            json={"worker_id": self.worker_id, "result": result},
+        )
+
+        # if the server can't create a trial until others
+        # finish, wait in line for one like a new worker
+        if response.status_code == 503:
+            return self.start_worker()
         response.raise_for_status()
-        return self._read_response(response)
+        return self._read_response(response.json())
 
-    def cancel_trial(self):
-        response = requests.get(f"{self.url}/cancel/{self.worker_id}")
+    def end_batch(
+        self,
+        results: Dict[str, Dict[str, float]],
+        failed: List[str],
+        num_trials: int,
+    ):
+        """Report a batch of trials and start a new one
+
+        Args:
+            results:
+                Mapping from the ids of successful trials
+                to the metrics they returned
+            failed:
+                The ids of any trials that raised an error
+            num_trials:
+                The maximum number of new trials to start
+        """
+
+        response = self._request(
+            "POST",
+            f"batch/{self.worker_id}",
+            json={
+                "results": results,
+                "failed": failed,
+                "num_trials": num_trials,
+                "wait": self.poll_timeout,
+            },
+            timeout=self.timeout + self.poll_timeout,
+        )
+
+        # if our trials got given away while we were
+        # running them, wait in line for new ones
+        if response.status_code == 503:
+            return self.start_batch(num_trials)
         response.raise_for_status()
-        return self._read_response(response)
+        return self._read_batch_response(response.json())
+
+    def cancel_trial(self, trial_id: Optional[str] = None):
+        """Cancel a failed trial and get the next one
+
+        Passing the id of the trial makes it safe to retry
+        the request, since the server will know if it's
+        already cancelled it.
+        """
+
+        params = {"trial_id": trial_id} if trial_id is not None else None
+        response = self._request(
+            "GET", f"cancel/{self.worker_id}", params=params
+        )
+        if response.status_code == 503:
+            return self.start_worker()
+        response.raise_for_status()
+        return self._read_response(response.json())
+
+    def report(self, trial_id: str, step: int, metrics: Dict[str, float]):
+        """Report intermediate metrics for a trial
+
+        Returns whether the server thinks the trial should
+        be stopped early, or whether a heartbeat has already
+        found that the trial isn't this worker's anymore.
+        """
+
+        if self.should_stop(trial_id):
+            return True
+        response = self._request(
+            "POST",
+            f"report/{trial_id}",
+            json={"step": step, "metrics": metrics},
+        )
+        response.raise_for_status()
+        return response.json()["stop"]
+
+    def heartbeat(self):
+        """Renew the lease on this worker's current trial
+
+        Returns the id of the trial the server thinks this
+        worker is running, or `None` if its lease expired
+        and the trial was handed to another worker. Any of
+        our trials the server doesn't list anymore get
+        flagged to stop, see `should_stop`.
+        """
+
+        # only go by trials we had before asking, since the
+        # server won't know about any we've been given since
+        trial_ids = set(self._trial_ids)
+        response = self._request("GET", f"heartbeat/{self.worker_id}")
+        response.raise_for_status()
+        response = response.json()
+        self._lost.update(trial_ids.difference(response["ids"]))
+        return response["id"] or None
+
+    def should_stop(self, trial_id: str) -> bool:
+        """Whether a trial this worker is running should be stopped
+
+        Trials should be stopped once the server stops
+        listing them as this worker's in response to a
+        heartbeat, e.g. because another worker finished
+        a copy of the trial first, or because its lease
+        expired and it was handed to another worker.
+        """
+
+        return trial_id in self._lost
+
+    def _beat(self):
+        while not self._heartbeat_stop.wait(self.lease_timeout / 3):
+            try:
+                self.heartbeat()
+            except requests.RequestException as e:
+                logging.warning(f"Heartbeat failed: {e}")
+
+    def start_heartbeat(self):
+        """Keep our trial leases alive in a background thread
+
+        Does nothing if the server isn't using leases.
+        """
+
+        if self.lease_timeout is None or self._heartbeat_thread is not None:
+            return
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = Thread(target=self._beat, daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat_thread is None:
+            return
+        self._heartbeat_stop.set()
+        self._heartbeat_thread.join()
+        self._heartbeat_thread = None
+
+
+class AsyncNonvexClient:
+    """Asyncio client for talking to a Nonvex hyperparameter server
+
+    Wraps a `NonvexClient`, running its requests in threads
+    so that waiting on the server, e.g. for a free slot,
+    doesn't hold up anything else on the event loop.
+
+    Args:
+        url:
+            The URL of the hyperparameter server
+        worker_id:
+            A unique ID to assign to this worker. If left
+            as `None`, a random hex value will be assigned
+        executor:
+            The executor to make requests in. If left as `None`,
+            the event loop's default executor will be used
+        **kwargs:
+            Any other arguments to pass to `NonvexClient`
+    """
+
+    def __init__(
+        self,
+        url: str,
+        worker_id: Optional[str] = None,
+        executor: Optional[Executor] = None,
+        **kwargs,
+    ):
+        self.client = NonvexClient(url, worker_id, **kwargs)
+        self.executor = executor
+
+    @property
+    def worker_id(self):
+        return self.client.worker_id
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args))
+
+    async def create_study(
+        self,
+        hyperparameters: Union["kt.HyperParameters", Dict],
+        objective: str,
+        max_trials: int,
+        **kwargs,
+    ):
+        await self._run(
+            partial(self.client.create_study, **kwargs),
+            hyperparameters,
+            objective,
+            max_trials,
+        )
+
+    async def get_hyperparameters(self):
+        return await self._run(self.client.get_hyperparameters)
+
+    async def start_worker(self):
+        return await self._run(self.client.start_worker)
+
+    async def start_batch(self, num_trials: int):
+        return await self._run(self.client.start_batch, num_trials)
+
+    async def end_trial(self, trial_id, result):
+        return await self._run(self.client.end_trial, trial_id, result)
+
+    async def end_batch(
+        self,
+        results: Dict[str, Dict[str, float]],
+        failed: List[str],
+        num_trials: int,
+    ):
+        return await self._run(
+            self.client.end_batch, results, failed, num_trials
+        )
+
+    async def cancel_trial(self, trial_id: Optional[str] = None):
+        return await self._run(self.client.cancel_trial, trial_id)
+
+    async def report(
+        self, trial_id: str, step: int, metrics: Dict[str, float]
+    ):
+        return await self._run(self.client.report, trial_id, step, metrics)
+
+    async def heartbeat(self):
+        return await self._run(self.client.heartbeat)
+
+    def start_heartbeat(self):
+        self.client.start_heartbeat()
+
+    def stop_heartbeat(self):
+        self.client.stop_heartbeat()
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,176 @@
+import multiprocessing as mp
+import os
+import signal
+import traceback
+from multiprocessing.connection import wait
+from typing import Callable, Dict, List, Optional
+
+# number of seconds between checks on whether
+# a running trial should be stopped
+_STOP_INTERVAL = 1.0
+
+
+class TrialStopped(Exception):
+    """Raised when a trial's process is killed before it finishes"""
+
+
+def _fork_trial(fn, args, hyperparameters, trial_id, conn):
+    """Run a trial in a child forked from the current process
+
+    If a message comes in over `conn` while the trial
+    is running, the child gets killed to stop the trial.
+    """
+
+    from nonvex.search.search import _get_trial_kwargs
+
+    # parse arguments here rather than in the child
+    # so that they get cached for later trials
+    try:
+        kwargs = _get_trial_kwargs(fn, args, hyperparameters, trial_id)
+    except Exception:
+        return ("error", traceback.format_exc())
+
+    read_conn, write_conn = mp.Pipe(duplex=False)
+    pid = os.fork()
+    if pid == 0:
+        read_conn.close()
+        try:
+            response = ("ok", fn(**kwargs))
+        except BaseException:
+            response = ("error", traceback.format_exc())
+
+        try:
+            write_conn.send(response)
+        finally:
+            os._exit(0)
+
+    # wait for the child to report back before reaping it,
+    # otherwise it could block trying to send us a large
+    # result while we block waiting for it to exit. If the
+    # child dies without reporting, we'll get an EOF. Kill
+    # it if we're told to stop it in the meantime, which is
+    # safe since it can't have been reaped yet
+    write_conn.close()
+    stopped = False
+    while conn in wait([read_conn, conn]):
+        conn.recv()
+        os.kill(pid, signal.SIGKILL)
+        stopped = True
+    try:
+        response = read_conn.recv()
+    except EOFError:
+        response = None
+    read_conn.close()
+
+    _, status = os.waitpid(pid, 0)
+    if response is None and stopped:
+        response = ("stopped", f"Trial {trial_id} was stopped")
+    elif response is None:
+        if os.WIFSIGNALED(status):
+            reason = "signal " + signal.Signals(os.WTERMSIG(status)).name
+        else:
+            reason = f"exit code {os.WEXITSTATUS(status)}"
+        response = ("crash", f"Trial {trial_id} process died with {reason}")
+    return response
+
+
+def _serve_template(executable, args, conn):
+    """Import the training function once, then fork it for each trial"""
+
+    from nonvex.search.search import get_train_fn
+
+    try:
+        fn = get_train_fn(executable)
+    except BaseException:
+        conn.send(("error", traceback.format_exc()))
+        return
+    conn.send(("ok", None))
+
+    while True:
+        request = conn.recv()
+        if request is None:
+            return
+        elif request == "stop":
+            # the trial finished before it could be stopped
+            continue
+        conn.send(_fork_trial(fn, args, *request, conn))
+
+
+class ForkExecutor:
+    """Run each trial in a fresh process without re-importing
+
+    Starts a template process which imports the training
+    function in `executable` once, then forks a child from
+    it for each trial. Children inherit the already-imported
+    libraries, so trials start quickly, but memory leaks,
+    global state and crashes don't carry over from one
+    trial to the next.
+
+    Args:
+        executable:
+            The training executable or function to run
+        args:
+            Any command line arguments to pass to `executable`
+    """
+
+    def __init__(self, executable: str, args: List[str]):
+        # spawn rather than fork the template so that it starts
+        # from a clean slate rather than inheriting e.g. our
+        # heartbeat thread, which wouldn't survive forking
+        ctx = mp.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(
+            target=_serve_template,
+            args=(executable, args, child_conn),
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+
+        status, error = self._conn.recv()
+        if status != "ok":
+            self._process.join()
+            raise RuntimeError(
+                "Couldn't import executable {} in template "
+                "process:\n{}".format(executable, error)
+            )
+
+    def run(
+        self,
+        hyperparameters: Dict,
+        trial_id: str,
+        stop: Optional[Callable[[str], bool]] = None,
+    ):
+        """Run a trial and return its result
+
+        Raises a `RuntimeError` if the trial raised an
+        error or its process died before returning. If
+        `stop` is passed, it gets called with `trial_id`
+        every so often while the trial runs, and if it
+        returns `True` the trial's process is killed and
+        a `TrialStopped` error is raised.
+        """
+
+        self._conn.send((hyperparameters, trial_id))
+        if stop is not None:
+            while not self._conn.poll(_STOP_INTERVAL):
+                if stop(trial_id):
+                    self._conn.send("stop")
+                    break
+
+        try:
+            status, result = self._conn.recv()
+        except EOFError:
+            raise RuntimeError("Template process died unexpectedly")
+
+        if status == "stopped":
+            raise TrialStopped(result)
+        elif status != "ok":
+            raise RuntimeError(result)
+        return result
+
+    def close(self):
+        if self._process.is_alive():
+            self._conn.send(None)
+        self._process.join()
+        self._conn.close()
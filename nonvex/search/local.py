@@ -0,0 +1,222 @@
+from typing import Dict, List, Optional
+
+from nonvex.app import Searcher, SlotUnavailable
+from nonvex.search.client import NonvexClient
+from nonvex.search.search import _search
+
+
+class LocalClient(NonvexClient):
+    """Client which runs a search in-process rather than over HTTP
+
+    Exposes the same interface as `NonvexClient`, but calls
+    straight into a `Searcher` living in the same process
+    instead of sending requests to a server, so there's no
+    network round trip or JSON encoding for each trial.
+
+    Args:
+        searcher:
+            The searcher to get trials from and report to
+        worker_id:
+            A unique ID to assign to this worker. If left
+            as `None`, a random hex value will be assigned
+        poll_timeout:
+            The number of seconds to wait for a free slot
+            before backing off
+        admission_timeout:
+            The total number of seconds to wait for a free
+            slot when starting before giving up. If left as
+            `None`, the client will wait indefinitely
+    """
+
+    def __init__(
+        self,
+        searcher: Searcher,
+        worker_id: Optional[str] = None,
+        poll_timeout: float = 30,
+        admission_timeout: Optional[float] = None,
+    ):
+        super().__init__("local", worker_id, poll_timeout, admission_timeout)
+        self.searcher = searcher
+
+    def get_hyperparameters(self):
+        return self.searcher.get_hyperparameters()["hyperparameters"]
+
+    def _begin(self, params):
+        try:
+            return self.searcher.begin_worker(self.worker_id, **params), None
+        except SlotUnavailable as e:
+            return None, e.retry_after
+
+    def _objective(self, result):
+        return float(result[self.searcher.objective])
+
+    def end_trial(self, trial_id, result):
+        try:
+            response = self.searcher.end_trial(
+                trial_id, self._objective(result), self.worker_id
+            )
+        except SlotUnavailable:
+            return self.start_worker()
+        return self._read_response(response)
+
+    def end_batch(
+        self,
+        results: Dict[str, Dict[str, float]],
+        failed: List[str],
+        num_trials: int,
+    ):
+        results = {i: self._objective(j) for i, j in results.items()}
+        try:
+            response = self.searcher.end_trials(
+                self.worker_id,
+                results,
+                failed,
+                num_trials,
+                self.poll_timeout,
+            )
+        except SlotUnavailable:
+            return self.start_batch(num_trials)
+        return self._read_batch_response(response)
+
+    def cancel_trial(self, trial_id: Optional[str] = None):
+        try:
+            response = self.searcher.cancel_trial(self.worker_id, trial_id)
+        except SlotUnavailable:
+            return self.start_worker()
+        return self._read_response(response)
+
+    def report(self, trial_id: str, step: int, metrics: Dict[str, float]):
+        if self.should_stop(trial_id):
+            return True
+        metrics = {k: float(v) for k, v in metrics.items()}
+        response = self.searcher.report_trial(trial_id, step, metrics)
+        return response["stop"]
+
+    def heartbeat(self):
+        trial_ids = set(self._trial_ids)
+        response = self.searcher.heartbeat(self.worker_id)
+        self._lost.update(trial_ids.difference(response["ids"]))
+        return response["id"] or None
+
+
+def run_local_search(
+    executable: str,
+    objective: str,
+    max_trials: int,
+    output_dir: str,
+    project_name: str,
+    num_trials: int = 1,
+    max_fails: int = 5,
+    resume: bool = False,
+    flush_interval: float = 1.0,
+    grace_period: Optional[int] = None,
+    reduction_factor: int = 3,
+    oracle_type: str = "random",
+    oracle_options: Optional[Dict[str, float]] = None,
+    no_memoize: bool = False,
+    warm_start: Optional[str] = None,
+    args: Optional[List[str]] = None,
+    isolate: bool = False,
+) -> List[Dict[str, float]]:
+    """Run a hyperparameter search without a server
+
+    Runs both the hyperparameter oracle and the training
+    function in this process, for searches that don't need
+    to be spread across more than one machine. The project
+    directory ends up the same as if the search had been
+    run through `nonvex serve` and a single worker.
+
+    Args:
+        executable:
+            The training executable or function to search over
+        objective:
+            The name of the objective returned by `executable`
+        max_trials:
+            The maximum number of trials to run for the
+            entire hyperparameter search
+        output_dir:
+            The output directory in which to create a
+            project directory for this hyperparameter search
+        project_name:
+            The name to assign to this hyperparameter search
+        num_trials:
+            The number of trials to create at once. Trials in
+            a batch are run one after the other, and their
+            results are recorded together
+        max_fails:
+            The number of trials that can fail before
+            the search is stopped
+        resume:
+            Whether to pick up an existing search in the same
+            project directory where it left off by replaying
+            its journal, rather than starting a new one
+        flush_interval:
+            The maximum number of seconds to wait between
+            writing batches of trial state to the project
+            directory. If `0`, trial state is written as
+            soon as it changes
+        grace_period:
+            The number of steps of intermediate metrics a
+            trial has to report before it can be stopped early
+            by asynchronous successive halving. If left as
+            `None`, trials are never stopped early
+        reduction_factor:
+            The factor by which successive halving cuts down
+            the number of trials at each rung, and by which
+            the number of steps between rungs grows
+        oracle_type:
+            The algorithm used to pick hyperparameters for new
+            trials. One of `"random"`, `"bayesian"` or
+            `"hyperband"`. Hyperband trials are passed the
+            arguments `epochs` and `initial_epoch` to train
+            for, and `resume_trial_id`, the id of the trial
+            to pick training back up from, if any
+        oracle_options:
+            Any options to pass to the oracle, e.g.
+            `num_candidates` to sample at once for random
+            search, `num_initial_points` for Bayesian
+            optimization, or `max_epochs` and `factor`
+            for Hyperband
+        no_memoize:
+            Whether to train every trial, rather than caching
+            the results of configs that have been evaluated
+            with the project and completing any later trials
+            with the same config straight from the cache.
+            Trials completed from the cache don't count
+            against `max_trials`
+        warm_start:
+            The project directory of an earlier search whose
+            results to add to the cache, so that configs it
+            already evaluated get skipped. Can't be used
+            with `no_memoize`
+        args:
+            Any command line arguments to pass to `executable`
+        isolate:
+            Whether to run each trial in its own process
+            forked from a template process which has already
+            imported `executable`
+    """
+
+    searcher = Searcher(
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name=project_name,
+        max_parallel_workers=num_trials,
+        max_fails_per_worker=max_fails,
+        resume=resume,
+        flush_interval=flush_interval,
+        grace_period=grace_period,
+        reduction_factor=reduction_factor,
+        oracle_type=oracle_type,
+        oracle_options=oracle_options,
+        memoize=not no_memoize,
+        warm_start=warm_start,
+    )
+    try:
+        # use the same worker id every time so that if we resume,
+        # any trials that were running get handed back to us
+        client = LocalClient(searcher, worker_id="local")
+        return _search(client, executable, num_trials, args or [], isolate)
+    finally:
+        searcher.close()
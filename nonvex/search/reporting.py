@@ -0,0 +1,88 @@
+import inspect
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+# function for reporting metrics for the trial that's
+# currently running. This is a context variable rather
+# than a global so that trials running concurrently on
+# an event loop each report for the right trial
+_reporter = ContextVar("nonvex_reporter", default=None)
+
+
+@contextmanager
+def reporting_to(reporter: Callable):
+    token = _reporter.set(reporter)
+    try:
+        yield
+    finally:
+        _reporter.reset(token)
+
+
+def report(step: int, **metrics: float) -> bool:
+    """Report intermediate metrics for the trial being run
+
+    Call this from within a training function, e.g. at the
+    end of each epoch, to let the server compare the trial
+    against others and decide whether to stop it early.
+    Outside of a search, or for trials run in isolated
+    processes, this does nothing.
+
+    Args:
+        step:
+            The number of steps, e.g. epochs, the
+            trial has run for so far
+        **metrics:
+            The current values of the trial's metrics,
+            including the objective being searched over
+    Returns:
+        Whether the training function should stop and
+        return its current metrics
+    """
+
+    reporter = _reporter.get()
+    if reporter is None:
+        return False
+
+    stop = reporter(step, metrics)
+    if inspect.isawaitable(stop):
+        stop.close()
+        raise RuntimeError(
+            "Can't report metrics from a coroutine training "
+            "function with `report`, use `areport` instead"
+        )
+    return stop
+
+
+async def areport(step: int, **metrics: float) -> bool:
+    """Report intermediate metrics for the trial being run
+
+    Version of `report` for coroutine training functions.
+    """
+
+    reporter = _reporter.get()
+    if reporter is None:
+        return False
+
+    stop = reporter(step, metrics)
+    if inspect.isawaitable(stop):
+        stop = await stop
+    return stop
+
+
+def keras_callback():
+    """Build a Keras callback which reports metrics every epoch
+
+    The metrics logged at the end of each epoch get
+    reported for the trial being run, and training is
+    stopped if the server thinks the trial should be.
+    """
+
+    from tensorflow import keras
+
+    class ReportCallback(keras.callbacks.Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            if report(epoch + 1, **(logs or {})):
+                self.model.stop_training = True
+
+    return ReportCallback()
@@ -1,14 +1,22 @@
+import asyncio
 import importlib
 import inspect
+import multiprocessing as mp
 import os
 import re
 import shutil
 import sys
-from typing import Callable, Dict, List, Optional
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 from hermes.typeo import typeo
 
-from nonvex.search.client import NonvexClient
+from nonvex.search.client import AsyncNonvexClient, NonvexClient
+from nonvex.search.executor import ForkExecutor, TrialStopped
+from nonvex.search.reporting import reporting_to
 
 
 def get_train_fn(executable: str) -> Callable:
@@ -33,15 +41,89 @@ def get_train_fn(executable: str) -> Callable:
     return getattr(module, fn)
 
 
+# nonvex environment variables which change from one
+# trial to the next, and so which invalidate any parsed
+# arguments that reference them
+_NV_ENV_VARS = ("NV_TRIAL_ID", "NV_WORKER_ID")
+
+_argv_lock = Lock()
+
+
+@lru_cache()
+def _referenced_env_vars(args: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    Find which nonvex environment variables are referenced in
+    `args`, either directly or in the typeo config they point to
+    """
+
+    texts = list(args)
+    for i, arg in enumerate(args):
+        if arg == "--typeo":
+            try:
+                config = args[i + 1]
+            except IndexError:
+                config = ""
+            if config.startswith("-"):
+                config = ""
+        elif arg.startswith("--typeo="):
+            config = arg.split("=", maxsplit=1)[1]
+        else:
+            continue
+
+        path = config.split(":")[0] or "pyproject.toml"
+        if os.path.isdir(path):
+            path = os.path.join(path, "pyproject.toml")
+
+        # if the config can't be read, typeo will
+        # raise a more useful error when parsing
+        try:
+            with open(path, "r") as f:
+                texts.append(f.read())
+        except OSError:
+            continue
+
+    text = "\n".join(texts)
+    return tuple([i for i in _NV_ENV_VARS if "${%s}" % i in text])
+
+
 def read_fn_kwargs(
-    fn: Callable, args: List[str], hyperparameters: List[str]
+    fn: Callable, args: List[str], hyperparameters: Iterable[str]
 ) -> Dict:
     """
     Use `fn`'s signature to parse out any command line arguments
     using `typeo`. Any arguments being search over as hyper-
-    parameters will be dropped.
+    parameters will be dropped. Parsed arguments are cached,
+    and only parsed again if they reference a nonvex environment
+    variable whose value has changed since they were last parsed.
+    Arguments that reference the trial ID change with every
+    trial, so they get parsed every time without being cached.
     """
 
+    args = tuple(args)
+    hyperparameters = tuple(hyperparameters)
+    env_vars = _referenced_env_vars(args)
+    if "NV_TRIAL_ID" in env_vars:
+        return _parse_fn_kwargs(fn, args, hyperparameters)
+
+    env = tuple([os.environ.get(i) for i in env_vars])
+    return dict(_cached_fn_kwargs(fn, args, hyperparameters, env))
+
+
+@lru_cache(maxsize=16)
+def _cached_fn_kwargs(
+    fn: Callable,
+    args: Tuple[str, ...],
+    hyperparameters: Tuple[str, ...],
+    env: Tuple[Optional[str], ...],
+) -> Dict:
+    # `env` is only here to be part of the cache key
+    return _parse_fn_kwargs(fn, args, hyperparameters)
+
+
+def _parse_fn_kwargs(
+    fn: Callable, args: Tuple[str, ...], hyperparameters: Tuple[str, ...]
+) -> Dict:
+
     # rather than ignore hyperparameters altogether,
     # we want to keep them in the signature so that
     # if they're contained in e.g. a typeo config,
@@ -87,8 +169,15 @@ def read_fn_kwargs(
     # parse the command line arguments with typeo and then
     # pop out any hyperparameters that may have been
     # in there because e.g. they were in a typeo config
-    sys.argv = [None] + args
-    kwargs = typeo(spoof_fn)()
+    # typeo will only parse from `sys.argv`, so swap our args
+    # in for as short a time as possible, and make sure only
+    # one thread does so at once
+    with _argv_lock:
+        argv, sys.argv = sys.argv, [None] + list(args)
+        try:
+            kwargs = typeo(spoof_fn)()
+        finally:
+            sys.argv = argv
     for hp in hyperparameters:
         try:
             kwargs.pop(hp)
@@ -99,12 +188,194 @@ def read_fn_kwargs(
     return kwargs
 
 
+def _get_trial_kwargs(
+    fn: Callable, args: List[str], hyperparameters: Dict, trial_id: str
+) -> Dict:
+    # set the trial ID before parsing in case
+    # the arguments reference it
+    os.environ["NV_TRIAL_ID"] = trial_id
+    kwargs = read_fn_kwargs(fn, args, hyperparameters)
+    kwargs.update(hyperparameters)
+    return kwargs
+
+
+def _run_trial(
+    fn: Callable, args: List[str], hyperparameters: Dict, trial_id: str
+):
+    return fn(**_get_trial_kwargs(fn, args, hyperparameters, trial_id))
+
+
+def _run_batches(
+    client: NonvexClient, run_trial: Callable, num_trials: int
+) -> List[Dict[str, float]]:
+    results = []
+    trials = client.start_batch(num_trials)
+    client.start_heartbeat()
+    while trials:
+        # run each trial in the batch one after the other,
+        # then report them all back to the server at once
+        batch_results, failed = {}, []
+        for hyperparameters, trial_id in trials:
+            try:
+                with reporting_to(partial(client.report, trial_id)):
+                    result = run_trial(hyperparameters, trial_id)
+            except TrialStopped:
+                # the trial isn't ours anymore, so it
+                # neither completed nor failed on us
+                continue
+            except Exception as e:
+                failed.append(trial_id)
+                error = e
+                continue
+            batch_results[trial_id] = result
+
+        results.extend(batch_results.values())
+        trials = client.end_batch(batch_results, failed, num_trials)
+        if not trials and failed:
+            raise error
+    return results
+
+
+def _run_single(
+    client: NonvexClient, run_trial: Callable
+) -> List[Dict[str, float]]:
+    hyperparameters, trial_id = client.start_worker()
+
+    # keep our lease on trials alive in the background
+    # while the training function is running
+    client.start_heartbeat()
+    results = []
+    try:
+        while trial_id is not None:
+            try:
+                with reporting_to(partial(client.report, trial_id)):
+                    result = run_trial(hyperparameters, trial_id)
+            except TrialStopped:
+                # someone else finished the trial or took it
+                # over, so move on without cancelling it
+                hyperparameters, trial_id = client.start_worker()
+                continue
+            except Exception:
+                hyperparameters, trial_id = client.cancel_trial(trial_id)
+                if trial_id is None:
+                    raise
+                continue
+
+            results.append(result)
+            hyperparameters, trial_id = client.end_trial(trial_id, result)
+    finally:
+        client.stop_heartbeat()
+    return results
+
+
+def _search(
+    client: NonvexClient,
+    executable: str,
+    num_trials: int,
+    args: List[str],
+    isolate: bool,
+) -> List[Dict[str, float]]:
+    os.environ["NV_WORKER_ID"] = client.worker_id
+    client.get_hyperparameters()
+
+    if isolate:
+        # trials in their own processes can't find out that they
+        # should stop by reporting metrics, so kill them instead
+        executor = ForkExecutor(executable, args)
+        run_trial = partial(executor.run, stop=client.should_stop)
+    else:
+        fn = get_train_fn(executable)
+        run_trial = partial(_run_trial, fn, args)
+
+    try:
+        if num_trials > 1:
+            try:
+                return _run_batches(client, run_trial, num_trials)
+            finally:
+                client.stop_heartbeat()
+        return _run_single(client, run_trial)
+    finally:
+        if isolate:
+            executor.close()
+
+
+def _run_local_worker(conn, device_env, device, **kwargs):
+    if device is not None:
+        os.environ[device_env] = device
+    try:
+        response = ("ok", run_search(**kwargs))
+    except BaseException:
+        response = ("error", traceback.format_exc())
+    conn.send(response)
+    conn.close()
+
+
+def _run_local_workers(
+    num_workers: int,
+    worker_id: str,
+    devices: Optional[List[str]],
+    device_env: str,
+    **kwargs,
+) -> List[Dict[str, float]]:
+    # spawn rather than fork so that environment variables
+    # used for device pinning get set before anything
+    # that reads them, e.g. TensorFlow, gets imported
+    ctx = mp.get_context("spawn")
+    workers = []
+    try:
+        for i in range(num_workers):
+            device = devices[i % len(devices)] if devices else None
+            conn, child_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(
+                target=_run_local_worker,
+                args=(child_conn, device_env, device),
+                kwargs=dict(worker_id=f"{worker_id}-{i}", **kwargs),
+            )
+            process.start()
+            child_conn.close()
+            workers.append((process, conn))
+
+        results, errors = [], []
+        for i, (process, conn) in enumerate(workers):
+            try:
+                status, response = conn.recv()
+            except EOFError:
+                status = "error"
+                response = f"Process exited with code {process.exitcode}\n"
+            process.join()
+
+            if status == "ok":
+                results.extend(response)
+            else:
+                errors.append(f"Worker {worker_id}-{i}: {response}")
+    finally:
+        for process, _ in workers:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    if errors:
+        raise RuntimeError(
+            "{} of {} local workers failed:\n{}".format(
+                len(errors), num_workers, "\n".join(errors)
+            )
+        )
+    return results
+
+
 def run_search(
     executable: str,
     url: str = "http://localhost:5000",
     worker_id: Optional[str] = None,
     max_fails: int = 5,
+    num_trials: int = 1,
     args: Optional[List[str]] = None,
+    isolate: bool = False,
+    num_workers: int = 1,
+    devices: Optional[List[str]] = None,
+    device_env: str = "CUDA_VISIBLE_DEVICES",
+    study: Optional[str] = None,
+    capacity: Optional[float] = None,
 ) -> List[Dict[str, float]]:
     """Run a hyperparameter search over a training function
 
@@ -116,33 +387,175 @@ def run_search(
         worker_id:
             A unique ID to assign to this worker. If left as `None`,
             a random hex value will be assigned
+        num_trials:
+            The number of trials to request from the server
+            at once. Trials in a batch are run one after the
+            other, and their results are reported together
         args:
             Any command line arguments to pass to `executable`
+        isolate:
+            Whether to run each trial in its own process, so
+            that state leaked by one trial can't affect the
+            next and a trial which crashes the interpreter is
+            cancelled rather than killing the worker. Trial
+            processes are forked from a template process which
+            has already imported `executable`, so they don't
+            pay its import cost again. Since they can't report
+            metrics, trial processes get killed instead once
+            heartbeats find the trial isn't this worker's
+            anymore, e.g. because another worker finished a
+            copy of it first
+        num_workers:
+            The number of workers to run in parallel on this
+            machine, each in its own process. Workers are
+            assigned IDs `<worker_id>-<i>`, and the results
+            of all of their trials are returned together
+        devices:
+            Devices to pin local workers to. Each worker
+            gets assigned one device from this list, going
+            around it in order if there are more workers than
+            devices. If left as `None`, workers won't be pinned
+        device_env:
+            The environment variable used to pin workers
+            to their devices
+        study:
+            The name of the study to run trials for, if the
+            server is hosting many studies at once
+        capacity:
+            How much work each worker can do relative to
+            other workers, for servers scheduling trials by
+            cost. If left as `None`, workers count as having
+            a capacity of 1
     """
 
-    client = NonvexClient(url, worker_id)
-    os.environ["NV_WORKER_ID"] = client.worker_id
-    hyperparameters = client.get_hyperparameters()
+    client = NonvexClient(url, worker_id, study=study, capacity=capacity)
+    if num_workers > 1:
+        # make sure we can reach the server before
+        # going to the trouble of starting workers
+        client.get_hyperparameters()
+        return _run_local_workers(
+            num_workers,
+            client.worker_id,
+            devices,
+            device_env,
+            executable=executable,
+            url=url,
+            max_fails=max_fails,
+            num_trials=num_trials,
+            args=args,
+            isolate=isolate,
+            study=study,
+            capacity=capacity,
+        )
+    try:
+        return _search(client, executable, num_trials, args or [], isolate)
+    finally:
+        client.close()
 
-    fn = get_train_fn(executable)
-    hyperparameters, trial_id = client.start_worker()
+
+async def _run_async_worker(
+    client: AsyncNonvexClient, fn: Callable, args: List[str]
+) -> List[Dict[str, float]]:
+    hyperparameters, trial_id = await client.start_worker()
+    client.start_heartbeat()
     results = []
-    while trial_id is not None:
-        # do command line argument parsing inside of the
-        # loop in case we reference any nonvex environment
-        # variables in the arguments
-        os.environ["NV_TRIAL_ID"] = trial_id
-        kwargs = read_fn_kwargs(fn, args or [], hyperparameters)
-        kwargs.update(hyperparameters)
+    try:
+        while trial_id is not None:
+            try:
+                # other workers on the event loop share our
+                # environment, so only count on nonvex environment
+                # variables being right while arguments are parsed
+                os.environ["NV_WORKER_ID"] = client.worker_id
+                kwargs = _get_trial_kwargs(fn, args, hyperparameters, trial_id)
+                with reporting_to(partial(client.report, trial_id)):
+                    result = await fn(**kwargs)
+            except Exception:
+                hyperparameters, trial_id = await client.cancel_trial(trial_id)
+                if trial_id is None:
+                    raise
+                continue
+
+            results.append(result)
+            hyperparameters, trial_id = await client.end_trial(
+                trial_id, result
+            )
+    finally:
+        client.stop_heartbeat()
+    return results
 
-        try:
-            result = fn(**kwargs)
-        except Exception:
-            hyperparameters, trial_id = client.cancel_trial()
-            if trial_id is None:
-                raise
-            continue
 
-        results.append(result)
-        hyperparameters, trial_id = client.end_trial(trial_id, result)
+async def run_async_search(
+    executable: str,
+    url: str = "http://localhost:5000",
+    worker_id: Optional[str] = None,
+    num_concurrent: int = 8,
+    args: Optional[List[str]] = None,
+    study: Optional[str] = None,
+) -> List[Dict[str, float]]:
+    """Run a hyperparameter search over a coroutine training function
+
+    Runs up to `num_concurrent` trials at once on the running
+    event loop, for training functions which spend most of
+    their time waiting on something else, e.g. jobs submitted
+    to a simulator or an inference server. Each concurrent
+    trial is run by its own worker, with ID `<worker_id>-<i>`,
+    so the total number of trials running at once is still
+    limited by the server's `max_parallel_workers`.
+
+    Args:
+        executable:
+            The coroutine training function to search over
+        url:
+            The URL of the hyperparameter server
+        worker_id:
+            A unique ID to use as the prefix for the IDs of
+            each worker. If left as `None`, a random hex
+            value will be used
+        num_concurrent:
+            The maximum number of trials to run at once
+        args:
+            Any command line arguments to pass to `executable`
+        study:
+            The name of the study to run trials for, if the
+            server is hosting many studies at once
+    """
+
+    fn = get_train_fn(executable)
+    if not inspect.iscoroutinefunction(fn):
+        raise ValueError(
+            "Training function {} is not a coroutine function, "
+            "use run_search instead".format(executable)
+        )
+    args = args or []
+
+    # give every worker its own thread to make requests in
+    # so that workers waiting in line for a slot at the
+    # server don't hold up workers that already have one
+    executor = ThreadPoolExecutor(num_concurrent)
+    clients = []
+    try:
+        client = AsyncNonvexClient(url, worker_id, executor, study=study)
+        clients.append(client)
+        await client.get_hyperparameters()
+
+        for i in range(num_concurrent):
+            clients.append(
+                AsyncNonvexClient(
+                    url, f"{client.worker_id}-{i}", executor, study=study
+                )
+            )
+        responses = await asyncio.gather(
+            *[_run_async_worker(i, fn, args) for i in clients[1:]],
+            return_exceptions=True,
+        )
+    finally:
+        for client in clients:
+            client.close()
+        executor.shutdown()
+
+    results = []
+    for response in responses:
+        if isinstance(response, BaseException):
+            raise response
+        results.extend(response)
     return results
@@ -66,4 +66,5 @@ def app(
         project_name=project_name,
         max_parallel_workers=max_parallel_workers,
     )
-    return app
+    yield app
+    app.extensions["nonvex"].close()
@@ -1,4 +1,19 @@
+import json
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
 from string import ascii_lowercase
+from threading import Thread
+
+import keras_tuner as kt
+import pytest
+import requests
+
+from nonvex.app import Searcher, create_app, create_study_app, run_server
+from nonvex.app.history import TrialHistory
+from nonvex.app.sampler import VectorizedRandomSearch
+from nonvex.app.storage import SQLiteStorage
 
 
 def validate_hyperparameters(response):
@@ -24,13 +39,14 @@ def test_app(
     assert hp_names == ["learning_rate", "batch_size"]
 
     # create one too many workers to make sure
-    # that the last one gets rejected
+    # that the last one gets told to come back later
     worker_ids = ascii_lowercase[: max_parallel_workers + 1]
     for worker_id in worker_ids:
         response = client.get(f"{url}/start/{worker_id}")
 
         if worker_id == worker_ids[-1]:
-            assert response.status == "400 BAD REQUEST"
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
         else:
             # make sure the response has all the appropriate info
             validate_hyperparameters(response)
@@ -54,3 +70,1066 @@ def test_app(
         else:
             validate_hyperparameters(response)
             assert trial_id != ""
+
+
+@pytest.mark.parametrize("max_trials,max_parallel_workers", [(100, 16)])
+def test_app_concurrent(app, max_trials, max_parallel_workers):
+    """Hammer the app from many threads to check for races"""
+
+    def run_worker(worker_id):
+        client = app.test_client()
+        response = client.get(f"/start/{worker_id}")
+        assert response.status_code == 200
+
+        # cancel the first trial for each worker so that we
+        # have cancellations racing with starts and ends too
+        cancelled = response.get_json()["id"]
+        response = client.get(f"/cancel/{worker_id}")
+        trial_id = response.get_json()["id"]
+
+        completed = []
+        while trial_id != "":
+            completed.append(trial_id)
+            response = client.get(
+                f"/end/{trial_id}",
+                query_string={"val_loss": 0.1, "worker_id": worker_id},
+            )
+            assert response.status_code == 200
+            trial_id = response.get_json()["id"]
+        return cancelled, completed
+
+    worker_ids = [f"worker-{i}" for i in range(max_parallel_workers)]
+    with ThreadPoolExecutor(max_parallel_workers) as ex:
+        results = list(ex.map(run_worker, worker_ids))
+
+    # every trial in the budget should have been run
+    # exactly once, and no cancelled trial should ever
+    # get handed out again
+    cancelled = [i for i, _ in results]
+    completed = [j for _, i in results for j in i]
+    assert len(completed) == max_trials
+    assert len(set(completed)) == max_trials
+    assert len(set(cancelled)) == max_parallel_workers
+    assert not set(cancelled) & set(completed)
+
+
+def test_trial_buffer(objective, output_dir, project_name):
+    searcher = Searcher(
+        objective=objective,
+        max_trials=3,
+        output_dir=output_dir,
+        project_name=project_name,
+        trial_buffer_size=5,
+    )
+
+    # wait for the background thread to run out of
+    # trials, then make sure it didn't create more
+    # than the trial budget allows or mark any as ongoing
+    buffer = searcher.buffer
+    while not buffer._exhausted:
+        time.sleep(0.01)
+    assert len(buffer._trials) == 3
+    assert len(searcher.oracle.trials) == 3
+    assert len(searcher.oracle.ongoing_trials) == 0
+
+    # handing out the buffered trials should preserve
+    # their order, then signal the end of the search
+    for trial_id in ["0", "1", "2"]:
+        assert buffer.get().trial_id == trial_id
+    assert buffer.get() is None
+    searcher.close()
+
+
+def test_vectorized_sampler(objective, output_dir):
+    hyperparameters = kt.HyperParameters()
+    hyperparameters.Choice("batch_size", [32, 64, 128])
+    hyperparameters.Boolean("batch_norm")
+    hyperparameters.Int("num_layers", 1, 5, step=2)
+    hyperparameters.Fixed("activation", "relu")
+    oracle = VectorizedRandomSearch(
+        objective=objective,
+        max_trials=100,
+        hyperparameters=hyperparameters,
+        num_candidates=8,
+    )
+    oracle._set_project_dir(output_dir, "sampler-test", overwrite=True)
+
+    # pretend a config was already tried, e.g. because it
+    # was restored from a journal, and make sure it's skipped
+    tried = {
+        "batch_size": 64,
+        "batch_norm": True,
+        "num_layers": 3,
+        "activation": "relu",
+    }
+    oracle._tried_so_far.add(oracle._compute_values_hash(tried))
+
+    # every other config in the space should get
+    # handed out once, then the search should stop
+    configs = []
+    while True:
+        trial = oracle.create_trial("worker")
+        oracle.ongoing_trials.pop("worker", None)
+        if trial.status != kt.engine.trial.TrialStatus.RUNNING:
+            break
+        configs.append(trial.hyperparameters.values)
+
+    keys = set([tuple(sorted(i.items())) for i in configs])
+    assert len(configs) == len(keys) == 3 * 2 * 3 - 1
+    assert tuple(sorted(tried.items())) not in keys
+    for config in configs:
+        assert config["num_layers"] in [1, 3, 5]
+        assert config["activation"] == "relu"
+
+    # continuous values should be spread out
+    # according to how they're sampled
+    hyperparameters = kt.HyperParameters()
+    hyperparameters.Float("learning_rate", 1e-6, 1e-2, sampling="log")
+    oracle = VectorizedRandomSearch(
+        objective=objective,
+        hyperparameters=hyperparameters,
+        num_candidates=10000,
+        seed=0,
+    )
+    values = [i[0] for i in oracle._draw(hyperparameters.space)]
+    assert all([1e-6 <= i <= 1e-2 for i in values])
+    num_small = len([i for i in values if i < 1e-4])
+    assert 4500 < num_small < 5500
+
+
+def test_trial_history():
+    hyperparameters = kt.HyperParameters()
+    hyperparameters.Float("learning_rate", 1e-4, 1e-2)
+    hyperparameters.Choice("optimizer", ["adam", "sgd"])
+    hyperparameters.Boolean("batch_norm")
+
+    # add more trials than there's initially room for
+    history = TrialHistory(hyperparameters, "max", capacity=4)
+    for i in range(10):
+        values = {
+            "learning_rate": 1e-4 * (i + 1),
+            "optimizer": ["adam", "sgd"][i % 2],
+            "batch_norm": i < 5,
+        }
+        history.add(str(i), values, float(i))
+    assert len(history) == 10
+
+    top = history.top(3)
+    assert [i["id"] for i in top] == ["9", "8", "7"]
+    assert top[0]["hyperparameters"] == {
+        "learning_rate": 1e-3,
+        "optimizer": "sgd",
+        "batch_norm": False,
+    }
+
+    summary = history.summary()
+    assert summary["count"] == 10
+    assert summary["best"] == 9 and summary["worst"] == 0
+    assert summary["mean"] == 4.5
+
+    trials = history.filter({"optimizer": "adam", "batch_norm": "true"})
+    assert [i["id"] for i in trials] == ["4", "2", "0"]
+    trials = history.filter({"learning_rate__lt": "5.5e-4"}, k=2)
+    assert [i["id"] for i in trials] == ["4", "3"]
+    assert history.filter({"optimizer": "rmsprop"}) == []
+    with pytest.raises(ValueError):
+        history.filter({"optimizer__in": "adam"})
+
+
+def test_app_worker_failures(client):
+    # starting over, e.g. after being turned away, shouldn't
+    # let a worker get around the limit on failed trials
+    client.get("/start/a")
+    for _ in range(4):
+        assert client.get("/cancel/a").get_json()["id"] != ""
+    client.get("/start/a")
+    assert client.get("/cancel/a").get_json()["id"] == ""
+    assert client.get("/start/a").get_json()["id"] == ""
+    assert client.get("/start/b").get_json()["id"] != ""
+
+
+def test_app_trial_queries(client, max_trials):
+    response = client.get("/start/a")
+    while response.get_json()["id"] != "":
+        trial = response.get_json()
+        response = client.get(
+            f"/end/{trial['id']}",
+            query_string={
+                "val_loss": trial["hyperparameters"]["learning_rate"],
+                "worker_id": "a",
+            },
+        )
+
+    summary = client.get("/trials/summary").get_json()
+    assert summary["count"] == max_trials
+
+    trials = client.get("/trials/top", query_string={"k": 3}).get_json()
+    trials = trials["trials"]
+    assert len(trials) == 3
+    assert trials[0]["score"] == summary["best"]
+    for trial in trials:
+        assert trial["score"] == trial["hyperparameters"]["learning_rate"]
+    assert trials == sorted(trials, key=lambda i: i["score"])
+
+    response = client.get("/trials", query_string={"batch_size": 64})
+    for trial in response.get_json()["trials"]:
+        assert trial["hyperparameters"]["batch_size"] == 64
+    response = client.get("/trials", query_string={"dropout": 0.1})
+    assert response.status_code == 400
+
+
+def test_app_metrics(objective, max_trials, output_dir, project_name):
+    app = create_app(
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name=project_name,
+        max_parallel_workers=2,
+        lease_timeout=10,
+    )
+    client = app.test_client()
+
+    trial_id = client.get("/start/a").get_json()["id"]
+    query = {"val_loss": 0.1, "worker_id": "a"}
+    client.get(f"/end/{trial_id}", query_string=query)
+    client.get("/cancel/a")
+    trial_id = client.get("/start/b").get_json()["id"]
+    assert client.get("/start/c").status_code == 503
+
+    snapshot = client.get("/metrics/json").get_json()
+    assert snapshot["nonvex_ongoing_trials"][0]["value"] == 2
+    assert snapshot["nonvex_completed_trials"][0]["value"] == 1
+    assert snapshot["nonvex_rejections_total"][0]["value"] == 1
+
+    outcomes = {
+        (i["labels"]["outcome"], i["labels"]["worker_id"]): i["value"]
+        for i in snapshot["nonvex_trials_total"]
+    }
+    assert outcomes == {("completed", "a"): 1, ("failed", "a"): 1}
+    failures = {
+        i["labels"]["worker_id"]: i["value"]
+        for i in snapshot["nonvex_worker_failures"]
+    }
+    assert failures == {"a": 1, "b": 0}
+
+    ages = snapshot["nonvex_lease_age_seconds"]
+    assert {i["labels"]["worker_id"] for i in ages} == {"a", "b"}
+    assert all(0 <= i["value"] < 10 for i in ages)
+
+    # requests should be labelled by route, not by path
+    latencies = {
+        i["labels"]["route"]: i
+        for i in snapshot["nonvex_request_duration_seconds"]
+    }
+    assert latencies["/start/<worker_id>"]["count"] == 3
+    assert latencies["/start/<worker_id>"]["buckets"]["+Inf"] == 3
+
+    response = client.get("/metrics")
+    assert response.content_type.startswith("text/plain")
+    lines = response.get_data(as_text=True).splitlines()
+    assert "# TYPE nonvex_request_duration_seconds histogram" in lines
+    assert "nonvex_ongoing_trials 2" in lines
+    assert (
+        'nonvex_request_duration_seconds_count{route="/start/<worker_id>"} 3'
+        in lines
+    )
+    assert (
+        'nonvex_responses_total{route="/start/<worker_id>",status="503"} 1'
+        in lines
+    )
+
+
+def test_app_studies(objective, output_dir):
+    app = create_study_app(os.path.join(output_dir, "studies"), 0)
+    client = app.test_client()
+
+    hyperparameters = kt.HyperParameters()
+    hyperparameters.Choice("units", [16, 32, 64])
+    spec = {
+        "objective": objective,
+        "max_trials": 3,
+        "hyperparameters": hyperparameters.get_config(),
+    }
+    assert client.put("/studies/a", json=spec).status_code == 201
+    assert client.put("/studies/a", json=spec).status_code == 200
+    conflict = dict(spec, max_trials=4)
+    assert client.put("/studies/a", json=conflict).status_code == 409
+    assert client.put("/studies/.a", json=spec).status_code == 400
+    invalid = dict(spec, objective_name="loss")
+    assert client.put("/studies/b", json=invalid).status_code == 400
+
+    # studies need a search space of their own rather
+    # than falling back to the one in `nonvex-hp.py`
+    missing = {k: v for k, v in spec.items() if k != "hyperparameters"}
+    assert client.put("/studies/b", json=missing).status_code == 400
+
+    # specs shouldn't be able to point the server at any files
+    for option in ["storage", "replica_id", "warm_start"]:
+        unsafe = dict(spec, **{option: "/etc/passwd"})
+        assert client.put("/studies/b", json=unsafe).status_code == 400
+
+    hyperparameters.Float("dropout", 0, 0.5)
+    spec["hyperparameters"] = hyperparameters.get_config()
+    assert client.put("/studies/b", json=spec).status_code == 201
+
+    response = client.get("/studies/a/hyperparameters")
+    assert response.get_json()["hyperparameters"] == ["units"]
+    response = client.get("/studies/b/hyperparameters")
+    assert response.get_json()["hyperparameters"] == ["units", "dropout"]
+    assert client.get("/studies/c/start/x").status_code == 404
+
+    response = client.get("/studies/a/start/x")
+    while response.get_json()["id"] != "":
+        trial = response.get_json()
+        query = {"val_loss": trial["hyperparameters"]["units"]}
+        response = client.get(
+            f"/studies/a/end/{trial['id']}",
+            query_string=dict(query, worker_id="x"),
+        )
+    summary = client.get("/studies/a/trials/summary").get_json()
+    assert summary["count"] == 3
+
+    # studies that have never had a request made
+    # to them should be able to get evicted too
+    assert client.put("/studies/c", json=spec).status_code == 201
+
+    # idle studies should get moved out of memory, then
+    # picked back up from disk the next time they're used
+    manager = app.extensions["nonvex"]
+    manager.evict_idle()
+    assert client.get("/studies").get_json() == {
+        "studies": ["a", "b", "c"],
+        "loaded": [],
+    }
+    summary = client.get("/studies/a/trials/summary").get_json()
+    assert summary["count"] == 3
+    assert client.get("/studies").get_json()["loaded"] == ["a"]
+    manager.close()
+
+
+def test_app_studies_eviction(objective, output_dir):
+    app = create_study_app(os.path.join(output_dir, "evictions"), 0)
+    client = app.test_client()
+    manager = app.extensions["nonvex"]
+
+    hyperparameters = kt.HyperParameters()
+    hyperparameters.Choice("units", [16, 32, 64])
+    spec = {
+        "objective": objective,
+        "max_trials": 3,
+        "hyperparameters": hyperparameters.get_config(),
+    }
+    hyperband = dict(
+        spec, oracle_type="hyperband", oracle_options={"max_epochs": 9.0}
+    )
+    cost_aware = dict(spec, max_trials=1, cost_aware=True)
+    assert client.put("/studies/hyperband", json=hyperband).status_code == 201
+    assert client.put("/studies/costs", json=cost_aware).status_code == 201
+
+    query = {"capacity": 2}
+    response = client.get("/studies/costs/start/a", query_string=query)
+    trial_id = response.get_json()["id"]
+    query = {objective: 0.1, "worker_id": "a"}
+    client.get(f"/studies/costs/end/{trial_id}", query_string=query)
+
+    # Hyperband studies can't be picked back up from disk
+    # where they left off, so they should stay in memory,
+    # while cost-aware ones should come back knowing what
+    # they'd learned about how long trials take
+    manager.evict_idle()
+    assert client.get("/studies").get_json()["loaded"] == ["hyperband"]
+    assert client.get("/studies/costs/trials/summary").status_code == 200
+    searcher = manager._studies["costs"]
+    assert len(searcher.runtimes) == 1
+    assert searcher.mean_duration is not None
+    assert searcher.capacities == {"a": 2}
+    manager.close()
+
+
+def test_app_leases(objective, max_trials, output_dir, project_name):
+    app = create_app(
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name=project_name,
+        max_parallel_workers=1,
+        lease_timeout=0.2,
+    )
+    client = app.test_client()
+
+    response = client.get("/start/a")
+    assert response.get_json()["lease"] == 0.2
+    trial_id = response.get_json()["id"]
+    assert client.get("/start/b").status_code == 503
+
+    # let the lease on worker a's trial expire without any
+    # heartbeats, which should free its slot and put its
+    # trial back in the queue for worker b to pick up
+    time.sleep(0.5)
+    assert client.get("/heartbeat/a").get_json()["id"] == ""
+    response = client.get("/start/b")
+    assert response.get_json()["id"] == trial_id
+    assert client.get("/heartbeat/b").get_json()["id"] == trial_id
+
+    # if worker a comes back and finishes the trial first,
+    # its result should be taken and worker b's dropped
+    query = {"val_loss": 0.1, "worker_id": "a"}
+    response = client.get(f"/end/{trial_id}", query_string=query)
+    assert response.get_json()["id"] not in ("", trial_id)
+    assert client.get("/heartbeat/b").get_json()["id"] == ""
+
+    # worker a has taken the only slot with its new trial,
+    # so worker b should be told to wait for one rather
+    # than getting a trial on top of it
+    query = {"val_loss": 0.2, "worker_id": "b"}
+    response = client.get(f"/end/{trial_id}", query_string=query)
+    assert response.status_code == 503
+    assert len(app.extensions["nonvex"].oracle.ongoing_trials) == 1
+    app.extensions["nonvex"].close()
+
+
+def test_app_replicas(objective, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    storage = os.path.join(output_dir, "replicas.db")
+    apps = [
+        create_app(
+            objective=objective,
+            max_trials=30,
+            output_dir=output_dir,
+            project_name="replicas",
+            max_parallel_workers=4,
+            storage=storage,
+            replica_id=str(i),
+        )
+        for i in range(2)
+    ]
+    clients = [app.test_client() for app in apps]
+
+    # slots are shared, so workers shouldn't be able to get
+    # around the limit on trials by going to another replica
+    trials = []
+    for i in range(4):
+        response = clients[i % 2].get(f"/start/{i}")
+        trials.append(response.get_json())
+    assert clients[0].get("/start/x").status_code == 503
+    assert clients[1].get("/start/x").status_code == 503
+
+    def run_worker(worker_id, trial=None):
+        if trial is None:
+            query = {"wait": 10}
+            trial = clients[0].get(f"/start/{worker_id}", query_string=query)
+            trial = trial.get_json()
+
+        # bounce between replicas, and fail the
+        # first trial to check that failures add
+        # to the trial budget on both replicas
+        seen = []
+        while trial["id"] != "":
+            seen.append(trial)
+            client = clients[len(seen) % 2]
+            if len(seen) == 1:
+                query = {"trial_id": trial["id"]}
+                response = client.get(
+                    f"/cancel/{worker_id}", query_string=query
+                )
+            else:
+                query = {"val_loss": len(seen), "worker_id": worker_id}
+                response = client.get(
+                    f"/end/{trial['id']}", query_string=query
+                )
+            trial = response.get_json()
+        return seen
+
+    with ThreadPoolExecutor(6) as executor:
+        futures = [
+            executor.submit(run_worker, str(i), trial)
+            for i, trial in enumerate(trials)
+        ]
+        futures += [executor.submit(run_worker, str(i)) for i in range(4, 6)]
+        seen = sum([future.result() for future in futures], [])
+
+    # no trial or config should have been handed out twice
+    trial_ids = [trial["id"] for trial in seen]
+    assert len(set(trial_ids)) == len(trial_ids)
+    configs = {tuple(trial["hyperparameters"].values()) for trial in seen}
+    assert len(configs) == len(seen)
+
+    num_failed = sum([len(future.result()) > 0 for future in futures])
+    assert len(seen) == 30 + num_failed
+    for client in clients:
+        summary = client.get("/trials/summary").get_json()
+        assert summary["count"] == 30
+    for app in apps:
+        app.extensions["nonvex"].close()
+
+
+def test_app_replicas_admission_limit(objective, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    app = create_app(
+        objective=objective,
+        max_trials=1,
+        output_dir=output_dir,
+        project_name="polling",
+        max_parallel_workers=1,
+        max_waiting_workers=1,
+        storage=os.path.join(output_dir, "polling.db"),
+    )
+    searcher = app.extensions["nonvex"]
+    client = app.test_client()
+    trial_id = client.get("/start/a").get_json()["id"]
+
+    def start(worker_id):
+        query = {"wait": 10}
+        return app.test_client().get(f"/start/{worker_id}", query_string=query)
+
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(start, "b")
+        deadline = time.time() + 5
+        while searcher.waiting.acquire(blocking=False):
+            searcher.waiting.release()
+            assert time.time() < deadline
+            time.sleep(0.01)
+
+        # worker b is polling for a slot, which takes
+        # up the only spot for workers to wait in
+        start_time = time.time()
+        assert start("c").status_code == 503
+        assert time.time() - start_time < 5
+
+        query = {"val_loss": 1, "worker_id": "a"}
+        client.get(f"/end/{trial_id}", query_string=query)
+        assert future.result().get_json()["id"] == ""
+    searcher.close()
+
+
+def test_app_replicas_reads(objective, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    kwargs = dict(
+        objective=objective,
+        max_trials=2,
+        output_dir=output_dir,
+        project_name="reads",
+        max_parallel_workers=2,
+        storage=os.path.join(output_dir, "reads.db"),
+    )
+    with pytest.raises(ValueError):
+        create_app(cost_aware=True, **kwargs)
+
+    app = create_app(**kwargs)
+    client = app.test_client()
+    trial_id = client.get("/start/a").get_json()["id"]
+
+    # requests that only read shouldn't have to wait
+    # while another replica holds the write lock
+    other = SQLiteStorage(kwargs["storage"])
+    with other.transaction():
+        start_time = time.time()
+        assert client.get("/ongoing/a").get_json()["id"] == trial_id
+        assert client.get("/trials/summary").get_json()["count"] == 0
+        assert client.get("/metrics").status_code == 200
+        assert time.time() - start_time < 5
+    other.close()
+    app.extensions["nonvex"].close()
+
+
+def test_app_batch(client, max_trials, max_parallel_workers):
+    # max_parallel_workers should count trials rather
+    # than workers, so a worker asking for more trials
+    # than there's room for should only get what's left
+    response = client.get("/start/a", query_string={"num_trials": 3})
+    trials = response.get_json()["trials"]
+    assert len(trials) == 3
+    for trial in trials:
+        assert 5e-6 <= trial["hyperparameters"]["learning_rate"] <= 5e-4
+
+    response = client.get("/start/b", query_string={"num_trials": 3})
+    assert len(response.get_json()["trials"]) == max_parallel_workers - 3
+    response = client.get("/start/c", query_string={"num_trials": 3})
+    assert response.status_code == 503
+
+    # report two successes and a failure at once, and
+    # make sure that the worker gets a full new batch
+    trial_ids = [i["id"] for i in trials]
+    response = client.post(
+        "/batch/a",
+        json={
+            "results": {i: {"val_loss": 0.1} for i in trial_ids[:2]},
+            "failed": trial_ids[2:],
+            "num_trials": 3,
+        },
+    )
+    new_ids = [i["id"] for i in response.get_json()["trials"]]
+    assert len(new_ids) == 3
+    assert not set(new_ids) & set(trial_ids)
+
+    response = client.get("/heartbeat/a")
+    assert response.get_json()["ids"] == new_ids
+
+    # keep reporting until we run out of trials, which
+    # should happen after max_trials successes since
+    # the failed trial doesn't count towards the budget
+    num_completed = 2
+    while new_ids:
+        response = client.post(
+            "/batch/a",
+            json={
+                "results": {i: {"val_loss": 0.1} for i in new_ids},
+                "failed": [],
+                "num_trials": 3,
+            },
+        )
+        num_completed += len(new_ids)
+        new_ids = [i["id"] for i in response.get_json()["trials"]]
+    assert num_completed == max_trials - max_parallel_workers + 3
+
+
+def test_app_admission(objective, max_trials, output_dir, project_name):
+    app = create_app(
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name=project_name,
+        max_parallel_workers=1,
+        lease_timeout=0.2,
+    )
+    client = app.test_client()
+    trial_id = client.get("/start/a").get_json()["id"]
+
+    # worker b should be held in line until worker a's
+    # lease expires, then get handed a's trial right away
+    start_time = time.time()
+    response = client.get("/start/b", query_string={"wait": 5})
+    assert response.status_code == 200
+    assert response.get_json()["id"] == trial_id
+    assert 0.2 < time.time() - start_time < 5
+    app.extensions["nonvex"].close()
+
+
+def test_app_admission_limit(objective, output_dir, project_name):
+    app = create_app(
+        objective=objective,
+        max_trials=1,
+        output_dir=output_dir,
+        project_name=project_name,
+        max_parallel_workers=1,
+        max_waiting_workers=2,
+    )
+    searcher = app.extensions["nonvex"]
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    kwargs = {"port": port, "num_threads": 3}
+    Thread(target=run_server, args=(app,), kwargs=kwargs, daemon=True).start()
+
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(50):
+        try:
+            trial_id = requests.get(f"{url}/start/a").json()["id"]
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    def start(worker_id):
+        return requests.get(f"{url}/start/{worker_id}", params={"wait": 10})
+
+    with ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(start, i) for i in "bc"]
+        while len(searcher.admissions) < 2:
+            time.sleep(0.01)
+
+        # with the line full, other workers should get
+        # turned away rather than take up the last thread
+        start_time = time.time()
+        response = start("d")
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+
+        # which leaves it free to end worker a's trial,
+        # letting the workers in line find out the
+        # search is done without waiting it out
+        response = requests.get(
+            f"{url}/end/{trial_id}",
+            params={"val_loss": 1, "worker_id": "a"},
+        )
+        assert response.status_code == 200
+        for future in futures:
+            assert future.result().json()["id"] == ""
+        assert time.time() - start_time < 5
+    searcher.close()
+
+
+def test_app_resume(objective, max_trials, output_dir):
+    kwargs = dict(
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name="resume-test",
+        max_parallel_workers=2,
+    )
+    app = create_app(**kwargs)
+    client = app.test_client()
+
+    # run a couple trials, cancel one, then
+    # leave two hanging when the server "dies"
+    query = {"val_loss": 0.1, "worker_id": "a"}
+    trial_id = client.get("/start/a").get_json()["id"]
+    for _ in range(2):
+        response = client.get(f"/end/{trial_id}", query_string=query)
+        trial_id = response.get_json()["id"]
+    trial_id = client.get("/cancel/a").get_json()["id"]
+    other_id = client.get("/start/b").get_json()["id"]
+
+    # a resumed server should still know which
+    # trials the workers are running
+    app.extensions["nonvex"].close()
+    app = create_app(resume=True, **kwargs)
+    client = app.test_client()
+    assert client.get("/ongoing/a").get_json()["id"] == trial_id
+    assert client.get("/ongoing/b").get_json()["id"] == other_id
+    assert client.get("/start/c").status_code == 503
+
+    # the workers should be able to keep reporting, and
+    # the search should only run the remaining trials
+    completed = []
+    for worker_id, trial_id in [("a", trial_id), ("b", other_id)]:
+        while trial_id != "":
+            completed.append(trial_id)
+            response = client.get(
+                f"/end/{trial_id}",
+                query_string={"val_loss": 0.1, "worker_id": worker_id},
+            )
+            trial_id = response.get_json()["id"]
+    assert len(set(completed)) == len(completed) == max_trials - 2
+    app.extensions["nonvex"].close()
+
+
+def test_app_coalesced_writes(objective, max_trials, output_dir):
+    app = create_app(
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name="flush-test",
+        max_parallel_workers=1,
+        flush_interval=60,
+    )
+    client = app.test_client()
+    trial_id = client.get("/start/a").get_json()["id"]
+    client.get(
+        f"/end/{trial_id}", query_string={"val_loss": 0.1, "worker_id": "a"}
+    )
+
+    # the trial shouldn't get written until we flush, which
+    # should happen when the searcher gets shut down
+    fname = os.path.join(
+        output_dir, "flush-test", f"trial_{trial_id}", "trial.json"
+    )
+    assert not os.path.exists(fname)
+    app.extensions["nonvex"].close()
+    with open(fname, "r") as f:
+        trial = json.load(f)
+    assert trial["status"] == "COMPLETED"
+    assert trial["score"] == 0.1
+
+
+def test_app_early_stopping(objective, max_trials, output_dir):
+    kwargs = dict(
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name="asha-test",
+        max_parallel_workers=4,
+        grace_period=1,
+        reduction_factor=2,
+    )
+    app = create_app(**kwargs)
+    client = app.test_client()
+
+    # only the worst trial to report after the first step
+    # should be told to stop, since it's the only one
+    # outside the top half of the trials it's compared to
+    trial_ids, stops = [], []
+    for worker_id, loss in zip("abcd", [0.5, 0.3, 0.9, 0.1]):
+        trial_id = client.get(f"/start/{worker_id}").get_json()["id"]
+        response = client.post(
+            f"/report/{trial_id}",
+            json={"step": 1, "metrics": {objective: loss}},
+        )
+        trial_ids.append(trial_id)
+        stops.append(response.get_json()["stop"])
+    assert stops == [False, False, True, False]
+
+    # a resumed server should remember which trials it stopped
+    app.extensions["nonvex"].close()
+    app = create_app(resume=True, **kwargs)
+    client = app.test_client()
+    for trial_id, stop in zip(trial_ids, [False, False, True, False]):
+        response = client.post(
+            f"/report/{trial_id}",
+            json={"step": 1, "metrics": {objective: 0.2}},
+        )
+        assert response.get_json()["stop"] == stop
+
+    # and trials that are already over should always be stopped
+    client.get(
+        f"/end/{trial_ids[0]}",
+        query_string={objective: 0.5, "worker_id": "a"},
+    )
+    response = client.post(
+        f"/report/{trial_ids[0]}",
+        json={"step": 2, "metrics": {objective: 0.05}},
+    )
+    assert response.get_json()["stop"]
+    app.extensions["nonvex"].close()
+
+
+def test_app_hyperband(objective, output_dir):
+    app = create_app(
+        objective=objective,
+        max_trials=100,
+        output_dir=output_dir,
+        project_name="hyperband-test",
+        max_parallel_workers=2,
+        oracle_type="hyperband",
+        oracle_options={"max_epochs": 9.0, "factor": 3.0},
+    )
+    client = app.test_client()
+    searcher = app.extensions["nonvex"]
+    hps = client.get("/hyperparameters").get_json()["hyperparameters"]
+    assert hps[-3:] == ["epochs", "initial_epoch", "resume_trial_id"]
+
+    # Hyperband will sometimes need to wait on one worker's
+    # trial to finish before it can give the other worker
+    # anything, in which case that worker should be told to
+    # check back later rather than that the search is done
+    trials, num_rejected = {}, 0
+    responses = {i: client.get(f"/start/{i}") for i in "ab"}
+    while responses:
+        for worker_id, response in list(responses.items()):
+            if response.status_code == 503:
+                num_rejected += 1
+                responses[worker_id] = client.get(f"/start/{worker_id}")
+                continue
+
+            trial = response.get_json()
+            if trial["id"] == "":
+                responses.pop(worker_id)
+                continue
+
+            trials[trial["id"]] = hps = trial["hyperparameters"]
+            loss = hps["learning_rate"] / hps["epochs"]
+            responses[worker_id] = client.post(
+                f"/end/{trial['id']}",
+                json={"result": {objective: loss}, "worker_id": worker_id},
+            )
+    assert num_rejected > 0
+
+    # workers should only have stopped once every trial
+    # was done, and promoted trials should pick up from
+    # trials that have already finished
+    assert len(trials) == len(searcher.oracle.trials)
+    resumed = [i for i in trials.values() if i["resume_trial_id"]]
+    assert resumed
+    for hps in resumed:
+        assert hps["resume_trial_id"] in trials
+        assert 0 < hps["initial_epoch"] < hps["epochs"]
+    app.extensions["nonvex"].close()
+
+
+def test_app_bayesian(objective, max_trials, output_dir):
+    with pytest.raises(ValueError):
+        create_app(
+            objective=objective,
+            max_trials=max_trials,
+            output_dir=output_dir,
+            project_name="bayesian-test",
+            max_parallel_workers=1,
+            oracle_type="grid",
+        )
+
+    pytest.importorskip("scipy")
+    app = create_app(
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name="bayesian-test",
+        max_parallel_workers=1,
+        oracle_type="bayesian",
+        oracle_options={"num_initial_points": 2.0},
+    )
+    client = app.test_client()
+    searcher = app.extensions["nonvex"]
+    assert searcher.oracle.num_initial_points == 2
+
+    num_trials = 0
+    query = {objective: 0.1, "worker_id": "a"}
+    trial_id = client.get("/start/a").get_json()["id"]
+    while trial_id != "":
+        num_trials += 1
+        response = client.get(f"/end/{trial_id}", query_string=query)
+        trial_id = response.get_json()["id"]
+    assert num_trials == max_trials
+    app.extensions["nonvex"].close()
+
+
+def test_app_memoization(objective, output_dir):
+    # use a small, discrete search space so
+    # that configs are bound to come up again
+    with open("nonvex-hp.py", "w") as f:
+        f.write(
+            "import keras_tuner as kt\n"
+            "hyperparameters = kt.HyperParameters()\n"
+            "hyperparameters.Choice('learning_rate', [1e-3, 1e-4])\n"
+            "hyperparameters.Choice('batch_size', [32, 64, 128])\n"
+        )
+
+    def run(client):
+        trial_ids = []
+        response = client.get("/start/a")
+        while response.get_json()["id"] != "":
+            trial_id = response.get_json()["id"]
+            hps = response.get_json()["hyperparameters"]
+            result = hps["learning_rate"] * hps["batch_size"]
+            trial_ids.append(trial_id)
+            response = client.get(
+                f"/end/{trial_id}",
+                query_string={objective: result, "worker_id": "a"},
+            )
+        return trial_ids
+
+    kwargs = dict(
+        objective=objective, output_dir=output_dir, max_parallel_workers=1
+    )
+    app = create_app(max_trials=3, project_name="memo-a", **kwargs)
+    assert len(run(app.test_client())) == 3
+    app.extensions["nonvex"].close()
+
+    # a search warm started from the first one should only
+    # have to run the configs the first one didn't get to,
+    # but should still know the results of all of them
+    kwargs.update(
+        max_trials=6,
+        project_name="memo-b",
+        warm_start=os.path.join(output_dir, "memo-a"),
+    )
+    app = create_app(**kwargs)
+    trial_ids = run(app.test_client())
+    assert len(trial_ids) == 3
+
+    searcher = app.extensions["nonvex"]
+    trials = searcher.oracle.trials.values()
+    assert len(trials) == 6
+    for trial in trials:
+        hps = trial.hyperparameters.values
+        assert trial.status == "COMPLETED"
+        assert trial.score == hps["learning_rate"] * hps["batch_size"]
+    app.extensions["nonvex"].close()
+
+    # resuming should recognize that the search is done
+    app = create_app(resume=True, **kwargs)
+    assert len(run(app.test_client())) == 0
+    assert len(app.extensions["nonvex"].cache) == 6
+    app.extensions["nonvex"].close()
+
+
+def test_app_cost_aware(objective, output_dir, project_name):
+    app = create_app(
+        objective=objective,
+        max_trials=6,
+        output_dir=output_dir,
+        project_name=project_name,
+        max_parallel_workers=3,
+        trial_buffer_size=8,
+        cost_aware=True,
+    )
+    client = app.test_client()
+    searcher = app.extensions["nonvex"]
+    while not searcher.buffer._exhausted:
+        time.sleep(0.01)
+
+    # teach the server that trials take longer
+    # the smaller their batch size is
+    for batch_size in [32, 64, 128]:
+        values = {"learning_rate": 1e-4, "batch_size": batch_size}
+        searcher.runtimes.add(values, 1280 / batch_size)
+    estimates = [
+        searcher.runtimes.predict({"learning_rate": 1e-4, "batch_size": i})
+        for i in [32, 64, 128]
+    ]
+    assert estimates[0] > estimates[1] > estimates[2]
+
+    costs = {
+        trial_id: searcher.runtimes.predict(trial.hyperparameters.values)
+        for trial_id, trial in searcher.oracle.trials.items()
+    }
+
+    def start(worker_id, capacity):
+        query = {"capacity": capacity}
+        response = client.get(f"/start/{worker_id}", query_string=query)
+        trial_id = response.get_json()["id"]
+        return trial_id, costs.pop(trial_id)
+
+    # a worker on its own should get the most expensive trial,
+    # as should a worker with more capacity than the others,
+    # while one with less than all the others gets the cheapest
+    _, cost = start("a", 1)
+    assert cost >= max(costs.values())
+    trial_id, cost = start("b", 4)
+    assert cost >= max(costs.values())
+    _, cost = start("c", 0.5)
+    assert cost <= min(costs.values())
+
+    query = {objective: 0.1, "worker_id": "b"}
+    client.get(f"/end/{trial_id}", query_string=query)
+    assert len(searcher.runtimes) == 4
+    searcher.close()
+
+
+def test_app_speculation(objective, output_dir, project_name):
+    app = create_app(
+        objective=objective,
+        max_trials=3,
+        output_dir=output_dir,
+        project_name=project_name,
+        max_parallel_workers=3,
+        max_fails_per_worker=1,
+        speculate=True,
+    )
+    client = app.test_client()
+
+    def end(worker_id, trial_id, result):
+        query = {objective: result, "worker_id": worker_id}
+        response = client.get(f"/end/{trial_id}", query_string=query)
+        return response.get_json()["id"]
+
+    def report(trial_id):
+        body = {"step": 1, "metrics": {objective: 1.0}}
+        response = client.post(f"/report/{trial_id}", json=body)
+        return response.get_json()["stop"]
+
+    trial_ids = [client.get(f"/start/{i}").get_json()["id"] for i in "abc"]
+
+    # once the budget is used up, idle workers should get
+    # copies of the trials that have been running longest,
+    # one copy per trial
+    assert end("b", trial_ids[1], 0.1) == trial_ids[0]
+    assert not report(trial_ids[0])
+
+    # if the original fails, the copy should carry on with
+    # it, and it should be free to get copied again
+    query = {"trial_id": trial_ids[0]}
+    response = client.get("/cancel/a", query_string=query)
+    assert response.get_json()["id"] == ""
+    assert client.get("/ongoing/b").get_json()["id"] == trial_ids[0]
+    assert end("c", trial_ids[2], 0.1) == trial_ids[0]
+
+    # the first result should win, and
+    # the other copy should get stopped
+    assert end("c", trial_ids[0], 0.5) == ""
+    assert report(trial_ids[0])
+    assert end("b", trial_ids[0], 0.9) == ""
+
+    searcher = app.extensions["nonvex"]
+    assert searcher.oracle.trials[trial_ids[0]].score == 0.5
+    assert client.get("/trials/summary").get_json()["count"] == 3
+    searcher.close()
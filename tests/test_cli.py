@@ -0,0 +1,93 @@
+import json
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+
+import nonvex
+from nonvex.app.studies import StudyManager
+
+# importing the CLI and building the parser for search
+# workers should be quick, since workers can be short
+# lived and there may be thousands of them
+IMPORT_TIME_BUDGET = 1.0
+
+SCRIPT = """
+import json
+import sys
+import time
+
+start_time = time.perf_counter()
+sys.argv = ["nonvex", "search", "--help"]
+import nonvex
+
+try:
+    nonvex.run_cli()
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - start_time
+
+heavy = ["tensorflow", "keras_tuner", "flask"]
+heavy = [i for i in heavy if i in sys.modules]
+sys.stderr.write(json.dumps({"elapsed": elapsed, "heavy": heavy}))
+"""
+
+
+def test_search_cli_imports():
+    # run in a fresh interpreter so that modules imported
+    # by other tests don't make this look better or worse
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(result.stderr.splitlines()[-1])
+
+    assert result["heavy"] == []
+    assert result["elapsed"] < IMPORT_TIME_BUDGET
+
+
+def test_studies_cli(tmp_path, monkeypatch):
+    # make sure `studies` builds the multi-study
+    # app rather than the single search one
+    argv = ["nonvex", "studies", "--output-dir", str(tmp_path)]
+    monkeypatch.setattr(sys, "argv", argv)
+    with patch("nonvex.app.run_server", autospec=True) as run_server:
+        nonvex.run_cli()
+
+    app = run_server.call_args.args[0]
+    try:
+        assert isinstance(app.extensions["nonvex"], StudyManager)
+        assert run_server.call_args.kwargs["num_threads"] == 16
+    finally:
+        app.extensions["nonvex"].close()
+
+
+@pytest.mark.parametrize(
+    "flags,memoize", [([], True), (["--no-memoize"], False)]
+)
+def test_serve_cli_memoize(tmp_path, monkeypatch, flags, memoize):
+    # boolean flags can only turn options on, so
+    # memoization has to be turned off explicitly
+    argv = [
+        "nonvex",
+        "serve",
+        "--objective",
+        "val_loss",
+        "--max-trials",
+        "1",
+        "--output-dir",
+        str(tmp_path),
+        "--project-name",
+        "cli-test",
+        "--max-parallel-workers",
+        "1",
+    ]
+    monkeypatch.setattr(sys, "argv", argv + flags)
+    with patch("nonvex.app.run_server", autospec=True) as run_server:
+        nonvex.run_cli()
+
+    searcher = run_server.call_args.args[0].extensions["nonvex"]
+    assert searcher.memoize is memoize
@@ -1,10 +1,39 @@
+import asyncio
+import importlib
+import json
 import os
+import sys
+import time
+from threading import Thread
 from unittest.mock import Mock, patch
 
+import keras_tuner as kt
 import pytest
+import requests
 import toml
+from werkzeug.serving import make_server
 
 from nonvex import search
+from nonvex.app import create_study_app
+
+
+@pytest.fixture
+def server(client):
+    # route requests made by search clients to
+    # the test app rather than over the network
+    def request(self, method, url, params=None, json=None, timeout=None):
+        response = client.open(
+            url, method=method, query_string=params, json=json
+        )
+        mock = Mock()
+        mock.status_code = response.status_code
+        mock.headers = response.headers
+        mock.raise_for_status = lambda: None
+        mock.json = lambda: response.get_json()
+        return mock
+
+    with patch("requests.Session.request", request):
+        yield client
 
 
 @pytest.fixture
@@ -32,41 +61,358 @@ def main(
     os.remove("train.py")
 
 
-def test_search(client, max_trials):
-    def get_patch(url, params=None):
-        response = client.get(url, query_string=params)
-        mock = Mock()
-        mock.raise_for_status = lambda: None
-        mock.json = lambda: response.get_json()
-        return mock
+def test_search(server, max_trials):
+    # make sure we can parse the function from the name
+    fn = search.search.get_train_fn("train:main")
+    assert fn(1e-3, 32, 128)["val_loss"] == 1e-3
+
+    # make sure that our request to the
+    # server works as expected
+    nv_client = search.client.NonvexClient("http://localhost:5000")
+    hps = nv_client.get_hyperparameters()
+    assert hps == ["learning_rate", "batch_size"]
+
+    # make sure that the kwarg parser comes
+    # up with the right arguments
+    args = ["--hidden-dim", "128"]
+    kwargs = search.search.read_fn_kwargs(fn, args, hps)
+    assert len(kwargs) == 1
+    assert kwargs["hidden_dim"] == 128
+
+    # finally run a search and make sure all
+    # trials get run, and that the learning
+    # rate (stored as "val_loss") is within
+    # range for all runs
+    results = search.search.run_search("train:main", args=args)
+    assert len(results) == max_trials
+
+    for i in results:
+        assert 5e-6 < i["val_loss"] < 5e-4
+
+
+# make sure retries work when the worker's
+# own trial is taking up the last slot too
+@pytest.mark.parametrize("max_parallel_workers", [1, 4])
+def test_client_retries(app, server):
+    request = requests.Session.request
+    lost = []
+
+    # let every request reach the server, but lose the response
+    # the first time around, so that the client has to retry
+    # requests that the server has already acted on
+    def flaky_request(self, method, url, **kwargs):
+        response = request(self, method, url, **kwargs)
+        if url not in lost:
+            lost.append(url)
+            raise requests.ConnectionError("Lost response")
+        return response
+
+    searcher = app.extensions["nonvex"]
+    with patch("requests.Session.request", flaky_request):
+        nv_client = search.client.NonvexClient(
+            "http://localhost:5000", "zaphod", backoff=0
+        )
+        _, trial_id = nv_client.start_worker()
+        assert searcher._trial_ids("zaphod") == [trial_id]
+
+        _, trial_id = nv_client.cancel_trial(trial_id)
+        assert searcher.failure_counts["zaphod"] == 1
+        assert searcher._trial_ids("zaphod") == [trial_id]
+
+        _, next_id = nv_client.end_trial(trial_id, {"val_loss": 0.1})
+        assert searcher.oracle.trials[trial_id].score == 0.1
+        assert searcher._trial_ids("zaphod") == [next_id]
+    assert len(lost) == 3
+
+
+def test_search_batched(server, max_trials):
+    results = search.search.run_search(
+        "train:main", num_trials=3, args=["--hidden-dim", "128"]
+    )
+    assert len(results) == max_trials
+    for i in results:
+        assert 5e-6 < i["val_loss"] < 5e-4
+
+
+def test_async_search(app, max_trials, max_parallel_workers):
+    # the Flask test client doesn't play well with asyncio
+    # contexts, so use a real server for workers to talk to
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.port}"
+
+    # keep track of how many trials are running at once
+    content = """
+import asyncio
+
+running = peak = 0
+
+
+async def main(learning_rate: float, batch_size: int):
+    global running, peak
+    running += 1
+    peak = max(peak, running)
+    await asyncio.sleep(0.05)
+    running -= 1
+    return {"val_loss": learning_rate}
+"""
+    with open("train_async.py", "w") as f:
+        f.write(content)
+
+    try:
+        results = asyncio.run(
+            search.run_async_search(
+                "train_async:main",
+                url=url,
+                num_concurrent=2 * max_parallel_workers,
+            )
+        )
+        train_async = importlib.import_module("train_async")
+
+        # make sure we don't let synchronous functions through
+        with pytest.raises(ValueError):
+            asyncio.run(search.run_async_search("train:main", url=url))
+    finally:
+        server.shutdown()
+        os.remove("train_async.py")
+
+    assert len(results) == max_trials
+    assert 1 < train_async.peak <= max_parallel_workers
+    for i in results:
+        assert 5e-6 < i["val_loss"] < 5e-4
+
+
+def test_search_study(max_trials, output_dir):
+    app = create_study_app(os.path.join(output_dir, "study-search"), 0)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.port}"
+
+    # give the study a search space with the `hidden_dim`
+    # argument the training function needs, which the
+    # one in `nonvex-hp.py` doesn't have
+    hyperparameters = kt.HyperParameters()
+    hyperparameters.Float("learning_rate", 5e-6, 5e-4, sampling="log")
+    hyperparameters.Choice("batch_size", [32, 64])
+    hyperparameters.Int("hidden_dim", 8, 64)
+
+    try:
+        client = search.NonvexClient(url, study="study")
+        client.create_study(
+            hyperparameters, "val_loss", max_trials, max_parallel_workers=2
+        )
+        results = search.run_search("train:main", url=url, study="study")
+    finally:
+        server.shutdown()
+        app.extensions["nonvex"].close()
+    assert len(results) == max_trials
+
+
+def test_search_isolated(server, max_trials, tmp_path):
+    # have the first trial take down its whole process, and make
+    # sure that the search carries on without it. Every trial
+    # reports its pid so we can check that each one ran in a
+    # fresh process that isn't the worker's
+    marker = tmp_path / "crashed"
+    content = f"""
+import os
+import signal
+
+
+def main(learning_rate: float, batch_size: int):
+    if not os.path.exists("{marker}"):
+        open("{marker}", "w").close()
+        os.kill(os.getpid(), signal.SIGKILL)
+    return {{"val_loss": learning_rate, "pid": os.getpid()}}
+"""
+    with open("train_crash.py", "w") as f:
+        f.write(content)
+
+    try:
+        results = search.search.run_search("train_crash:main", isolate=True)
+    finally:
+        os.remove("train_crash.py")
+
+    assert marker.exists()
+    assert len(results) == max_trials
+    pids = set([i["pid"] for i in results])
+    assert len(pids) == max_trials
+    assert os.getpid() not in pids
+
 
-    with patch("requests.get", get_patch):
-        # make sure we can parse the function from the name
-        fn = search.search.get_train_fn("train:main")
-        assert fn(1e-3, 32, 128)["val_loss"] == 1e-3
+@pytest.mark.parametrize("local", [False, True])
+def test_client_stops_lost_trials(app, server, local):
+    from nonvex.search.local import LocalClient
 
-        # make sure that our request to the
-        # server works as expected
-        nv_client = search.client.NonvexClient("http://localhost:5000")
-        hps = nv_client.get_hyperparameters()
-        assert hps == ["learning_rate", "batch_size"]
+    def make_client(worker_id):
+        if local:
+            return LocalClient(app.extensions["nonvex"], worker_id)
+        return search.client.NonvexClient("http://localhost:5000", worker_id)
 
-        # make sure that the kwarg parser comes
-        # up with the right arguments
-        args = ["--hidden-dim", "128"]
-        kwargs = search.search.read_fn_kwargs(fn, args, hps)
-        assert len(kwargs) == 1
-        assert kwargs["hidden_dim"] == 128
+    nv_client = make_client("ford")
+    _, trial_id = nv_client.start_worker()
+    assert nv_client.heartbeat() == trial_id
+    assert not nv_client.should_stop(trial_id)
 
-        # finally run a search and make sure all
-        # trials get run, and that the learning
-        # rate (stored as "val_loss") is within
-        # range for all runs
-        results = search.search.run_search("train:main", args=args)
-        assert len(results) == max_trials
+    # once someone else finishes the trial, the next
+    # heartbeat should flag it to stop, and reporting
+    # metrics for it should say to stop too
+    other = make_client("zaphod")
+    other.end_trial(trial_id, {"val_loss": 0.1})
+    assert nv_client.heartbeat() is None
+    assert nv_client.should_stop(trial_id)
+    assert nv_client.report(trial_id, 1, {"val_loss": 1.0})
 
-        for i in results:
-            assert 5e-6 < i["val_loss"] < 5e-4
+    # getting new trials clears the flag
+    _, trial_id = nv_client.start_worker()
+    assert not nv_client.should_stop(trial_id)
+
+
+def test_executor_stop():
+    content = """
+import time
+
+
+def main(learning_rate: float, batch_size: int):
+    time.sleep(learning_rate)
+    return {"val_loss": learning_rate}
+"""
+    with open("train_slow.py", "w") as f:
+        f.write(content)
+
+    executor = search.executor.ForkExecutor("train_slow:main", [])
+    try:
+        # trials should get killed as soon as they're told to stop
+        start_time = time.time()
+        with pytest.raises(search.executor.TrialStopped):
+            executor.run(
+                {"learning_rate": 60, "batch_size": 32},
+                "0",
+                stop=lambda trial_id: True,
+            )
+        assert time.time() - start_time < 10
+
+        # and the executor should carry on running trials
+        result = executor.run(
+            {"learning_rate": 0, "batch_size": 32},
+            "1",
+            stop=lambda trial_id: False,
+        )
+        assert result == {"val_loss": 0}
+    finally:
+        executor.close()
+        os.remove("train_slow.py")
+
+
+def test_search_local_workers(app, max_trials):
+    # local workers run in their own processes, so
+    # we need a real server for them to talk to
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    content = """
+import os
+
+
+def main(learning_rate: float, batch_size: int):
+    return {
+        "val_loss": learning_rate,
+        "worker": os.environ["NV_WORKER_ID"],
+        "device": os.environ["CUDA_VISIBLE_DEVICES"],
+    }
+"""
+    with open("train_local.py", "w") as f:
+        f.write(content)
+
+    try:
+        results = search.search.run_search(
+            "train_local:main",
+            url=f"http://127.0.0.1:{server.port}",
+            worker_id="deep-thought",
+            num_workers=3,
+            devices=["0", "1"],
+        )
+    finally:
+        server.shutdown()
+        os.remove("train_local.py")
+
+    assert len(results) == max_trials
+    for result in results:
+        prefix, i = result["worker"].rsplit("-", maxsplit=1)
+        assert prefix == "deep-thought"
+        assert result["device"] == str(int(i) % 2)
+
+
+def test_local_search(app, server, max_trials, objective, output_dir):
+    from nonvex.search.local import run_local_search
+
+    # run the same search through a server and in-process,
+    # and make sure they both leave behind the same thing
+    args = ["--hidden-dim", "128"]
+    server_results = search.search.run_search("train:main", args=args)
+    searcher = app.extensions["nonvex"]
+    searcher.writer.flush()
+
+    local_results = run_local_search(
+        "train:main",
+        objective=objective,
+        max_trials=max_trials,
+        output_dir=output_dir,
+        project_name="local-test",
+        args=args,
+    )
+    assert len(local_results) == len(server_results) == max_trials
+
+    local_dir = os.path.join(output_dir, "local-test")
+    expected = ["oracle.json", "journal.jsonl", "results.jsonl"]
+    expected += ["trial_" + i for i in searcher.oracle.trials]
+    assert sorted(os.listdir(local_dir)) == sorted(expected)
+    for trial_dir in os.listdir(local_dir):
+        if not trial_dir.startswith("trial_"):
+            continue
+        with open(os.path.join(local_dir, trial_dir, "trial.json")) as f:
+            trial = json.load(f)
+        assert trial["status"] == "COMPLETED"
+        learning_rate = trial["hyperparameters"]["values"]["learning_rate"]
+        assert trial["score"] == learning_rate
+
+
+def test_local_search_early_stopping(max_trials, objective, output_dir):
+    from nonvex.search.local import run_local_search
+
+    content = """
+from nonvex.search import report
+
+def main(learning_rate: float, batch_size: int, num_epochs: int = 8):
+    for epoch in range(num_epochs):
+        if report(epoch + 1, val_loss=learning_rate):
+            break
+    return {"val_loss": learning_rate, "epochs": epoch + 1}
+"""
+    with open("report_train.py", "w") as f:
+        f.write(content)
+
+    try:
+        results = run_local_search(
+            "report_train:main",
+            objective=objective,
+            max_trials=max_trials,
+            output_dir=output_dir,
+            project_name="local-asha-test",
+            grace_period=1,
+            reduction_factor=2,
+        )
+    finally:
+        os.remove("report_train.py")
+
+    # the first trial has nothing to be compared
+    # against, but later ones should get cut short
+    assert len(results) == max_trials
+    assert results[0]["epochs"] == 8
+    assert any([i["epochs"] < 8 for i in results])
 
 
 @pytest.fixture
@@ -103,28 +449,78 @@ def main(
     os.remove("train_with_log.py")
 
 
-def test_search_with_typeo_config(client, worker_id, typeo_config):
-    def get_patch(url, params=None):
-        response = client.get(url, query_string=params)
-        mock = Mock()
-        mock.raise_for_status = lambda: None
-        mock.json = lambda: response.get_json()
-        return mock
+def test_search_with_typeo_config(server, worker_id, typeo_config):
+    # test to make sure we can run a search with a
+    # typeo config for the searched function, including
+    # using NV_* environment variables
+    results = search.search.run_search(
+        "train_with_log:main",
+        worker_id=worker_id,
+        args=["--typeo", "config.toml"],
+    )
 
-    with patch("requests.get", get_patch):
-        # test to make sure we can run a search with a
-        # typeo config for the searched function, including
-        # using NV_* environment variables
-        results = search.search.run_search(
-            "train_with_log:main",
-            worker_id=worker_id,
-            args=["--typeo", "config.toml"],
-        )
+    assert len(results) > 0
+    for i in results:
+        assert 5e-6 < i["val_loss"] < 5e-4
+
+    assert os.path.exists(worker_id + ".log")
+    with open(worker_id + ".log", "r") as f:
+        assert f.read() == "Please can you stop the noise"
+
+
+def test_read_fn_kwargs_cache(typeo_config, monkeypatch):
+    fn = search.search.get_train_fn("train_with_log:main")
+    hps = ["learning_rate", "batch_size"]
+
+    calls = []
+    parse = search.search._parse_fn_kwargs
+
+    def parse_patch(*args):
+        calls.append(args)
+        return parse(*args)
+
+    search.search._cached_fn_kwargs.cache_clear()
+    monkeypatch.setattr(search.search, "_parse_fn_kwargs", parse_patch)
+    argv = list(sys.argv)
+
+    # arguments which don't reference any nonvex environment
+    # variables should only ever get parsed once, and callers
+    # shouldn't be able to mess with the cached values
+    args = ["--hidden-dim", "128", "--log-file", "train.log"]
+    kwargs = search.search.read_fn_kwargs(fn, args, hps)
+    kwargs["hidden_dim"] = 64
+    kwargs = search.search.read_fn_kwargs(fn, args, hps)
+    assert kwargs == {"hidden_dim": 128, "log_file": "train.log"}
+    assert len(calls) == 1
+    assert sys.argv == argv
+
+    # our config references the worker ID, so the arguments
+    # should get parsed again when it changes, but not
+    # when the trial ID changes
+    args = ["--typeo", typeo_config]
+    monkeypatch.setenv("NV_WORKER_ID", "marvin")
+    monkeypatch.setenv("NV_TRIAL_ID", "0")
+    kwargs = search.search.read_fn_kwargs(fn, args, hps)
+    assert kwargs["log_file"] == "marvin.log"
+    assert len(calls) == 2
+
+    monkeypatch.setenv("NV_TRIAL_ID", "1")
+    kwargs = search.search.read_fn_kwargs(fn, args, hps)
+    assert kwargs["log_file"] == "marvin.log"
+    assert len(calls) == 2
 
-        assert len(results) > 0
-        for i in results:
-            assert 5e-6 < i["val_loss"] < 5e-4
+    monkeypatch.setenv("NV_WORKER_ID", "arthur")
+    kwargs = search.search.read_fn_kwargs(fn, args, hps)
+    assert kwargs["log_file"] == "arthur.log"
+    assert len(calls) == 3
+    assert sys.argv == argv
 
-        assert os.path.exists(worker_id + ".log")
-        with open(worker_id + ".log", "r") as f:
-            assert f.read() == "Please can you stop the noise"
+    # arguments that reference the trial ID are different
+    # for every trial, so they shouldn't get cached at all
+    cached = search.search._cached_fn_kwargs.cache_info().currsize
+    args = ["--hidden-dim", "128", "--log-file", "${NV_TRIAL_ID}.log"]
+    for i in range(2):
+        monkeypatch.setenv("NV_TRIAL_ID", str(i))
+        search.search.read_fn_kwargs(fn, args, hps)
+    assert len(calls) == 5
+    assert search.search._cached_fn_kwargs.cache_info().currsize == cached